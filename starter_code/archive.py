@@ -0,0 +1,263 @@
+from array import array
+import bisect
+
+from balance_history import BalanceHistory, block_points, unzigzag, write_varint, zigzag
+from ledger import CASHBACK, Ledger
+
+
+#varints at the start of a record:
+#(block size, blocks, data bytes, encoded points, tail timestamp, tail balance,
+# has newest point, newest timestamp, newest balance,
+# payments, payment bytes, events, event bytes, last event timestamp)
+HEADER_FIELDS = 14
+
+
+def read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    """
+    Decode the LEB128 varint at `pos`; returns `(value, next position)`.
+    """
+    shift = 0
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class AccountArchive:
+    """
+    Compact tier for dormant and closed accounts.
+
+    The balance history, statement ledger and payment numbers of an
+    archived account are packed into a single immutable `bytes` record,
+    replacing the `BalanceHistory`, `Ledger` and payment array objects
+    (and their buffers) it held while resident. A record is a varint
+    header followed by the history in its own block layout (the skip
+    index as raw int64 arrays, then the varint-encoded blocks), the
+    payment numbers as deltas, and the ledger rows as zigzag timestamp
+    delta, kind, amount and counterpart.
+
+    Balance reads binary-search the skip index in place and decode one
+    block, like resident reads; settling a refund appends to the record
+    without decoding it. Writing to an account restores it first.
+    """
+
+    def __init__(self):
+        #handle -> packed record
+        self.records = {}
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __contains__(self, h: int) -> bool:
+        return h in self.records
+
+    def nbytes(self) -> int:
+        """
+        Payload size in bytes of all records.
+        """
+        return sum(len(record) for record in self.records.values())
+
+    def pack(self, h: int, history: BalanceHistory, ledger: Ledger | None, payments: array) -> None:
+        """
+        Store the resident structures of account `h` as one record.
+        """
+        numbers = bytearray()
+        previous = 0
+        for number in payments:
+            write_varint(numbers, number - previous)
+            previous = number
+
+        events = bytearray()
+        timestamp = 0
+        if ledger is not None:
+            for t, kind, amount, counterpart in zip(ledger.timestamps, ledger.kinds, ledger.amounts, ledger.counterparts):
+                write_varint(events, zigzag(t - timestamp))
+                write_varint(events, kind)
+                write_varint(events, zigzag(amount))
+                write_varint(events, zigzag(counterpart))
+                timestamp = t
+
+        has_last = history.last_timestamp is not None
+        header = (history.block_size, len(history.block_timestamps), len(history.data), history.encoded_count,
+                  zigzag(history.tail_timestamp), zigzag(history.tail_balance), int(has_last),
+                  zigzag(history.last_timestamp if has_last else 0), zigzag(history.last_balance if has_last else 0),
+                  len(payments), len(numbers), 0 if ledger is None else len(ledger), len(events), zigzag(timestamp))
+        self.records[h] = self._record(header, history.block_timestamps.tobytes(), history.block_balances.tobytes(),
+                                       history.block_offsets.tobytes(), history.data, numbers, events)
+
+    @staticmethod
+    def _record(header, *sections) -> bytes:
+        #sections may be views into the previous record; they are copied once
+        prefix = bytearray()
+        for value in header:
+            write_varint(prefix, value)
+        return b"".join((prefix, *sections))
+
+    def _sections(self, record: bytes) -> tuple[list[int], int, int, int, int]:
+        #(header, start of the skip index, start of data, start of payments, start of events)
+        pos = 0
+        header = []
+        for _ in range(HEADER_FIELDS):
+            value, pos = read_varint(record, pos)
+            header.append(value)
+        data = pos + 24 * header[1]
+        payments = data + header[2]
+        return header, pos, data, payments, payments + header[10]
+
+    def payments(self, h: int) -> array:
+        """
+        Payment numbers of archived account `h`, in order.
+        """
+        record = self.records[h]
+        header, _, _, pos, _ = self._sections(record)
+        numbers = array("q")
+        number = 0
+        for _ in range(header[9]):
+            delta, pos = read_varint(record, pos)
+            number += delta
+            numbers.append(number)
+        return numbers
+
+    def history(self, h: int) -> BalanceHistory:
+        """
+        Resident copy of the balance history of archived account `h`.
+        """
+        record = self.records[h]
+        header, index, data, payments, _ = self._sections(record)
+        blocks = header[1]
+        return BalanceHistory.from_buffers(header[0], record[index:index + 8 * blocks],
+                                           record[index + 8 * blocks:index + 16 * blocks],
+                                           record[index + 16 * blocks:data], record[data:payments], header[3],
+                                           unzigzag(header[4]), unzigzag(header[5]),
+                                           unzigzag(header[7]) if header[6] else None,
+                                           unzigzag(header[8]) if header[6] else None)
+
+    def balance_at(self, h: int, time_at: int) -> int | None:
+        """
+        Balance of archived account `h` at the latest history point at
+        or before `time_at`, or `None` if `time_at` precedes its history.
+        """
+        record = self.records[h]
+        header, index, data, _, _ = self._sections(record)
+        if header[6] and unzigzag(header[7]) <= time_at:
+            return unzigzag(header[8])
+        blocks = header[1]
+        view = memoryview(record)
+        timestamps = view[index:index + 8 * blocks].cast("q")
+        i = bisect.bisect_right(timestamps, time_at) - 1
+        if i < 0:
+            return None
+        balance = view[index + 8 * blocks:index + 16 * blocks].cast("q")[i]
+        offset = view[index + 16 * blocks:data].cast("Q")[i]
+        count = min(header[0], header[3] - i * header[0])
+        found = None
+        for timestamp, balance in block_points(record, data + offset, timestamps[i], balance, count):
+            if timestamp > time_at:
+                break
+            found = balance
+        return found
+
+    def events(self, h: int, t1: int, t2: int):
+        """
+        Lazily yield `(timestamp, kind, amount, counterpart)` of every
+        ledger row of archived account `h` with `t1 <= timestamp <= t2`,
+        in order, decoding only the rows up to `t2`.
+        """
+        record = self.records[h]
+        header, _, _, _, pos = self._sections(record)
+        timestamp = 0
+        for _ in range(header[11]):
+            delta, pos = read_varint(record, pos)
+            timestamp += unzigzag(delta)
+            if timestamp > t2:
+                return
+            kind, pos = read_varint(record, pos)
+            amount, pos = read_varint(record, pos)
+            counterpart, pos = read_varint(record, pos)
+            if timestamp >= t1:
+                yield timestamp, kind, unzigzag(amount), unzigzag(counterpart)
+
+    def expand(self, h: int) -> tuple[BalanceHistory, Ledger | None, array]:
+        """
+        Decode the record of `h` back into resident structures
+        `(history, ledger or None, payment numbers)`; the record is kept.
+        """
+        record = self.records[h]
+        header, _, _, _, pos = self._sections(record)
+        ledger = None
+        if header[11]:
+            ledger = Ledger()
+            timestamp = 0
+            for _ in range(header[11]):
+                delta, pos = read_varint(record, pos)
+                timestamp += unzigzag(delta)
+                kind, pos = read_varint(record, pos)
+                amount, pos = read_varint(record, pos)
+                counterpart, pos = read_varint(record, pos)
+                ledger.append(timestamp, kind, unzigzag(amount), unzigzag(counterpart))
+        return self.history(h), ledger, self.payments(h)
+
+    def unpack(self, h: int) -> tuple[BalanceHistory, Ledger | None, array]:
+        """
+        `expand` the record of `h` and remove it from the archive.
+        """
+        structures = self.expand(h)
+        del self.records[h]
+        return structures
+
+    def settle(self, h: int, refunds: list[tuple[int, int, int, int]]) -> int:
+        """
+        Record refunds `(CB_timestamp, new balance, payment number,
+        CB_amount)` to archived account `h`, in due order: each adds a
+        balance history point and a cashback event. Returns the number of
+        history points added (a refund at the timestamp of the newest
+        point replaces it). Only the new points and rows are encoded and
+        the rest of the record is copied once per call.
+        """
+        record = self.records[h]
+        header, index, data, payments, events = self._sections(record)
+        block_size, blocks, data_bytes, encoded, tail_timestamp, tail_balance, has_last = header[:7]
+        tail_timestamp, tail_balance = unzigzag(tail_timestamp), unzigzag(tail_balance)
+        last_timestamp, last_balance = unzigzag(header[7]), unzigzag(header[8])
+        event_timestamp = unzigzag(header[13])
+        view = memoryview(record)
+        #skip index entries, block deltas and ledger rows appended to the record
+        timestamps, balances, offsets = array("q"), array("q"), array("Q")
+        deltas, rows = bytearray(), bytearray()
+
+        added = 0
+        for CB_timestamp, balance, number, CB_amount in refunds:
+            if not has_last or last_timestamp != CB_timestamp:
+                added += 1
+                if has_last:
+                    #encode the previous newest point, as BalanceHistory.append does
+                    if encoded % block_size == 0:
+                        timestamps.append(last_timestamp)
+                        balances.append(last_balance)
+                        offsets.append(data_bytes + len(deltas))
+                    else:
+                        write_varint(deltas, zigzag(last_timestamp - tail_timestamp))
+                        write_varint(deltas, zigzag(last_balance - tail_balance))
+                    tail_timestamp, tail_balance = last_timestamp, last_balance
+                    encoded += 1
+            has_last, last_timestamp, last_balance = 1, CB_timestamp, balance
+
+            write_varint(rows, zigzag(CB_timestamp - event_timestamp))
+            write_varint(rows, CASHBACK)
+            write_varint(rows, zigzag(CB_amount))
+            write_varint(rows, zigzag(number))
+            event_timestamp = CB_timestamp
+
+        header[1:9] = (blocks + len(timestamps), data_bytes + len(deltas), encoded, zigzag(tail_timestamp),
+                       zigzag(tail_balance), has_last, zigzag(last_timestamp), zigzag(last_balance))
+        header[11:14] = header[11] + len(refunds), header[12] + len(rows), zigzag(event_timestamp)
+        index_bytes = 8 * blocks
+        self.records[h] = self._record(header, view[index:index + index_bytes], timestamps,
+                                       view[index + index_bytes:index + 2 * index_bytes], balances,
+                                       view[index + 2 * index_bytes:data], offsets, view[data:payments], deltas,
+                                       view[payments:events], view[events:], rows)
+        return added
@@ -0,0 +1,233 @@
+import bisect
+from array import array
+
+
+def zigzag(value: int) -> int:
+    """
+    Map a signed integer onto an unsigned one so small magnitudes of
+    either sign get short varints (0, -1, 1, -2, ... -> 0, 1, 2, 3, ...).
+    """
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value: int) -> int:
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def write_varint(buffer: bytearray, value: int) -> None:
+    """
+    Append `value` (unsigned) to `buffer` as a LEB128 varint.
+    """
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def block_points(data, pos: int, timestamp: int, balance: int, count: int):
+    """
+    Yield the `count` points of the block whose first point (from the
+    skip index) is `(timestamp, balance)` and whose deltas start at
+    `data[pos]`.
+    """
+    yield timestamp, balance
+    for _ in range(count - 1):
+        #timestamp delta
+        shift = 0
+        value = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        timestamp += unzigzag(value)
+        #balance delta
+        shift = 0
+        value = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        balance += unzigzag(value)
+        yield timestamp, balance
+
+
+class BalanceHistory:
+    """
+    Compact, append-only balance history of a single account.
+
+    Points are `(timestamp, balance)` pairs in increasing timestamp order.
+    They are grouped into blocks of `block_size` points; the first point
+    of every block is kept raw in the skip index and the rest of the
+    block is stored as zigzag varint deltas of timestamp and balance.
+    A lookup binary-searches the skip index and decodes a single block.
+
+    The newest point is held unencoded, because several writes at the
+    same timestamp overwrite each other.
+    """
+
+    def __init__(self, block_size: int = 32):
+        self.block_size = block_size
+
+        #skip index, one entry per block
+        self.block_timestamps = array("q")
+        self.block_balances = array("q")
+        self.block_offsets = array("Q")
+
+        #encoded deltas of all blocks
+        self.data = bytearray()
+        self.encoded_count = 0
+        self.tail_timestamp = 0
+        self.tail_balance = 0
+
+        #newest point, not yet encoded
+        self.last_timestamp = None
+        self.last_balance = None
+
+    def __len__(self) -> int:
+        return self.encoded_count + (self.last_timestamp is not None)
+
+    @property
+    def first_timestamp(self) -> int | None:
+        if self.block_timestamps:
+            return self.block_timestamps[0]
+        return self.last_timestamp
+
+    def append(self, timestamp: int, balance: int) -> None:
+        """
+        Record `balance` at `timestamp`. Writing again at the newest
+        timestamp replaces that point.
+        """
+        if self.last_timestamp is not None and timestamp != self.last_timestamp:
+            self._encode(self.last_timestamp, self.last_balance)
+        self.last_timestamp = timestamp
+        self.last_balance = int(balance)
+
+    def _encode(self, timestamp: int, balance: int) -> None:
+        if self.encoded_count % self.block_size == 0:
+            #start a new block: raw point goes to the skip index
+            self.block_timestamps.append(timestamp)
+            self.block_balances.append(balance)
+            self.block_offsets.append(len(self.data))
+        else:
+            write_varint(self.data, zigzag(timestamp - self.tail_timestamp))
+            write_varint(self.data, zigzag(balance - self.tail_balance))
+        self.tail_timestamp = timestamp
+        self.tail_balance = balance
+        self.encoded_count += 1
+
+    def _block_points(self, i: int):
+        """
+        Yield the `(timestamp, balance)` points of block `i`.
+        """
+        count = min(self.block_size, self.encoded_count - i * self.block_size)
+        return block_points(self.data, self.block_offsets[i], self.block_timestamps[i], self.block_balances[i], count)
+
+    def lookup(self, time_at: int) -> int | None:
+        """
+        Balance at the latest timestamp at or before `time_at`, or `None`
+        if `time_at` precedes the whole history.
+        """
+        if self.last_timestamp is not None and self.last_timestamp <= time_at:
+            return self.last_balance
+        i = bisect.bisect_right(self.block_timestamps, time_at) - 1
+        if i < 0:
+            return None
+        found = None
+        for timestamp, balance in self._block_points(i):
+            if timestamp > time_at:
+                break
+            found = balance
+        return found
+
+    def items(self, since: int | None = None):
+        """
+        Iterate over all `(timestamp, balance)` points in time order, or
+        only those at or after `since`, decoding from the block that
+        holds `since`.
+        """
+        first = 0
+        if since is not None:
+            first = max(bisect.bisect_right(self.block_timestamps, since) - 1, 0)
+        for i in range(first, len(self.block_timestamps)):
+            for timestamp, balance in self._block_points(i):
+                if since is None or timestamp >= since:
+                    yield timestamp, balance
+        if self.last_timestamp is not None and (since is None or self.last_timestamp >= since):
+            yield self.last_timestamp, self.last_balance
+
+    def split_before(self, cutoff: int, min_points: int = 1) -> list[tuple[int, int]]:
+        """
+        Remove and return the points of the leading blocks that lie
+        entirely before `cutoff`, if there are at least `min_points` of
+        them. Returns an empty list otherwise.
+        """
+        #block k-1 ends before block k starts, so blocks [0, k) are older than cutoff
+        k = bisect.bisect_right(self.block_timestamps, cutoff) - 1
+        if k <= 0 or k * self.block_size < min_points:
+            return []
+
+        points = []
+        for i in range(k):
+            points.extend(self._block_points(i))
+
+        start = self.block_offsets[k]
+        del self.data[:start]
+        del self.block_timestamps[:k]
+        del self.block_balances[:k]
+        self.block_offsets = array("Q", (offset - start for offset in self.block_offsets[k:]))
+        self.encoded_count -= k * self.block_size
+        return points
+
+    def __reduce__(self):
+        #pickle the buffers as bytes: much faster than pickling each array
+        return (BalanceHistory.from_buffers, (self.block_size, self.block_timestamps.tobytes(),
+                                              self.block_balances.tobytes(), self.block_offsets.tobytes(),
+                                              bytes(self.data), self.encoded_count, self.tail_timestamp,
+                                              self.tail_balance, self.last_timestamp, self.last_balance))
+
+    @classmethod
+    def from_buffers(cls, block_size: int, block_timestamps: bytes, block_balances: bytes, block_offsets: bytes,
+                     data: bytes, encoded_count: int, tail_timestamp: int, tail_balance: int,
+                     last_timestamp: int | None, last_balance: int | None) -> "BalanceHistory":
+        """
+        Rebuild a history from the raw buffers and state given by pickling.
+        """
+        history = cls.__new__(cls)
+        history.block_size = block_size
+        history.block_timestamps = array("q", block_timestamps)
+        history.block_balances = array("q", block_balances)
+        history.block_offsets = array("Q", block_offsets)
+        history.data = bytearray(data)
+        history.encoded_count = encoded_count
+        history.tail_timestamp = tail_timestamp
+        history.tail_balance = tail_balance
+        history.last_timestamp = last_timestamp
+        history.last_balance = last_balance
+        return history
+
+    def copy(self) -> "BalanceHistory":
+        other = BalanceHistory(self.block_size)
+        other.block_timestamps = array("q", self.block_timestamps)
+        other.block_balances = array("q", self.block_balances)
+        other.block_offsets = array("Q", self.block_offsets)
+        other.data = bytearray(self.data)
+        other.encoded_count = self.encoded_count
+        other.tail_timestamp = self.tail_timestamp
+        other.tail_balance = self.tail_balance
+        other.last_timestamp = self.last_timestamp
+        other.last_balance = self.last_balance
+        return other
+
+    def nbytes(self) -> int:
+        """
+        Approximate payload size in bytes (encoded data and skip index).
+        """
+        return (len(self.data) + self.block_timestamps.itemsize * len(self.block_timestamps)
+                + self.block_balances.itemsize * len(self.block_balances)
+                + self.block_offsets.itemsize * len(self.block_offsets))
@@ -1,36 +1,320 @@
-from banking_system import BankingSystem
+from array import array
+from collections import OrderedDict
+import heapq
+import random
+import sys
+import threading
+from operator import itemgetter
+from typing import Iterator
+
 import numpy as np
 
+from archive import AccountArchive
+from banking_system import BankingSystem
+from balance_history import BalanceHistory
+from cashback_policy import CashbackPolicy, FlatCashbackPolicy
+from dedup import DedupCache, idempotent
+from heavy_hitters import SpaceSaving
+from history_store import SegmentStore
+from ledger import CASHBACK, DEPOSIT, KINDS, MERGE, PAYMENT, TRANSFER_IN, TRANSFER_OUT, Ledger, StatementEvent
+from memory import SLOT_BYTES, account_footprint, percentile
+from metrics import Metrics, metered
+from mvcc import versioned
+from payment_registry import PaymentRegistry
+from settlement import HeapScheduler
+
 class BankingSystemImpl(BankingSystem):
+    """
+    In-memory banking engine.
+
+    Account ids are interned once into dense integer handles; every
+    per-account table is a list indexed by handle. The string methods of
+    the `BankingSystem` interface resolve the id and forward to the
+    `*_h` handle methods, which callers holding a handle (see `handle`)
+    can use directly to skip the id lookup.
+
+    The mutating string methods accept an optional `idempotency_key`
+    keyword; when a dedup cache is configured, a retried request with the
+    same key returns the original result instead of being applied twice.
+
+    Reads leave the account state untouched. Writes bump `version` (odd
+    while in progress), so readers on other threads can validate what
+    they read with `mvcc.consistent_read` instead of locking. The only
+    writes made by reads are to caches that stay valid under concurrent
+    writes: `top_spenders` stores rankings under `top_lock`, only when
+    no write ran while it computed them, and `root` compresses merge
+    paths to ancestors that remain ancestors.
+    """
+
+    #number of distinct `n` values whose top_spenders ranking is cached
+    TOP_CACHE_SIZE = 8
+
+    def __init__(self, history_dir: str | None = None, hot_window: int = 86400000, spill_min: int = 256,
+                 cache_blocks: int = 64, dedup_capacity: int = 0, dedup_window: int | None = None,
+                 cashback_policy: CashbackPolicy | None = None, scheduler=None,
+                 heavy_hitters_epsilon: float | None = None, metrics: bool = False):
+        """
+        Parameters
+        ----------
+        history_dir: folder for cold balance history segments, or `None`
+        to keep every history point in memory
+        hot_window: history points older than `hot_window` ms before the
+        latest write stay in memory, older ones are spilled to disk
+        spill_min: minimum number of points written per spilled block
+        cache_blocks: number of cold blocks kept in the LRU read cache
+        dedup_capacity: number of idempotency keys remembered (0 disables
+        deduplication)
+        dedup_window: ms of request time after which a key is forgotten,
+        or `None` to only evict by capacity
+        cashback_policy: decides cashback amount and delay of payments;
+        defaults to the flat 2% refund after 24 hours
+        scheduler: queue of pending refunds (`HeapScheduler` by default,
+        or a `TimingWheel`, cheaper only with ~10M refunds pending)
+        heavy_hitters_epsilon: enables `top_spenders(..., approximate=True)`
+        with a sketch of `ceil(1 / epsilon)` counters whose totals are
+        overestimated by at most `epsilon` times all outgoing money
+        metrics: count and time the calls of the public methods (see
+        `metrics.exposition`)
+        """
+        #interning: live account id -> handle, and handle -> account id
+        self.ids = {}
+        self.names = []
+
+        #per-account tables, indexed by handle (handles are never reused);
+        #numeric columns are int64 arrays, so updating them allocates nothing
+        self.live = bytearray()
+        self.created = array("q")
+        self.balances = array("q")
+        self.histories = []
+        self.outgoing = array("q")
+        #payment numbers of every payer; histories and payment lists are
+        #created on an account's first activity
+        self.payments = []
+        #statement ledgers, created on the first event of an account
+        self.ledgers = []
+
+        #merge lineage: parent handle (-1 unless merged away) and the timestamp
+        #the account left (merge or close); histories stay with their own
+        #handle and are never copied
+        self.merged_into = []
+        self.merged_at = []
+        #union-find alias of every handle, compressed towards the live account
+        self.alias = []
+        #merged-away account id -> its handle
+        self.retired = {}
+        #handle -> handles merged directly into it
+        self.merged_from = {}
+
+        #packed history, ledger and payment numbers of archived accounts;
+        #their resident entries are None, like those of accounts without
+        #any activity yet
+        self.archive = AccountArchive()
+
+        #payment id -> (owner handle, CB_timestamp, CB_amount, CB_status), stored by payment number
+        self.pay_log = PaymentRegistry()
+
+        #cold tier for balance history (disabled by default), keyed by handle
+        self.history_store = None
+        if history_dir is not None:
+            self.history_store = SegmentStore(history_dir, cache_blocks=cache_blocks)
+        self.hot_window = hot_window
+        self.spill_min = spill_min
+
+        #results of requests carrying an idempotency key
+        self.dedup = None
+        if dedup_capacity > 0:
+            self.dedup = DedupCache(dedup_capacity, dedup_window)
+
+        self.cashback_policy = cashback_policy if cashback_policy is not None else FlatCashbackPolicy()
+
+        #top_spenders rankings by n: [ranking entries, accounts changed since]
+        self.top_cache = OrderedDict()
+        #guards top_cache against readers on other threads
+        self.top_lock = threading.Lock()
+        #fixed-size sketch of outgoing totals by handle (disabled by default)
+        self.heavy_hitters = None
+        if heavy_hitters_epsilon is not None:
+            self.heavy_hitters = SpaceSaving.with_error(heavy_hitters_epsilon)
+
+        #global settlement clock and pending refunds (payment ids) by CB_timestamp
+        self.clock = float("-inf")
+        self.scheduler = scheduler if scheduler is not None else HeapScheduler()
+
+        #write counter, odd while a write is in progress
+        self.version = 0
+
+        #engine-wide totals kept up to date by the writes, for monitoring;
+        #every account counts its creation point even before it is stored
+        self.history_points = 0
+        self.pending_cashback = 0
+        self.merged_accounts = 0
+        #call counters and latency histograms (disabled by default)
+        self.metrics = Metrics() if metrics else None
+
+    def handle(self, account_id: str) -> int | None:
+        """
+        Integer handle of the live account `account_id`, or `None` if it
+        doesn't exist. A handle stays valid until the account is merged
+        away.
+        """
+        return self.ids.get(account_id)
+
+    #helper function to log the current balance in the balance history
+    def record_balance(self, timestamp: int, h: int) -> None:
+        """
+        Store the current balance of account `h` at `timestamp` and spill
+        history older than the hot window to the cold tier.
+        """
+        history = self.histories[h]
+        #a second write at the newest timestamp replaces that point
+        if history.last_timestamp != timestamp:
+            self.history_points += 1
+        history.append(timestamp, self.balances[h])
+
+        if self.history_store is None or len(history) < 2 * self.spill_min:
+            return
+        cutoff = timestamp - self.hot_window
+        if history.first_timestamp >= cutoff:
+            return
+
+        #history is in time order, so the cold points are whole leading blocks
+        cold_points = history.split_before(cutoff, self.spill_min)
+        self.history_store.append(h, cold_points)
+
+    #helper function for balance lookups across the hot and cold tiers
+    def balance_at(self, history_id: int, history: BalanceHistory, time_at: int) -> int | None:
+        """
+        Balance logged at the latest timestamp at or before `time_at`, or
+        `None` if `time_at` precedes the whole history.
+        """
+        if history is None:
+            if history_id not in self.archive:
+                #no activity since creation
+                return 0 if self.created[history_id] <= time_at else None
+            balance = self.archive.balance_at(history_id, time_at)
+        else:
+            balance = history.lookup(time_at)
+        if balance is not None:
+            return balance
+        if self.history_store is not None:
+            return self.history_store.lookup(history_id, time_at)
+        return None
+
+    def memory_report(self, sample: int = 1000, top: int = 5, seed: int = 0) -> dict:
+        """
+        Estimated memory footprint of the engine in bytes.
+
+        Per-account structures (account tables, balance histories,
+        statement ledgers, payment lists, archive records and `pay_log`
+        entries) are measured on `sample` random accounts and scaled to
+        all accounts; with fewer accounts than `sample` they are measured
+        exactly.
+        Returns `{"accounts", "sampled", "structures": {name: bytes},
+        "total", "per_account": {"p50", "p90", "p99", "max"}, "heaviest":
+        [(account_id, bytes), ...]}`, the last two over the sample.
+        """
+        n = len(self.names)
+        handles = range(n) if n <= sample else random.Random(seed).sample(range(n), sample)
+        structures = {}
+        per_account = []
+        for h in handles:
+            footprint = account_footprint(self, h)
+            for structure, size in footprint.items():
+                structures[structure] = structures.get(structure, 0) + size
+            per_account.append((sum(footprint.values()), h))
+        scale = n / len(handles) if n else 0
+        structures = {structure: int(size * scale) for structure, size in structures.items()}
+
+        #engine-wide structures, measured directly
+        structures["pending_refunds"] = len(self.scheduler) * (sys.getsizeof((0, "")) + SLOT_BYTES)
+        structures["top_cache"] = sum(sys.getsizeof(ranking) + len(ranking) * (sys.getsizeof(ranking[0]) + 64)
+                                      for ranking, _ in self.top_cache.values() if ranking)
+        if self.dedup is not None:
+            structures["dedup"] = sys.getsizeof(self.dedup.entries) + len(self.dedup) * 3 * sys.getsizeof((0, 0))
+        if self.heavy_hitters is not None:
+            structures["heavy_hitters"] = (sys.getsizeof(self.heavy_hitters.counters) + sys.getsizeof(self.heavy_hitters.heap)
+                                           + len(self.heavy_hitters) * 2 * sys.getsizeof([0, 0]))
+
+        per_account.sort()
+        sizes = [size for size, _ in per_account] or [0]
+        return {
+            "accounts": n,
+            "sampled": len(per_account),
+            "structures": structures,
+            "total": sum(structures.values()),
+            "per_account": {"p50": percentile(sizes, 0.5), "p90": percentile(sizes, 0.9),
+                            "p99": percentile(sizes, 0.99), "max": sizes[-1]},
+            "heaviest": [(self.names[h], size) for size, h in reversed(per_account[-top:])],
+        }
+
+    def close(self) -> None:
+        """
+        Release the files held by the cold history tier.
+        """
+        if self.history_store is not None:
+            self.history_store.close()
+
+    @versioned
+    def advance_time(self, timestamp: int) -> int:
+        """
+        Settle every cashback refund due at or before `timestamp`, across
+        all accounts, in due order. Each refund is recorded in the balance
+        history at its CB_timestamp.
+
+        Every balance-changing operation advances the clock to its own
+        timestamp first, so refunds land before any other transaction at
+        the same timestamp.
+        Returns the number of refunds settled.
+        """
+        if timestamp <= self.clock:
+            return 0
+        self.clock = timestamp
+        if not len(self.scheduler):
+            return 0
+
+        #one pass over the whole due batch
+        due_refunds = self.scheduler.pop_due(timestamp)
+        pay_log = self.pay_log
+        owners, amounts, settled = pay_log.owners, pay_log.amounts, pay_log.settled
+        balances, histories = self.balances, self.histories
+        #refunds to archived accounts, by owner, settled into the archive in one pass each
+        archived = {}
+        for CB_timestamp, number in due_refunds:
+            i = number - 1
+            settled[i] = 1
+            #refunds of merged-away payers go to the account they were merged into
+            owner = self.root(owners[i])
+            balances[owner] += amounts[i]
+            self.pending_cashback -= amounts[i]
+            if histories[owner] is None:
+                #settle into the archive without restoring the account
+                archived.setdefault(owner, []).append((CB_timestamp, balances[owner], number, amounts[i]))
+                continue
+            self.record_balance(CB_timestamp, owner)
+            self.log_event(CB_timestamp, owner, CASHBACK, amounts[i], number)
+        for owner, refunds in archived.items():
+            self.history_points += self.archive.settle(owner, refunds)
+        return len(due_refunds)
+
+    #helper function to append to the statement ledger of an account
+    def log_event(self, timestamp: int, h: int, kind: int, amount: int, counterpart: int = -1) -> None:
+        ledger = self.ledgers[h]
+        if ledger is None:
+            ledger = self.ledgers[h] = Ledger()
+        ledger.append(timestamp, kind, amount, counterpart)
 
-    def __init__(self):
-        self.accounts = {}
-        self.pay_log = {}
-    
     #helper function for CB
-    def cashback(self, timestamp: int, account_id: str) -> None:
-        """
-        Process cashback refunds due by `timestamp`.
-
-        Refunds must be applied at the cashback timestamp (CB_timestamp),
-        and the balance snapshot must be recorded at timestamp.
-        """
-        CB = 0
-        #if timestamp >= CB timestamp and CB has not been payed
-        for payment in self.accounts[account_id]["payments"]:
-              pay_account_id, CB_timestamp, CB_amount, CB_status = self.pay_log[payment]
-              if CB_timestamp <= timestamp and CB_status == False:
-                  CB += CB_amount
-                  self.pay_log[payment] = (pay_account_id, CB_timestamp, CB_amount, True)
-        
-        #update balance by CB
-        if CB >0:
-            self.accounts[account_id]["current_balance"] += CB
-            if timestamp not in self.accounts[account_id]["balance"]:
-                self.accounts[account_id]["balance"][timestamp] = self.accounts[account_id]["current_balance"]
-    
+    def cashback(self, timestamp: int, h: int | None = None) -> None:
+        """
+        Process cashback refunds due by `timestamp`. Settlement is global,
+        so this covers account `h` and every other account.
+        """
+        self.advance_time(timestamp)
         return None
-    
+
+    @metered
+    @idempotent
+    @versioned
     def create_account(self, timestamp: int, account_id: str) -> bool:
         """
         Parameters
@@ -43,19 +327,92 @@ class BankingSystemImpl(BankingSystem):
         `False` if an account with `account_id` already exists.
         """
         #check if account already exists
-        if account_id in self.accounts:
+        if account_id in self.ids:
             return False
-        #create account
+        #create account with the next free handle
         else:
-            self.accounts[account_id] = {}
-            self.accounts[account_id]["account_created"] = timestamp 
-            self.accounts[account_id]["balance"] = {}
-            self.accounts[account_id]["balance"][timestamp] = 0
-            self.accounts[account_id]["current_balance"] = 0
-            self.accounts[account_id]["transfers"] = {}
-            self.accounts[account_id]["payments"] = []
+            h = len(self.names)
+            self.ids[account_id] = h
+            self.names.append(account_id)
+            self.live.append(1)
+            self.mark_dirty(h)
+            self.created.append(timestamp)
+            self.balances.append(0)
+            self.histories.append(None)
+            self.outgoing.append(0)
+            self.payments.append(None)
+            self.ledgers.append(None)
+            self.merged_into.append(-1)
+            self.merged_at.append(None)
+            self.alias.append(h)
+            self.history_points += 1
             return True
 
+    @metered
+    @idempotent
+    @versioned
+    def create_accounts(self, timestamp: int, account_ids: list[str]) -> list[bool]:
+        """
+        Create many accounts at `timestamp` in one pass, with the result
+        of `create_account(timestamp, account_id)` for each id in order:
+        `False` for ids that already exist or repeat an earlier id of the
+        batch.
+
+        Every per-account column is extended once for the whole batch;
+        histories and payment lists are only created on first activity.
+        Parameters
+        ----------
+        timestamp: current datetime (account creation)
+        account_ids: unique account identifiers
+        Returns
+        -------
+        list[bool]: result of every id, in order
+        """
+        ids = self.ids
+        first = len(self.names)
+        fresh = account_ids
+        results = None
+        if ids.keys().isdisjoint(account_ids):
+            #common case: insert the whole batch, then check it had no repeated ids
+            size = len(ids)
+            ids.update(zip(account_ids, range(first, first + len(account_ids))))
+            if len(ids) - size == len(account_ids):
+                results = [True] * len(account_ids)
+            else:
+                for account_id in account_ids:
+                    ids.pop(account_id, None)
+        if results is None:
+            seen = set()
+            results = [account_id not in ids and account_id not in seen and not seen.add(account_id)
+                       for account_id in account_ids]
+            fresh = [account_id for account_id, created in zip(account_ids, results) if created]
+            ids.update(zip(fresh, range(first, first + len(fresh))))
+        n = len(fresh)
+        if not n:
+            return results
+
+        handles = range(first, first + n)
+        self.names.extend(fresh)
+        self.live.extend(b"\x01" * n)
+        self.created.extend(array("q", [timestamp]) * n)
+        zeros = bytes(8 * n)
+        self.balances.frombytes(zeros)
+        self.outgoing.frombytes(zeros)
+        nones = [None] * n
+        self.histories.extend(nones)
+        self.payments.extend(nones)
+        self.ledgers.extend(nones)
+        self.merged_into.extend([-1] * n)
+        self.merged_at.extend(nones)
+        self.alias.extend(handles)
+        self.history_points += n
+        with self.top_lock:
+            for entry in self.top_cache.values():
+                entry[1].update(handles)
+        return results
+
+    @metered
+    @idempotent
     def deposit(self, timestamp: int, account_id: str, amount: int) ->  None:
         """
         Parameters
@@ -67,19 +424,32 @@ class BankingSystemImpl(BankingSystem):
         -------
         account balance, or 'None' if account does not exist
         """
-        if account_id in self.accounts:  
-          #cashback
-          self.cashback(timestamp, account_id)
+        h = self.ids.get(account_id)
+        if h is None:
+            return None
+        return self.deposit_h(timestamp, h, amount)
 
-          #update current balance and balance history
-          self.accounts[account_id]["current_balance"] += amount
-          self.accounts[account_id]["balance"][timestamp] = self.accounts[account_id]["current_balance"]
-    
-          return self.accounts[account_id]["current_balance"]
-        
-        else:
-          return None
+    @versioned
+    def deposit_h(self, timestamp: int, h: int, amount: int) -> int | None:
+        """
+        `deposit` for the account with handle `h`.
+        """
+        if not self.live[h]:
+            return None
+        if self.histories[h] is None:
+            self.materialize(h)
+        #cashback
+        if timestamp > self.clock:
+            self.advance_time(timestamp)
 
+        #update current balance and balance history
+        self.balances[h] += amount
+        self.record_balance(timestamp, h)
+        self.log_event(timestamp, h, DEPOSIT, amount)
+        return self.balances[h]
+
+    @metered
+    @idempotent
     def transfer(self, timestamp: int, source_account_id: str, target_account_id: str, amount: int) -> None:
         """
         Parameters
@@ -93,28 +463,49 @@ class BankingSystemImpl(BankingSystem):
         balance of source_account_id, or 'None' if source_account_id or target_account_id do not exist
         or if source and target accounts are the same, or if insufficient funds for transfer.
         """
+        #check if accounts exist
+        source = self.ids.get(source_account_id)
+        target = self.ids.get(target_account_id)
+        if source is None or target is None:
+            return None
+        return self.transfer_h(timestamp, source, target, amount)
+
+    @versioned
+    def transfer_h(self, timestamp: int, source: int, target: int, amount: int) -> int | None:
+        """
+        `transfer` between the accounts with handles `source` and `target`.
+        """
         #check if accounts exist or if self-transfer
-        if source_account_id not in self.accounts or target_account_id not in self.accounts:
+        if not self.live[source] or not self.live[target]:
             return None
-        if source_account_id == target_account_id:
+        if source == target:
             return None
+        if self.histories[source] is None:
+            self.materialize(source)
+        if self.histories[target] is None:
+            self.materialize(target)
+        if timestamp > self.clock:
+            self.advance_time(timestamp)
+
+        #update balance and transfer history
+        balances = self.balances
+        if balances[source] - amount >= 0:
+            balances[source] -= amount
+            balances[target] += amount
+            self.record_balance(timestamp, source)
+            self.record_balance(timestamp, target)
+            self.log_event(timestamp, source, TRANSFER_OUT, amount, target)
+            self.log_event(timestamp, target, TRANSFER_IN, amount, source)
+            self.outgoing[source] += amount
+            self.mark_dirty(source)
+            if self.heavy_hitters is not None:
+                self.heavy_hitters.update(source, amount)
+            return balances[source]
         else:
-            self.cashback(timestamp, source_account_id)
-            self.cashback(timestamp, target_account_id)
-
-            #update balance and transfer history
-            if self.accounts[source_account_id]["current_balance"] - amount >= 0:
-              self.accounts[source_account_id]["current_balance"] -= amount
-              self.accounts[target_account_id]["current_balance"] += amount
-              self.accounts[source_account_id]["balance"][timestamp] = self.accounts[source_account_id]["current_balance"]
-              self.accounts[target_account_id]["balance"][timestamp] = self.accounts[target_account_id]["current_balance"]
-              self.accounts[source_account_id]["transfers"][timestamp] = amount
-              return self.accounts[source_account_id]["current_balance"]
-            else:
-              return None
-            
+            return None
 
-    def top_spenders(self, timestamp: int, n: int) -> list[str]:
+    @metered
+    def top_spenders(self, timestamp: int, n: int, approximate: bool = False) -> list[str]:
         """
         Should return the identifiers of the top `n` accounts with
         the highest outgoing transactions - the total amount of
@@ -131,33 +522,107 @@ class BankingSystemImpl(BankingSystem):
           * Cashback (an operation that will be introduced in level 3)
           should not be reflected in the calculations for total
           outgoing transactions.
+        With `approximate` (requires `heavy_hitters_epsilon`), the
+        ranking and totals come from the heavy-hitter sketch instead.
         """
-        transfer_sum_log = []
-        #sum all transactions for each account
-        for account_id in self.accounts:
-            transfer_sum = 0
-            for timestamp in self.accounts[account_id]["transfers"]:
-                transfer_sum += self.accounts[account_id]["transfers"][timestamp]
-            transfer_sum_log.append((account_id, transfer_sum))
-        
-        #sort by decreasing transfer sum, then increasing account name if tie
-        transfer_sum_log.sort(key=lambda x: (-x[1], x[0]))
-
-        #ensure n top spenders is at most equal to number of accounts
-        if n > len(transfer_sum_log):
-            n_correct = len(transfer_sum_log)
+        if n <= 0:
+            return []
+        if approximate:
+            return self.approximate_spenders(n)
+        version = self.version
+        with self.top_lock:
+            entry = self.top_cache.get(n)
+            if entry is not None:
+                self.top_cache.move_to_end(n)
+                ranking, dirty = entry[0], set(entry[1])
+        if entry is None:
+            ranking = self.rank_spenders(n)
+        elif dirty:
+            ranking = self.patch_ranking(n, ranking, dirty)
         else:
-            n_correct = n
-        
-        #build final list of strings
-        transfer_sum_log_str = []
-        for i in range(n_correct):
-            transfer_sum_str = transfer_sum_log[i][0] + "(" + str(transfer_sum_log[i][1]) +")"
-            transfer_sum_log_str.append(transfer_sum_str)
-        return transfer_sum_log_str
+            return [ranked[3] for ranked in ranking]
+
+        #cache the ranking only if no write started before or ran during the
+        #computation, so it matches the marks it clears
+        with self.top_lock:
+            if not version & 1 and self.version == version:
+                if entry is None:
+                    self.top_cache[n] = [ranking, set()]
+                    if len(self.top_cache) > self.TOP_CACHE_SIZE:
+                        self.top_cache.popitem(last=False)
+                elif self.top_cache.get(n) is entry:
+                    entry[0] = ranking
+                    entry[1] = set()
 
+        #build final list of strings (cached alongside the ranking)
+        return [ranked[3] for ranked in ranking]
 
-    def pay(self, timestamp: int, account_id: str, amount: int) -> str :
+    def approximate_spenders(self, n: int) -> list[str]:
+        """
+        Top `n` accounts by estimated outgoing total from the sketch, in
+        the `top_spenders` format. Estimates never undercount and accounts
+        spending more than `epsilon` of all outgoing money are always
+        tracked; the order among smaller accounts is approximate.
+        """
+        if self.heavy_hitters is None:
+            raise ValueError("approximate top_spenders needs heavy_hitters_epsilon")
+        names = self.names
+        best = sorted((-count, names[h]) for h, count in self.heavy_hitters.top(n))
+        return [account_id + "(" + str(-count) + ")" for count, account_id in best]
+
+    #helper function to track accounts whose outgoing total changed
+    def mark_dirty(self, h: int) -> None:
+        with self.top_lock:
+            for entry in self.top_cache.values():
+                entry[1].add(h)
+
+    def spender_entry(self, h: int) -> tuple[int, str, int, str]:
+        #sorts by decreasing transfer sum, then increasing account name if tie
+        return (-self.outgoing[h], self.names[h], h, self.names[h] + "(" + str(self.outgoing[h]) + ")")
+
+    def rank_spenders(self, n: int) -> list[tuple[int, str, int, str]]:
+        """
+        Top `n` ranking entries `(-outgoing, account_id, handle, text)`
+        computed from scratch, in O(accounts * log n).
+        """
+        outgoing = self.outgoing
+        best = heapq.nsmallest(n, ((-outgoing[h], account_id, h) for account_id, h in self.ids.items()))
+        return [self.spender_entry(h) for _, _, h in best]
+
+    def patch_ranking(self, n: int, ranking: list, dirty: set) -> list:
+        """
+        Update a cached top-`n` ranking after the accounts in `dirty`
+        changed. Outgoing totals only grow, so an account outside the
+        ranking can enter it only if it is dirty; a full recompute is
+        needed only when a ranked account was merged away from a full
+        ranking and the gap must be refilled.
+        """
+        live = self.live
+        ranked = {entry[2] for entry in ranking}
+        full = len(ranking) == n
+        if full and any(not live[h] for h in dirty if h in ranked):
+            return self.rank_spenders(n)
+        if len(dirty) > len(self.ids) // 2:
+            return self.rank_spenders(n)
+
+        keep = [entry for entry in ranking if entry[2] not in dirty]
+        candidates = []
+        for h in dirty:
+            if not live[h]:
+                continue
+            entry = self.spender_entry(h)
+            #an account that is not ranked must beat the current last place
+            if h in ranked or not full or entry < ranking[-1]:
+                candidates.append(entry)
+        if not candidates:
+            return keep
+        candidates.sort()
+        return list(heapq.merge(keep, candidates))[:n]
+
+
+    @metered
+    @idempotent
+    def pay(self, timestamp: int, account_id: str, amount: int, merchant_category: int = 0) -> str :
         """
         Should withdraw the given amount of money from the specified
         account.
@@ -184,38 +649,56 @@ class BankingSystemImpl(BankingSystem):
           * When it's time to process cashback for a withdrawal, the
           amount must be refunded to the account before any other
           transactions are performed at the relevant timestamp.
+        The cashback amount and delay come from the configured
+        `cashback_policy`, which may use `merchant_category`.
         """
+        h = self.ids.get(account_id)
+        if h is None:
+            return None
+        return self.pay_h(timestamp, h, amount, merchant_category)
 
-        if account_id not in self.accounts:
+    @versioned
+    def pay_h(self, timestamp: int, h: int, amount: int, merchant_category: int = 0) -> str | None:
+        """
+        `pay` from the account with handle `h`.
+        """
+        if not self.live[h]:
             return None
-        
+        if self.histories[h] is None:
+            self.materialize(h)
+
         #apply CB if needed
-        self.cashback(timestamp, account_id)
+        if timestamp > self.clock:
+            self.advance_time(timestamp)
 
         #account does not have sufficient balance for payment
-        if amount > self.accounts[account_id]["current_balance"]:
+        if amount > self.balances[h]:
             return None
-        
-        #update balances and transfers
-        self.accounts[account_id]["balance"][timestamp] = self.accounts[account_id]["current_balance"] - amount
-        self.accounts[account_id]["current_balance"] -= amount
-        self.accounts[account_id]["transfers"][timestamp] = amount
-        
-        pay_count = len(self.pay_log) + 1
-        pay_str = "payment" + str(pay_count)
 
-        #create CB
-        CB_timestamp = timestamp + 86400000
-        CB_amount = np.floor(0.02 * amount) #round down to nearest int, per instructions
-        CB_status = False
+        #update balances and outgoing total
+        self.balances[h] -= amount
+        self.record_balance(timestamp, h)
+        self.outgoing[h] += amount
+        self.mark_dirty(h)
+        if self.heavy_hitters is not None:
+            self.heavy_hitters.update(h, amount)
 
-        #update pay_log
-        self.pay_log[pay_str] = (account_id, CB_timestamp, CB_amount, CB_status)
-        self.accounts[account_id]["payments"].append(pay_str)
+        #create CB (policies round down to the nearest int, per instructions)
+        policy = self.cashback_policy
+        CB_timestamp = timestamp + policy.delay
+        CB_amount = policy.evaluate(h, amount, timestamp, merchant_category)
 
-        return pay_str
+        #update pay_log and schedule the refund by payment number
+        pay_count = self.pay_log.add(h, CB_timestamp, CB_amount)
+        self.pending_cashback += CB_amount
+        self.payments[h].append(pay_count)
+        self.log_event(timestamp, h, PAYMENT, amount, pay_count)
+        self.scheduler.schedule(CB_timestamp, pay_count)
 
+        return "payment" + str(pay_count)
 
+
+    @metered
     def get_payment_status(self, timestamp: int, account_id: str, payment: str) -> str :
         """
         Should return the status of the payment transaction for the
@@ -229,25 +712,70 @@ class BankingSystemImpl(BankingSystem):
           * Returns a string representing the payment status:
           `"IN_PROGRESS"` or `"CASHBACK_RECEIVED"`.
         """
+        #check if account exists
+        h = self.ids.get(account_id)
+        if h is None:
+            return None
+        return self.get_payment_status_h(timestamp, h, payment)
+
+    def get_payment_status_h(self, timestamp: int, h: int, payment: str) -> str | None:
+        """
+        `get_payment_status` for the account with handle `h`.
+        """
         #check if account exists and if payment was made from inputted account
-        if account_id not in self.accounts:
+        if not self.live[h]:
             return None
-        if payment not in self.pay_log:
+        pay_count = self.pay_log.number(payment)
+        if pay_count is None:
             return None
-        
-        #check pay log
-        payment_info = self.pay_log[payment]
-        #payment_info = (account_id, CB_timestamp, CB_amount, CB_status)
-        
-        #check payment status from payment info in pay log
-        if payment_info[0] != account_id:
+
+        #check payment status from the pay log columns; payments of
+        #merged-away accounts belong to the account they were merged into
+        if self.root(self.pay_log.owners[pay_count - 1]) != h:
             return None
         else:
-            if timestamp < payment_info[1]:
+            if timestamp < self.pay_log.due[pay_count - 1]:
                 return "IN_PROGRESS"
             else:
                 return "CASHBACK_RECEIVED"
 
+    @metered
+    def get_payment_statuses(self, timestamp: int, account_id: str, payments: list[str]) -> list[str | None]:
+        """
+        `get_payment_status(timestamp, account_id, payment)` for every id
+        in `payments`, in order, resolved in one pass over the payment
+        registry columns.
+        """
+        h = self.ids.get(account_id)
+        if h is None:
+            return [None] * len(payments)
+        return self.get_payment_statuses_h(timestamp, h, payments)
+
+    def get_payment_statuses_h(self, timestamp: int, h: int, payments: list[str]) -> list[str | None]:
+        """
+        `get_payment_statuses` for the account with handle `h`.
+        """
+        if not self.live[h]:
+            return [None] * len(payments)
+        #0 stands for ids that name no payment
+        numbers = self.pay_log.numbers(payments)
+        found = np.flatnonzero(numbers)
+        rows = numbers[found] - 1
+        owners = np.frombuffer(self.pay_log.owners, dtype=np.int64)[rows]
+
+        #payments made by h or by any account merged into it; each distinct
+        #owner is resolved through the merge aliases once
+        distinct = np.unique(owners).tolist()
+        mine = np.isin(owners, [owner for owner in distinct if self.root(owner) == h])
+        found, rows = found[mine], rows[mine]
+
+        due = np.frombuffer(self.pay_log.due, dtype=np.int64)[rows]
+        statuses = np.full(len(payments), None, dtype=object)
+        statuses[found] = np.array(["CASHBACK_RECEIVED", "IN_PROGRESS"], dtype=object)[(timestamp < due).view(np.int8)]
+        return statuses.tolist()
+
+    @metered
+    @idempotent
     def merge_accounts(self, timestamp: int, account_id_1: str, account_id_2: str) -> bool:
         """
         Should merge `account_id_2` into the `account_id_1`.
@@ -272,57 +800,313 @@ class BankingSystemImpl(BankingSystem):
           * `account_id_2` should be removed from the system after the
           merge.
         """
-        
-        if account_id_1 == account_id_2:
+        h1 = self.ids.get(account_id_1)
+        h2 = self.ids.get(account_id_2)
+        if h1 is None or h2 is None:
+            return False
+        return self.merge_accounts_h(timestamp, h1, h2)
+
+    @versioned
+    def merge_accounts_h(self, timestamp: int, h1: int, h2: int) -> bool:
+        """
+        `merge_accounts` of the account with handle `h2` into `h1`.
+        """
+        if h1 == h2:
             return False
-        
-        if account_id_1 not in self.accounts or account_id_2 not in self.accounts:
+
+        if not self.live[h1] or not self.live[h2]:
             return False
 
         # process pending payments
-        self.cashback(timestamp, account_id_1)
-        self.cashback(timestamp, account_id_2)
-       
-        # merged_account_history
-        self.accounts[account_id_1].setdefault("merged_account_history", set()).update(
-            {account_id_2}.union(self.accounts[account_id_2].get("merged_account_history", set())))
-        
-        # now merge by updating individual account variables/data structures
-        self.accounts[account_id_1]["current_balance"] += self.accounts[account_id_2]["current_balance"]
-
-        #storing deleted acc's balance history separately, did not combine the balance 
-        #histories because then we overwrite and lose time stamps
-        if "merged_balance_histories" not in self.accounts[account_id_1]:
-            self.accounts[account_id_1]["merged_balance_histories"] = {}
-        
-        #stores (balance history, merge_timestamp)
-        self.accounts[account_id_1]["merged_balance_histories"][account_id_2] = (self.accounts[account_id_2]["balance"].copy(), timestamp)
-        
-        #to check if account_id_2 has any previous merged histories
-        if "merged_balance_histories" in self.accounts[account_id_2]:
-            for inside, inside_data in self.accounts[account_id_2]["merged_balance_histories"].items():
-                self.accounts[account_id_1]["merged_balance_histories"][inside] = inside_data
-        
+        self.advance_time(timestamp)
+
+        self.absorb(timestamp, h1, h2)
+
         #new balance at merge timestamp with new/combined current_balance
-        self.accounts[account_id_1]["balance"][timestamp] = self.accounts[account_id_1]["current_balance"]
-        
-        #merge transfers and payments
-        merged_transfers = {**self.accounts[account_id_1]["transfers"], **self.accounts[account_id_2]["transfers"]}
-        self.accounts[account_id_1]["transfers"] = dict(sorted(merged_transfers.items()))
-        
-        merged_payments = sorted(self.accounts[account_id_1]["payments"] + self.accounts[account_id_2]["payments"])
-        self.accounts[account_id_1]["payments"] = merged_payments
-
-        # update master pay_log to reflect new account synonyms
-        for payment, payment_record in self.pay_log.items():
-            self.pay_log[payment] = (payment_record[0].replace(account_id_2, account_id_1), *payment_record[1:])
+        self.record_balance(timestamp, h1)
+        return True
+
+    #helper function for merges
+    def absorb(self, timestamp: int, h1: int, h2: int) -> None:
+        """
+        Fold live account `h2` into live account `h1` at `timestamp`
+        without validation, settlement or history updates.
+        """
+        #an archived h2 stays archived: merged-away accounts are never written again
+        if self.histories[h1] is None:
+            self.materialize(h1)
+
+        # now merge by updating individual account variables/data structures
+        self.log_event(timestamp, h1, MERGE, self.balances[h2], h2)
+        self.merged_from.setdefault(h1, []).append(h2)
+        self.balances[h1] += self.balances[h2]
+        self.outgoing[h1] += self.outgoing[h2]
+        self.mark_dirty(h1)
+        self.mark_dirty(h2)
+        if self.heavy_hitters is not None:
+            self.heavy_hitters.merge_keys(h1, h2)
+
+        #record the lineage; account_id_2 keeps its own balance history and
+        #payments, which now resolve to h1 through the alias
+        self.merged_into[h2] = h1
+        self.merged_at[h2] = timestamp
+        self.alias[h2] = h1
+        self.merged_accounts += 1
 
         # remove account_id_2 from accounts
-        self.accounts.pop(account_id_2)
+        account_id_2 = self.names[h2]
+        del self.ids[account_id_2]
+        self.retired[account_id_2] = h2
+        self.live[h2] = 0
+
+    @metered
+    @idempotent
+    @versioned
+    def merge_many(self, timestamp: int, pairs: list[tuple[str, str]], resolve_chains: bool = False) -> list[bool]:
+        """
+        Apply many `merge_accounts(timestamp, account_id_1, account_id_2)`
+        calls in one pass.
+
+        Pairs are validated in order against the merge graph built so
+        far, so the per-pair results match calling `merge_accounts` for
+        each pair in turn. With `resolve_chains`, a pair whose
+        `account_id_1` was merged away earlier in the batch is redirected
+        to the account it ended up in, so `[(A, B), (B, C)]` folds both B
+        and C into A.
+        Parameters
+        ----------
+        timestamp: current datetime (merge timing)
+        pairs: `(account_id_1, account_id_2)` pairs, `account_id_2` is
+        merged into `account_id_1`
+        resolve_chains: follow merges made earlier in this batch
+        Returns
+        -------
+        list[bool]: result of every pair, in order
+        """
+        self.advance_time(timestamp)
+
+        results = []
+        touched = set()
+        absorbed = {}
+        ids = self.ids
+        for account_id_1, account_id_2 in pairs:
+            h1 = ids.get(account_id_1)
+            if h1 is None and resolve_chains and account_id_1 in absorbed:
+                h1 = self.root(absorbed[account_id_1])
+            h2 = ids.get(account_id_2)
+            if h1 is None or h2 is None or h1 == h2:
+                results.append(False)
+                continue
+            self.absorb(timestamp, h1, h2)
+            absorbed[account_id_2] = h2
+            touched.add(h1)
+            results.append(True)
+
+        #one history point per survivor; later merges at the same timestamp overwrite earlier ones anyway
+        for h in touched:
+            self.record_balance(timestamp, h)
+        return results
+
+    @metered
+    @idempotent
+    @versioned
+    def close_account(self, timestamp: int, account_id: str) -> bool:
+        """
+        Close `account_id` at `timestamp`. Returns `True` if the account
+        was closed, or `False` otherwise.
+        Specifically:
+          * Returns `False` if `account_id` doesn't exist.
+          * Returns `False` if the account still holds money or has
+          cashback refunds not yet received (its own or those of
+          accounts merged into it).
+          * The account is removed from the system like a merged-away
+          account: it drops out of `top_spenders`, its id can be
+          created again, and `get_balance` answers for times before
+          `timestamp` from its archived history.
+        """
+        h = self.ids.get(account_id)
+        if h is None:
+            return False
+        if timestamp > self.clock:
+            self.advance_time(timestamp)
+        if self.balances[h]:
+            return False
+        settled = self.pay_log.settled
+        for payer in self.merged_handles(h):
+            numbers = self.payment_numbers(payer)
+            #refunds of a payer are settled in payment order
+            if numbers and not settled[numbers[-1] - 1]:
+                return False
+
+        self.archive_h(h)
+        self.merged_at[h] = timestamp
+        del self.ids[account_id]
+        self.retired[account_id] = h
+        self.live[h] = 0
+        self.mark_dirty(h)
+        if self.heavy_hitters is not None:
+            self.heavy_hitters.discard(h)
+        return True
 
+    @metered
+    def archive_account(self, timestamp: int, account_id: str) -> bool:
+        """
+        Move dormant account `account_id` to the archive tier: its
+        balance history, statement ledger and payment numbers, and those
+        of every account merged into it, are packed into compact records
+        and their resident structures are released. Balances and
+        outgoing totals stay in the engine-wide columns.
+
+        The account keeps working: reads (`get_balance`,
+        `get_payment_status`, `top_spenders`, statements) are answered
+        from the archive, pending refunds settle into it, and the next
+        deposit, transfer, payment or merge into it restores it.
+        Returns `False` if `account_id` doesn't exist.
+        """
+        h = self.ids.get(account_id)
+        if h is None:
+            return False
+        if timestamp > self.clock:
+            self.advance_time(timestamp)
+        self.archive_h(h)
         return True
-    
 
+    @versioned
+    def archive_h(self, h: int) -> None:
+        """
+        `archive_account` for the account with handle `h`.
+        """
+        for archived in self.merged_handles(h):
+            if self.histories[archived] is None:
+                continue
+            self.archive.pack(archived, self.histories[archived], self.ledgers[archived], self.payments[archived])
+            self.histories[archived] = None
+            self.ledgers[archived] = None
+            self.payments[archived] = None
+
+    #helper function to give an account its resident structures before writing to it
+    @versioned
+    def materialize(self, h: int) -> None:
+        if h in self.archive:
+            self.histories[h], self.ledgers[h], self.payments[h] = self.archive.unpack(h)
+            return
+        #account without activity since its creation
+        history = BalanceHistory()
+        history.append(self.created[h], 0)
+        self.histories[h] = history
+        self.payments[h] = array("q")
+
+    def history(self, h: int) -> BalanceHistory:
+        """
+        Balance history of account `h` (without its cold tier), decoded
+        from the archive or built from the creation point if the account
+        isn't resident.
+        """
+        history = self.histories[h]
+        if history is not None:
+            return history
+        if h in self.archive:
+            return self.archive.expand(h)[0]
+        history = BalanceHistory()
+        history.append(self.created[h], 0)
+        return history
+
+    def merged_handles(self, h: int) -> list[int]:
+        """
+        `h` followed by every account merged into it, directly or
+        through a chain of merges.
+        """
+        handles = [h]
+        for merged in handles:
+            handles.extend(self.merged_from.get(merged, ()))
+        return handles
+
+    def payment_numbers(self, h: int) -> array:
+        """
+        Numbers of the payments made by account `h`, resident or archived.
+        """
+        numbers = self.payments[h]
+        if numbers is not None:
+            return numbers
+        return self.archive.payments(h) if h in self.archive else array("q")
+
+    def root(self, h: int) -> int:
+        """
+        Live account that handle `h` has been merged into (directly or
+        through a chain of merges), or `h` itself.
+        """
+        alias = self.alias
+        r = h
+        while alias[r] != r:
+            r = alias[r]
+        #path compression; safe from concurrent reads since merges only add ancestors
+        while alias[h] != r:
+            alias[h], h = r, alias[h]
+        return r
+
+    def lineage(self, h: int) -> list[tuple[int, int]]:
+        """
+        `(handle, merge timestamp)` of every account that `h` was merged
+        into, from the direct parent to the live account.
+        """
+        chain = []
+        while self.merged_into[h] != -1:
+            chain.append((self.merged_into[h], self.merged_at[h]))
+            h = self.merged_into[h]
+        return chain
+
+    def iter_statement(self, account_id: str, t1: int, t2: int) -> Iterator[StatementEvent] | None:
+        """
+        Lazily stream the activity of `account_id` between `t1` and `t2`
+        (inclusive) as `StatementEvent`s in time order: deposits,
+        transfers in and out, payments, settled cashback and merges,
+        including the activity of every account merged into it.
+        Returns `None` if the account never existed.
+
+        Only events already applied are listed; refunds due by `t2` appear
+        once the clock has passed their CB_timestamp. Each ledger is
+        entered by binary search and the streams are merged with one
+        pending event per ledger, so memory doesn't grow with the length
+        of the statement.
+        """
+        h = self.ids.get(account_id)
+        if h is None:
+            h = self.retired.get(account_id)
+            if h is None:
+                return None
+        return self.statement_h(h, t1, t2)
+
+    def statement_h(self, h: int, t1: int, t2: int) -> Iterator[StatementEvent]:
+        """
+        `iter_statement` for the account with handle `h`.
+        """
+        handles = self.merged_handles(h)
+        #events at the same timestamp: own account first, then merged accounts by handle
+        handles[1:] = sorted(handles[1:])
+        streams = [self.ledger_events(merged, t1, t2) for merged in handles
+                   if self.ledgers[merged] is not None or merged in self.archive]
+        return heapq.merge(*streams, key=itemgetter(0))
+
+    def ledger_events(self, h: int, t1: int, t2: int) -> Iterator[StatementEvent]:
+        names = self.names
+        account_id = names[h]
+        ledger = self.ledgers[h]
+        if ledger is not None:
+            rows = ledger.scan(t1, t2)
+        else:
+            #decoded row by row from the archived record
+            rows = self.archive.events(h, t1, t2)
+        for timestamp, kind, amount, counterpart in rows:
+            if kind == PAYMENT or kind == CASHBACK:
+                counterparty = "payment" + str(counterpart)
+            elif counterpart >= 0:
+                counterparty = names[counterpart]
+            else:
+                counterparty = None
+            yield StatementEvent(timestamp, KINDS[kind], account_id, amount, counterparty)
+
+
+    @metered
     def get_balance(self, timestamp: int, account_id: str, time_at: int) -> int :
         """
         Should return the total amount of money in the account
@@ -340,44 +1124,59 @@ class BankingSystemImpl(BankingSystem):
         account_id: unique account identifier
         time_at: query timestamp to look up account balance
         """
-        
-        if account_id not in self.accounts:
-            #search for the deleted account in existing accounts merge histories
-            for existing_account in self.accounts:
-                if account_id in self.accounts[existing_account].get("merged_account_history", set()):
-                    #get balance history
-                    merged_histories = self.accounts[existing_account].get("merged_balance_histories", {})
-                    deleted_balance, merge_timestamp = merged_histories[account_id]
-                        
-                    #check when we are querying: before or after merger
-                    if time_at >= merge_timestamp:
-                        return None
-                        
-                    time_account_created = min(deleted_balance.keys())
-                    if time_account_created > time_at:
-                        return None
-                        
-                    #balance at time_at or earlier
-                    time_at_or_before = [x for x in deleted_balance if x <= time_at]
-                    if len(time_at_or_before) == 0:
-                        return 0
-                    return deleted_balance[max(time_at_or_before)] 
-            
+        h = self.ids.get(account_id)
+        if h is not None:
+            return self.get_balance_h(timestamp, h, time_at)
+
+        #merged-away accounts keep their own history under their old handle
+        h = self.retired.get(account_id)
+        if h is None:
             #account never existed if not found
             return None
-            
+        return self.get_balance_h(timestamp, h, time_at)
+
+    def get_balance_h(self, timestamp: int, h: int, time_at: int) -> int | None:
+        """
+        `get_balance` for the account with handle `h`, live or merged away.
+        Refunds due by `timestamp` that are not settled yet are added
+        without settling them, so the read changes no state.
+        """
+        if not self.live[h]:
+            #check when we are querying: before or after merger
+            if self.merged_at[h] is None or time_at >= self.merged_at[h]:
+                return None
+            #balance at time_at or earlier, None if before the account was created
+            return self.balance_at(h, self.histories[h], time_at)
+
         #check if querying before account was created
-        if self.accounts[account_id]["account_created"] > time_at:
-            return None 
-        
-        # apply cashback if needed
-        self.cashback(time_at, account_id)
-        
-        # get timestamp keys corresponding to balances logged at or before time_at
-        time_at_or_earlier_timestamps = [key for key in self.accounts[account_id]["balance"] if key <= time_at]
-        if len(time_at_or_earlier_timestamps) == 0:
-            return 0  # no account activity since creation
-        else:
-            return self.accounts[account_id]["balance"][max(time_at_or_earlier_timestamps)]
+        if self.created[h] > time_at:
+            return None
+
+        # get balance logged at or before time_at, from memory or the cold tier
+        balance = self.balance_at(h, self.histories[h], time_at)
+        if balance is None:
+            balance = 0  # no account activity since creation
 
+        # cashback due by then but not yet settled
+        due = min(timestamp, time_at)
+        if due > self.clock:
+            balance += self.pending_refunds(h, due)
+        return balance
 
+    def pending_refunds(self, h: int, due: int) -> int:
+        """
+        Total cashback of unsettled refunds due at or before `due` for
+        payments by live account `h` or accounts merged into it.
+        """
+        clock = self.clock
+        due_at, amounts = self.pay_log.due, self.pay_log.amounts
+        total = 0
+        for payer in self.merged_handles(h):
+            #refunds of a payer fall due in payment order: walk back to the settled ones
+            for number in reversed(self.payment_numbers(payer)):
+                CB_timestamp = due_at[number - 1]
+                if CB_timestamp <= clock:
+                    break
+                if CB_timestamp <= due:
+                    total += amounts[number - 1]
+        return total
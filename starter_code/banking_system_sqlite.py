@@ -0,0 +1,269 @@
+import sqlite3
+from contextlib import contextmanager
+
+from banking_system import BankingSystem
+from cashback_policy import CashbackPolicy, FlatCashbackPolicy
+from payment_registry import payment_number
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    handle INTEGER PRIMARY KEY,
+    account_id TEXT NOT NULL,
+    created INTEGER NOT NULL,
+    balance INTEGER NOT NULL DEFAULT 0,
+    outgoing INTEGER NOT NULL DEFAULT 0,
+    live INTEGER NOT NULL DEFAULT 1,
+    merged_into INTEGER NOT NULL DEFAULT -1,
+    merged_at INTEGER
+);
+CREATE UNIQUE INDEX IF NOT EXISTS live_accounts ON accounts(account_id) WHERE live = 1;
+CREATE INDEX IF NOT EXISTS accounts_by_id ON accounts(account_id, handle);
+CREATE INDEX IF NOT EXISTS top_spenders ON accounts(outgoing DESC, account_id) WHERE live = 1;
+
+CREATE TABLE IF NOT EXISTS history (
+    handle INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    balance INTEGER NOT NULL,
+    PRIMARY KEY (handle, ts)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS payments (
+    payment INTEGER PRIMARY KEY,
+    handle INTEGER NOT NULL,
+    cb_ts INTEGER NOT NULL,
+    cb_amount INTEGER NOT NULL,
+    settled INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS pending_refunds ON payments(cb_ts, payment) WHERE settled = 0;
+"""
+
+#statements are kept as constants so sqlite3's statement cache reuses the prepared form
+LIVE_ACCOUNT = "SELECT handle, balance FROM accounts WHERE account_id = ? AND live = 1"
+RETIRED_ACCOUNT = ("SELECT handle, merged_at FROM accounts WHERE account_id = ? AND live = 0 "
+                   "ORDER BY handle DESC LIMIT 1")
+ACCOUNT_CREATED = "SELECT created FROM accounts WHERE handle = ?"
+INSERT_ACCOUNT = "INSERT INTO accounts (account_id, created) VALUES (?, ?)"
+ADD_BALANCE = "UPDATE accounts SET balance = balance + ? WHERE handle = ? RETURNING balance"
+ADD_OUTGOING = "UPDATE accounts SET outgoing = outgoing + ? WHERE handle = ?"
+MERGE_INTO = ("UPDATE accounts SET balance = balance + ?2, outgoing = outgoing + ?3 "
+              "WHERE handle = ?1 RETURNING balance")
+RETIRE = "UPDATE accounts SET live = 0, merged_into = ?, merged_at = ? WHERE handle = ?"
+ACCOUNT_TOTALS = "SELECT balance, outgoing FROM accounts WHERE handle = ?"
+PARENT = "SELECT merged_into FROM accounts WHERE handle = ?"
+RECORD_BALANCE = ("INSERT INTO history (handle, ts, balance) VALUES (?, ?, ?) "
+                  "ON CONFLICT (handle, ts) DO UPDATE SET balance = excluded.balance")
+BALANCE_AT = "SELECT balance FROM history WHERE handle = ? AND ts <= ? ORDER BY ts DESC LIMIT 1"
+TOP_SPENDERS = "SELECT account_id, outgoing FROM accounts WHERE live = 1 ORDER BY outgoing DESC, account_id LIMIT ?"
+INSERT_PAYMENT = "INSERT INTO payments (payment, handle, cb_ts, cb_amount) VALUES (?, ?, ?, ?)"
+PAYMENT = "SELECT handle, cb_ts FROM payments WHERE payment = ?"
+DUE_REFUNDS = ("SELECT payment, handle, cb_ts, cb_amount FROM payments "
+               "WHERE settled = 0 AND cb_ts <= ? ORDER BY cb_ts, payment")
+SETTLE = "UPDATE payments SET settled = 1 WHERE settled = 0 AND cb_ts <= ?"
+NEXT_DUE = "SELECT MIN(cb_ts) FROM payments WHERE settled = 0"
+PAYMENT_COUNT = "SELECT COALESCE(MAX(payment), 0) FROM payments"
+
+
+class SQLiteBankingSystem(BankingSystem):
+    """
+    `BankingSystem` stored in SQLite.
+
+    Balance history is a `WITHOUT ROWID` table keyed by (account,
+    timestamp), so `get_balance` is a single covering index probe; live
+    accounts are indexed by outgoing total for `top_spenders` and pending
+    refunds by due time. Mutations are grouped into transactions of
+    `commit_every` operations, or explicitly with `batch()`. Merged-away
+    accounts keep their rows and point to the account they were merged
+    into, like `BankingSystemImpl`.
+    """
+
+    def __init__(self, path: str = ":memory:", commit_every: int = 1,
+                 cashback_policy: CashbackPolicy | None = None):
+        """
+        Parameters
+        ----------
+        path: database file (WAL mode), or `":memory:"`
+        commit_every: number of mutating operations per transaction
+        cashback_policy: decides cashback amount and delay of payments;
+        defaults to the flat 2% refund after 24 hours
+        """
+        self.conn = sqlite3.connect(path, cached_statements=256)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.batch_depth = 0
+        self.cashback_policy = cashback_policy if cashback_policy is not None else FlatCashbackPolicy()
+
+        self.clock = float("-inf")
+        self.payment_count = self.conn.execute(PAYMENT_COUNT).fetchone()[0]
+        self.next_due = self.conn.execute(NEXT_DUE).fetchone()[0]
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+
+    @contextmanager
+    def batch(self):
+        """
+        Run the operations inside the `with` block in one transaction.
+        """
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if self.batch_depth == 0:
+                self.conn.commit()
+                self.uncommitted = 0
+
+    def _written(self) -> None:
+        #count a mutation and commit when the group is full
+        self.uncommitted += 1
+        if self.batch_depth == 0 and self.uncommitted >= self.commit_every:
+            self.conn.commit()
+            self.uncommitted = 0
+
+    def _live(self, account_id: str) -> tuple[int, int] | None:
+        return self.conn.execute(LIVE_ACCOUNT, (account_id,)).fetchone()
+
+    def _root(self, h: int) -> int:
+        #follow merge pointers up to the live account
+        while True:
+            parent = self.conn.execute(PARENT, (h,)).fetchone()[0]
+            if parent == -1:
+                return h
+            h = parent
+
+    def _add(self, timestamp: int, h: int, amount: int) -> int:
+        balance = self.conn.execute(ADD_BALANCE, (amount, h)).fetchone()[0]
+        self.conn.execute(RECORD_BALANCE, (h, timestamp, balance))
+        return balance
+
+    def advance_time(self, timestamp: int) -> int:
+        """
+        Settle every cashback refund due at or before `timestamp`, each
+        recorded in the balance history at its due time. Returns the
+        number of refunds settled.
+        """
+        if timestamp <= self.clock:
+            return 0
+        self.clock = timestamp
+        if self.next_due is None or self.next_due > timestamp:
+            return 0
+
+        due_refunds = self.conn.execute(DUE_REFUNDS, (timestamp,)).fetchall()
+        for _, h, cb_ts, cb_amount in due_refunds:
+            self._add(cb_ts, self._root(h), cb_amount)
+        self.conn.execute(SETTLE, (timestamp,))
+        self.next_due = self.conn.execute(NEXT_DUE).fetchone()[0]
+        self._written()
+        return len(due_refunds)
+
+    def create_account(self, timestamp: int, account_id: str) -> bool:
+        if self._live(account_id) is not None:
+            return False
+        h = self.conn.execute(INSERT_ACCOUNT, (account_id, timestamp)).lastrowid
+        self.conn.execute(RECORD_BALANCE, (h, timestamp, 0))
+        self._written()
+        return True
+
+    def deposit(self, timestamp: int, account_id: str, amount: int) -> int | None:
+        account = self._live(account_id)
+        if account is None:
+            return None
+        self.advance_time(timestamp)
+        balance = self._add(timestamp, account[0], amount)
+        self._written()
+        return balance
+
+    def transfer(self, timestamp: int, source_account_id: str, target_account_id: str, amount: int) -> int | None:
+        source = self._live(source_account_id)
+        target = self._live(target_account_id)
+        if source is None or target is None or source[0] == target[0]:
+            return None
+        self.advance_time(timestamp)
+        #re-read: settlement may have refunded the source
+        source = self._live(source_account_id)
+        if source[1] < amount:
+            return None
+        balance = self._add(timestamp, source[0], -amount)
+        self._add(timestamp, target[0], amount)
+        self.conn.execute(ADD_OUTGOING, (amount, source[0]))
+        self._written()
+        return balance
+
+    def top_spenders(self, timestamp: int, n: int) -> list[str]:
+        #LIMIT with a negative count means no limit in SQLite
+        if n <= 0:
+            return []
+        rows = self.conn.execute(TOP_SPENDERS, (n,)).fetchall()
+        return ["%s(%d)" % (account_id, outgoing) for account_id, outgoing in rows]
+
+    def pay(self, timestamp: int, account_id: str, amount: int, merchant_category: int = 0) -> str | None:
+        account = self._live(account_id)
+        if account is None:
+            return None
+        self.advance_time(timestamp)
+        account = self._live(account_id)
+        if account[1] < amount:
+            return None
+        h = account[0]
+        self._add(timestamp, h, -amount)
+        self.conn.execute(ADD_OUTGOING, (amount, h))
+
+        self.payment_count += 1
+        policy = self.cashback_policy
+        cb_ts = timestamp + policy.delay
+        self.conn.execute(INSERT_PAYMENT, (self.payment_count, h, cb_ts,
+                                           policy.evaluate(h, amount, timestamp, merchant_category)))
+        if self.next_due is None or cb_ts < self.next_due:
+            self.next_due = cb_ts
+        self._written()
+        return "payment" + str(self.payment_count)
+
+    def get_payment_status(self, timestamp: int, account_id: str, payment: str) -> str | None:
+        account = self._live(account_id)
+        number = payment_number(payment)
+        if account is None or number is None:
+            return None
+        row = self.conn.execute(PAYMENT, (number,)).fetchone()
+        if row is None or self._root(row[0]) != account[0]:
+            return None
+        return "IN_PROGRESS" if timestamp < row[1] else "CASHBACK_RECEIVED"
+
+    def merge_accounts(self, timestamp: int, account_id_1: str, account_id_2: str) -> bool:
+        if account_id_1 == account_id_2:
+            return False
+        first = self._live(account_id_1)
+        second = self._live(account_id_2)
+        if first is None or second is None:
+            return False
+        self.advance_time(timestamp)
+
+        h1, h2 = first[0], second[0]
+        balance, outgoing = self.conn.execute(ACCOUNT_TOTALS, (h2,)).fetchone()
+        balance = self.conn.execute(MERGE_INTO, (h1, balance, outgoing)).fetchone()[0]
+        self.conn.execute(RECORD_BALANCE, (h1, timestamp, balance))
+        self.conn.execute(RETIRE, (h1, timestamp, h2))
+        self._written()
+        return True
+
+    def get_balance(self, timestamp: int, account_id: str, time_at: int) -> int | None:
+        account = self._live(account_id)
+        if account is not None:
+            h = account[0]
+            if self.conn.execute(ACCOUNT_CREATED, (h,)).fetchone()[0] > time_at:
+                return None
+            self.advance_time(timestamp)
+        else:
+            retired = self.conn.execute(RETIRED_ACCOUNT, (account_id,)).fetchone()
+            if retired is None or time_at >= retired[1]:
+                return None
+            h = retired[0]
+
+        row = self.conn.execute(BALANCE_AT, (h, time_at)).fetchone()
+        if row is None:
+            return None if account is None else 0
+        return row[0]
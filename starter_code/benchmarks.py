@@ -0,0 +1,755 @@
+"""
+Micro-benchmarks for the banking engine.
+
+Run from this folder, e.g. `python3 benchmarks.py handles --ops 200000`.
+Each benchmark prints one line per measurement.
+"""
+import argparse
+import functools
+import gc
+import io
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+from banking_system_impl import BankingSystemImpl
+from banking_system_sqlite import SQLiteBankingSystem
+from cashback_policy import TieredCashbackPolicy
+from columnar import export_state, load_state
+from heavy_hitters import SpaceSaving
+from ingest import ReorderBuffer
+from metrics import exposition
+from mvcc import ReadPool
+from replay import ParallelReplay
+from replication import Primary, Replica
+from settlement import HeapScheduler, TimingWheel
+
+
+def timed(fn, setup=None, repeat: int = 3) -> float:
+    """
+    Best wall-clock seconds of `repeat` runs of `fn(setup())` (or `fn()`
+    without a setup function); setup time is not measured. The garbage
+    collector is paused while timing, as in `timeit`.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        args = () if setup is None else (setup(),)
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            fn(*args)
+            best = min(best, time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return best
+
+
+def make_trace(n_ops: int, n_accounts: int = 1000, seed: int = 0, community: int | None = None) -> list[tuple]:
+    """
+    Mixed workload of `(method name, args)` calls with increasing
+    timestamps: account creation first, then deposits, transfers,
+    payments, balance queries, top_spenders and occasional merges.
+    With `community`, transfers and merges stay within groups of
+    `community` consecutive accounts.
+    """
+    rng = random.Random(seed)
+    names = ["account%d" % i for i in range(n_accounts)]
+    trace = [("create_account", (t, name)) for t, name in enumerate(names)]
+    t = len(trace)
+
+    def counterpart(a):
+        if community is None:
+            return rng.choice(names)
+        first = a - a % community
+        return names[rng.randrange(first, min(first + community, n_accounts))]
+
+    for _ in range(n_ops):
+        t += rng.randint(1, 2000)
+        roll = rng.random()
+        i = rng.randrange(n_accounts)
+        a = names[i]
+        if roll < 0.35:
+            trace.append(("deposit", (t, a, rng.randint(1, 5000))))
+        elif roll < 0.6:
+            trace.append(("transfer", (t, a, counterpart(i), rng.randint(1, 2000))))
+        elif roll < 0.8:
+            trace.append(("pay", (t, a, rng.randint(1, 2000))))
+        elif roll < 0.95:
+            trace.append(("get_balance", (t, a, t - rng.randint(0, t))))
+        elif roll < 0.999:
+            trace.append(("top_spenders", (t, 10)))
+        else:
+            trace.append(("merge_accounts", (t, a, counterpart(i))))
+    return trace
+
+
+def replay(system, trace: list[tuple]) -> list:
+    """
+    Run `trace` against `system`; returns every call's result.
+    """
+    return [getattr(system, method)(*args) for method, args in trace]
+
+
+def bench_handles(n_accounts: int = 1000, n_ops: int = 200000, seed: int = 0) -> dict:
+    """
+    Per-call cost of the string-id API against the `*_h` handle API for
+    deposit and transfer on identical workloads.
+    """
+    rng = random.Random(seed)
+    names = ["account%d" % i for i in range(n_accounts)]
+    picks = [(rng.randrange(n_accounts), rng.randrange(n_accounts)) for _ in range(n_ops)]
+
+    def setup():
+        system = BankingSystemImpl()
+        for i, name in enumerate(names):
+            system.create_account(i, name)
+            system.deposit(i, name, 10 ** 9)
+        return system
+
+    def run_strings(system):
+        t = n_accounts
+        for a, b in picks:
+            t += 1
+            system.deposit(t, names[a], 5)
+            system.transfer(t, names[a], names[b], 3)
+
+    def run_handles(system):
+        handles = [system.handle(name) for name in names]
+        t = n_accounts
+        for a, b in picks:
+            t += 1
+            system.deposit_h(t, handles[a], 5)
+            system.transfer_h(t, handles[a], handles[b], 3)
+
+    calls = 2 * n_ops
+    strings = timed(run_strings, setup) / calls
+    handles = timed(run_handles, setup) / calls
+    return {
+        "string_ns_per_call": strings * 1e9,
+        "handle_ns_per_call": handles * 1e9,
+        "saved_ns_per_call": (strings - handles) * 1e9,
+    }
+
+
+def bench_cashback_policy(n_accounts: int = 100000, n_ops: int = 1000000, seed: int = 0) -> dict:
+    """
+    Cost per payment of evaluating a tiered policy with category bonuses,
+    promotions and a cap, one payment at a time and in a batch.
+    """
+    rng = np.random.default_rng(seed)
+    policy = TieredCashbackPolicy(
+        tier_rates_bp=[100, 200, 300, 500],
+        account_tiers={h: int(tier) for h, tier in enumerate(rng.integers(0, 4, n_accounts))},
+        category_bonus_bp={category: int(bonus) for category, bonus in enumerate(rng.integers(0, 150, 64))},
+        promotions=[(start, start + 3600000, 100) for start in range(0, 86400000, 8640000)],
+        cap=5000,
+    )
+    handles = rng.integers(0, n_accounts, n_ops)
+    amounts = rng.integers(1, 100000, n_ops)
+    timestamps = np.sort(rng.integers(0, 86400000, n_ops))
+    categories = rng.integers(0, 64, n_ops)
+
+    def run_scalar():
+        evaluate = policy.evaluate
+        for h, amount, timestamp, category in zip(handles.tolist(), amounts.tolist(),
+                                                  timestamps.tolist(), categories.tolist()):
+            evaluate(h, amount, timestamp, category)
+
+    def run_batch():
+        policy.evaluate_batch(handles, amounts, timestamps, categories)
+
+    return {
+        "scalar_ns_per_payment": timed(run_scalar) / n_ops * 1e9,
+        "batch_ns_per_payment": timed(run_batch) / n_ops * 1e9,
+    }
+
+
+def bench_scheduler(n_ops=(1000000, 10000000, 50000000), steps: int = 1000, seed: int = 0) -> dict:
+    """
+    Heap against timing wheel with `n_ops` pending refunds (one size or a
+    sequence of sizes): cost per scheduled refund while filling the
+    queue, then per expired refund while advancing through the 24h
+    cashback window in `steps` settlement passes.
+    """
+    sizes = [n_ops] if isinstance(n_ops, int) else list(n_ops)
+    start = 1700000000000
+    results = {}
+    for n in sizes:
+        rng = random.Random(seed)
+        dues = [start + 86400000 + rng.randrange(86400000) for _ in range(n)]
+        for name, factory in (("heap", HeapScheduler), ("wheel", TimingWheel)):
+            scheduler = factory()
+            scheduler.pop_due(start)
+            gc.disable()
+
+            begin = time.perf_counter()
+            for i, due in enumerate(dues):
+                scheduler.schedule(due, i)
+            results["%s_%d_schedule_ns" % (name, n)] = (time.perf_counter() - begin) / n * 1e9
+
+            begin = time.perf_counter()
+            expired = 0
+            for step in range(1, steps + 1):
+                expired += len(scheduler.pop_due(start + 86400000 + step * 86400000 // steps))
+            results["%s_%d_expire_ns" % (name, n)] = (time.perf_counter() - begin) / expired * 1e9
+
+            gc.enable()
+            del scheduler
+    return results
+
+
+def bench_sqlite(n_ops=(10000, 100000), n_accounts: int = 1000) -> dict:
+    """
+    Operations per second of `BankingSystemImpl` against the SQLite
+    engine (WAL file, 1000 operations per transaction) on the same mixed
+    trace, for one size or a sequence of sizes.
+    """
+    sizes = [n_ops] if isinstance(n_ops, int) else list(n_ops)
+    results = {}
+    for n in sizes:
+        trace = make_trace(n, n_accounts)
+        results["memory_%d_ops_per_s" % n] = len(trace) / timed(lambda: replay(BankingSystemImpl(), trace), repeat=1)
+        with tempfile.TemporaryDirectory() as tmp:
+            system = SQLiteBankingSystem(os.path.join(tmp, "bank.db"), commit_every=1000)
+            results["sqlite_%d_ops_per_s" % n] = len(trace) / timed(lambda: replay(system, trace), repeat=1)
+            system.close()
+    return results
+
+
+def bench_top_spenders(n_accounts: int = 100000, n_ops: int = 1000, top: int = 10, seed: int = 0) -> dict:
+    """
+    Cost of a `top_spenders` poll on an unchanged system, after one
+    payment between polls, and of a from-scratch ranking.
+    """
+    rng = random.Random(seed)
+    system = BankingSystemImpl()
+    for h in range(n_accounts):
+        system.create_account(h, "account%d" % h)
+        system.deposit(h, "account%d" % h, 10 ** 9)
+        system.pay(h, "account%d" % h, rng.randint(1, 10 ** 6))
+    t = n_accounts
+    system.top_spenders(t, top)
+
+    def unchanged():
+        for i in range(n_ops):
+            system.top_spenders(t + i, top)
+
+    def one_payment():
+        for i in range(n_ops):
+            system.pay(t + n_ops + i, "account%d" % rng.randrange(n_accounts), 1)
+            system.top_spenders(t + n_ops + i, top)
+
+    def scratch():
+        for _ in range(10):
+            system.rank_spenders(top)
+
+    return {
+        "unchanged_us_per_poll": timed(unchanged, repeat=1) / n_ops * 1e6,
+        "one_payment_us_per_poll": timed(one_payment, repeat=1) / n_ops * 1e6,
+        "scratch_us_per_poll": timed(scratch, repeat=1) / 10 * 1e6,
+    }
+
+
+def bench_heavy_hitters(n_accounts: int = 1000000, n_ops: int = 1000000, top: int = 100,
+                        epsilons=(1e-2, 1e-3, 1e-4), skew: float = 1.2, seed: int = 0) -> dict:
+    """
+    Recall and precision of the approximate top-`top` spenders from the
+    Space-Saving sketch against the exact ranking, on a Zipf-skewed
+    stream of outgoing amounts, for several error bounds.
+    """
+    rng = np.random.default_rng(seed)
+    payers = (rng.zipf(skew, n_ops) - 1) % n_accounts
+    amounts = rng.integers(1, 1000, n_ops)
+    totals = np.bincount(payers, weights=amounts, minlength=n_accounts)
+    #exact top set, including every account tied with the last place
+    cutoff = np.sort(totals)[-top]
+    exact = set(np.flatnonzero(totals >= cutoff).tolist())
+    stream = list(zip(payers.tolist(), amounts.tolist()))
+
+    results = {}
+    for epsilon in epsilons:
+        sketch = SpaceSaving.with_error(epsilon)
+
+        def feed():
+            for h, amount in stream:
+                sketch.update(h, amount)
+
+        elapsed = timed(feed, repeat=1)
+        found = {h for h, _ in sketch.top(top)}
+        hits = len(found & exact)
+        results["eps_%g_counters" % epsilon] = sketch.capacity
+        results["eps_%g_recall_pct" % epsilon] = 100 * hits / min(top, len(exact))
+        results["eps_%g_precision_pct" % epsilon] = 100 * hits / max(len(found), 1)
+        results["eps_%g_updates_per_s" % epsilon] = n_ops / elapsed
+    return results
+
+
+def bench_ingest(n_ops: int = 200000, jitter: int = 20000, seed: int = 0) -> dict:
+    """
+    Throughput of replaying a trace through a `ReorderBuffer` when every
+    event arrives up to `jitter` ms late, against an in-order replay, and
+    the share of late events for watermarks below and at the jitter.
+    """
+    rng = random.Random(seed)
+    trace = make_trace(n_ops, seed=seed)
+    #arrival order: timestamp plus a random network delay
+    arrivals = sorted(trace, key=lambda event: event[1][0] + rng.randint(0, jitter))
+
+    def buffered(max_delay):
+        buffer = ReorderBuffer(BankingSystemImpl(), max_delay)
+        for method, args in arrivals:
+            buffer.push(method, args)
+        buffer.flush()
+        return buffer
+
+    results = {"in_order_ops_per_s": len(trace) / timed(lambda: replay(BankingSystemImpl(), trace), repeat=1)}
+    for max_delay in (jitter // 4, jitter):
+        results["delay_%d_ops_per_s" % max_delay] = len(trace) / timed(lambda: buffered(max_delay), repeat=1)
+        results["delay_%d_late_pct" % max_delay] = 100 * buffered(max_delay).dropped / len(trace)
+    return results
+
+
+def bench_columnar(n_ops: int = 200000, n_accounts: int = 10000, chunk_rows: int = 65536) -> dict:
+    """
+    Export and import rates of the columnar state files, in rows per
+    second over all tables.
+    """
+    system = BankingSystemImpl()
+    replay(system, make_trace(n_ops, n_accounts))
+    with tempfile.TemporaryDirectory() as tmp:
+        rows = {}
+        export_seconds = timed(lambda: rows.update(export_state(system, tmp, chunk_rows)), repeat=1)
+        import_seconds = timed(lambda: load_state(tmp), repeat=1)
+        size = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp))
+    total = sum(rows.values())
+    return {
+        "rows": total,
+        "export_rows_per_s": total / export_seconds,
+        "import_rows_per_s": total / import_seconds,
+        "bytes_per_row": size / total,
+    }
+
+
+def replica_reads(stream: bytes, n_reads: int, seed: int) -> float:
+    #worker process: rebuild a replica from the change stream, then time balance reads
+    replica = Replica(io.BytesIO(stream))
+    while replica.apply_next():
+        pass
+    system = replica.system
+    rng = random.Random(seed)
+    names = list(system.ids)
+    queries = [(rng.choice(names), rng.randint(0, system.clock)) for _ in range(n_reads)]
+    start = time.perf_counter()
+    for name, time_at in queries:
+        replica.get_balance(system.clock, name, time_at)
+    return time.perf_counter() - start
+
+
+def bench_replication(n_ops: int = 100000, n_reads: int = 200000, readers=(1, 2, 4)) -> dict:
+    """
+    Change stream size and publish/apply rates, replication lag (ms and
+    records) of a replica fed through a pipe, and aggregate `get_balance`
+    throughput of 1, 2, 4... replica processes.
+    """
+    trace = make_trace(n_ops)
+    sink = io.BytesIO()
+    primary = Primary(sinks=[sink])
+    publish_seconds = timed(lambda: [primary.apply(method, args) for method, args in trace], repeat=1)
+    stream = sink.getvalue()
+
+    def apply_all():
+        replica = Replica(io.BytesIO(stream))
+        while replica.apply_next():
+            pass
+
+    results = {
+        "bytes_per_record": len(stream) / primary.seq,
+        "publish_ops_per_s": len(trace) / publish_seconds,
+        "apply_records_per_s": primary.seq / timed(apply_all, repeat=1),
+    }
+
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(read_fd, "rb") as source, os.fdopen(write_fd, "wb") as pipe:
+        primary = Primary(sinks=[pipe])
+        replica = Replica(source)
+        replica.start()
+        for method, args in trace:
+            primary.apply(method, args)
+        pipe.close()
+        replica.stop()
+    results["max_lag_ms"] = replica.max_apply_lag_ms
+    results["max_lag_records"] = replica.max_apply_lag_events
+
+    context = multiprocessing.get_context("fork")
+    for k in readers:
+        with context.Pool(k) as pool:
+            seconds = pool.starmap(replica_reads, [(stream, n_reads, seed) for seed in range(k)])
+        results["replicas_%d_reads_per_s" % k] = k * n_reads / max(seconds)
+    return results
+
+
+def bench_parallel_reads(n_ops: int = 100000, n_reads: int = 200000, workers=(1, 2, 4), seed: int = 0) -> dict:
+    """
+    `get_balance` throughput of a single caller, of `ReadPool` process
+    workers pinned to one version, and of thread workers doing
+    consistent reads while a writer thread keeps applying a trace.
+    """
+    system = BankingSystemImpl()
+    trace = make_trace(n_ops, seed=seed)
+    replay(system, trace)
+    rng = random.Random(seed)
+    names = list(system.ids)
+    end = system.clock
+    calls = [(end, rng.choice(names), rng.randint(0, end)) for _ in range(n_reads)]
+
+    results = {"direct_reads_per_s": n_reads / timed(lambda: [system.get_balance(*args) for args in calls], repeat=1)}
+    for k in workers:
+        pool = ReadPool(system, workers=k)
+        results["processes_%d_reads_per_s" % k] = n_reads / timed(lambda: pool.map("get_balance", calls), repeat=1)
+        pool.close()
+
+    #writer keeps going past the end of the trace while threads read
+    more = [(method, (args[0] + end,) + args[1:]) for method, args in make_trace(n_ops, seed=seed + 1)
+            if method != "create_account"]
+    for k in workers:
+        pool = ReadPool(system, workers=k, processes=False)
+        writer = threading.Thread(target=replay, args=(system, more[:n_ops // 10]))
+        writer.start()
+        results["threads_%d_reads_per_s" % k] = n_reads / timed(lambda: pool.map("get_balance", calls), repeat=1)
+        writer.join()
+        pool.close()
+        more = more[n_ops // 10:]
+    return results
+
+
+def bench_allocations(n_ops: int = 100000, n_accounts: int = 1000, seed: int = 0) -> dict:
+    """
+    Memory allocated per operation type under tracemalloc while replaying
+    a trace: bytes retained after the call and transient peak bytes
+    during it, averaged per call. Ends with the engine's sampled
+    `memory_report` totals for comparison.
+    """
+    system = BankingSystemImpl()
+    trace = make_trace(n_ops, n_accounts, seed)
+    retained = {}
+    peak = {}
+    calls = {}
+    tracemalloc.start()
+    try:
+        for method, args in trace:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            getattr(system, method)(*args)
+            current, top = tracemalloc.get_traced_memory()
+            retained[method] = retained.get(method, 0) + current - before
+            peak[method] = peak.get(method, 0) + top - before
+            calls[method] = calls.get(method, 0) + 1
+        traced = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    results = {}
+    for method in sorted(calls):
+        results[method + "_retained_bytes_per_op"] = retained[method] / calls[method]
+        results[method + "_peak_bytes_per_op"] = peak[method] / calls[method]
+    results["traced_bytes"] = traced
+    report = system.memory_report()
+    for structure, size in report["structures"].items():
+        results["report_%s_bytes" % structure] = size
+    results["report_total_bytes"] = report["total"]
+    return results
+
+
+def count_allocations(calls) -> tuple[float, float, float]:
+    """
+    Net pymalloc blocks and traced bytes still allocated after running
+    `calls` (a list of zero-argument callables), and seconds, per call.
+    Blocks and time come from the first half of the calls, bytes from
+    the second half run under tracemalloc.
+    """
+    gc.disable()
+    try:
+        half = len(calls) // 2
+        blocks = sys.getallocatedblocks()
+        start = time.perf_counter()
+        for call in calls[:half]:
+            call()
+        elapsed = time.perf_counter() - start
+        blocks = sys.getallocatedblocks() - blocks
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            for call in calls[half:]:
+                call()
+            traced = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+    finally:
+        gc.enable()
+    return blocks / half, traced / (len(calls) - half), elapsed / half
+
+
+def bench_hot_paths(n_ops: int = 200000, n_accounts: int = 1000, seed: int = 0) -> dict:
+    """
+    Steady-state allocations of `deposit`, `transfer` and `pay`: net
+    allocated blocks (objects) and bytes per call after a warm-up of the
+    same workload, and calls per second. Bytes are the history and
+    statement ledger data the calls record. Payments run long enough for
+    refunds to settle at the rate they are created.
+    """
+    rng = random.Random(seed)
+    names = ["account%d" % i for i in range(n_accounts)]
+
+    def workload(system, method, start, step):
+        calls = []
+        for i in range(n_ops):
+            t = start + i * step
+            a = rng.choice(names)
+            if method == "deposit":
+                args = (t, a, rng.randint(1, 1000))
+            elif method == "transfer":
+                args = (t, a, rng.choice(names), rng.randint(1, 1000))
+            else:
+                args = (t, a, rng.randint(1, 1000))
+            calls.append(functools.partial(getattr(system, method), *args))
+        return calls
+
+    results = {}
+    for method in ("deposit", "transfer", "pay"):
+        system = BankingSystemImpl()
+        for t, name in enumerate(names):
+            system.create_account(t, name)
+            system.deposit(t, name, 10 ** 12)
+        #a refund cycle during warm-up and during the measurement
+        step = 2 * system.cashback_policy.delay // n_ops if method == "pay" else 1000
+        for call in workload(system, method, n_accounts, step):
+            call()
+        calls = workload(system, method, n_accounts + n_ops * step, step)
+        blocks, traced, seconds = count_allocations(calls)
+        results[method + "_blocks_per_op"] = blocks
+        results[method + "_bytes_per_op"] = traced
+        results[method + "_ops_per_s"] = 1 / seconds
+    return results
+
+
+def bench_payment_statuses(n_ops: int = 200000, n_accounts: int = 100, merges: int = 50, seed: int = 0) -> dict:
+    """
+    Status checks of every payment of accounts that absorbed `merges`
+    other accounts: per-id `get_payment_status` calls against one
+    `get_payment_statuses` call per account, and the latency of the
+    merges themselves (which no longer touch payment records).
+    """
+    rng = random.Random(seed)
+    system = BankingSystemImpl()
+    names = ["account%d" % i for i in range(n_accounts)]
+    for t, name in enumerate(names):
+        system.create_account(t, name)
+        system.deposit(t, name, 10 ** 12)
+    issued = {name: [] for name in names}
+    for i in range(n_ops):
+        name = rng.choice(names)
+        issued[name].append(system.pay(n_accounts + i, name, rng.randint(1, 1000)))
+
+    t = n_accounts + n_ops
+    survivors = names[merges:]
+    start = time.perf_counter()
+    for i, name in enumerate(names[:merges]):
+        survivor = survivors[i % len(survivors)]
+        system.merge_accounts(t, survivor, name)
+        issued[survivor] += issued.pop(name)
+    merge_s = (time.perf_counter() - start) / merges
+
+    def single():
+        for name, payments in issued.items():
+            for payment in payments:
+                system.get_payment_status(t, name, payment)
+
+    def bulk():
+        for name, payments in issued.items():
+            system.get_payment_statuses(t, name, payments)
+
+    return {
+        "merge_ms": merge_s * 1000,
+        "single_checks_per_s": n_ops / timed(single),
+        "bulk_checks_per_s": n_ops / timed(bulk),
+    }
+
+
+def bench_archive(n_accounts: int = 100000, n_ops: int = 1000000, dormant: float = 0.9, n_reads: int = 20000,
+                  long_points: int = 400000, seed: int = 0) -> dict:
+    """
+    Memory of the engine before and after archiving the `dormant`
+    fraction of accounts (those not touched in the second half of the
+    run), and `get_balance` latency on resident and archived accounts,
+    including a dormant account with `long_points` history points and
+    refunds settling into it once archived.
+    """
+    rng = random.Random(seed)
+    system = BankingSystemImpl()
+    names = ["account%d" % i for i in range(n_accounts)]
+    for t, name in enumerate(names):
+        system.create_account(t, name)
+        system.deposit(t, name, 10 ** 9)
+    active = names[:int(n_accounts * (1 - dormant))]
+    t = n_accounts
+    for i in range(n_ops):
+        t += 100
+        pool = names if i < n_ops // 2 else active
+        if i % 2:
+            system.transfer(t, rng.choice(pool), rng.choice(pool), rng.randint(1, 1000))
+        else:
+            system.pay(t, rng.choice(pool), rng.randint(1, 1000))
+
+    before = system.memory_report()["total"]
+    start = time.perf_counter()
+    for name in names[len(active):]:
+        system.archive_account(t, name)
+    archive_s = time.perf_counter() - start
+    after = system.memory_report()["total"]
+
+    def reads(pool):
+        queries = [(rng.choice(pool), rng.randint(0, t)) for _ in range(n_reads)]
+        return n_reads / timed(lambda: [system.get_balance(t, name, time_at) for name, time_at in queries])
+
+    results = {
+        "resident_mb": before / 2 ** 20,
+        "archived_mb": after / 2 ** 20,
+        "reduction_pct": 100 * (1 - after / before),
+        "archive_per_s": (n_accounts - len(active)) / archive_s,
+        "resident_reads_per_s": reads(active),
+        "archived_reads_per_s": reads(names[len(active):]),
+    }
+
+    long = BankingSystemImpl()
+    long.create_account(0, "long")
+    for t in range(1, long_points):
+        long.deposit(t, "long", 1)
+    for t in range(long_points, long_points + 1000):
+        long.pay(t, "long", 100)
+    queries = [rng.randrange(long_points) for _ in range(n_reads)]
+    results["long_resident_reads_per_s"] = n_reads / timed(
+        lambda: [long.get_balance(long_points, "long", time_at) for time_at in queries])
+    long.archive_account(long_points + 1000, "long")
+    results["long_archived_reads_per_s"] = n_reads / timed(
+        lambda: [long.get_balance(long_points, "long", time_at) for time_at in queries])
+    #the 1000 refunds settle into the archived record
+    start = time.perf_counter()
+    long.advance_time(long_points + 1000 + 86400000)
+    results["long_archived_settles_per_s"] = 1000 / (time.perf_counter() - start)
+    return results
+
+
+def bench_onboarding(n_ops: int = 1000000, batch: int = 100000) -> dict:
+    """
+    Accounts created per second by `create_account` calls and by
+    `create_accounts` batches of `batch` ids, and the memory of an
+    account without activity.
+    """
+    names = ["account%d" % i for i in range(n_ops)]
+    single = BankingSystemImpl()
+    start = time.perf_counter()
+    for name in names:
+        single.create_account(0, name)
+    single_s = time.perf_counter() - start
+
+    bulk = BankingSystemImpl()
+    start = time.perf_counter()
+    for i in range(0, n_ops, batch):
+        bulk.create_accounts(0, names[i:i + batch])
+    bulk_s = time.perf_counter() - start
+
+    report = bulk.memory_report()
+    return {
+        "single_per_s": n_ops / single_s,
+        "bulk_per_s": n_ops / bulk_s,
+        "bytes_per_account": report["total"] / n_ops,
+    }
+
+
+def bench_metrics(n_ops: int = 200000, n_accounts: int = 100000, seed: int = 0) -> dict:
+    """
+    Throughput of the mixed trace with metrics disabled and enabled, and
+    the time to render the exposition of the resulting engine.
+    """
+    trace = make_trace(n_ops, n_accounts, seed)
+    plain = len(trace) / timed(lambda system: replay(system, trace), BankingSystemImpl)
+    metered = len(trace) / timed(lambda system: replay(system, trace), lambda: BankingSystemImpl(metrics=True))
+    system = BankingSystemImpl(metrics=True)
+    replay(system, trace)
+    return {
+        "plain_ops_per_s": plain,
+        "metered_ops_per_s": metered,
+        "overhead_pct": 100 * (plain / metered - 1),
+        "scrape_ms": 1000 * timed(lambda: exposition(system)),
+        "exposition_bytes": len(exposition(system)),
+    }
+
+
+def bench_parallel_replay(n_ops: int = 600000, n_accounts: int = 20000, window: int = 200000, workers=(1, 2, 4),
+                          community: int = 16, seed: int = 0) -> dict:
+    """
+    Calls per second of replaying the mixed trace sequentially and with
+    `ParallelReplay` at several worker counts (the machine has
+    `cpu_count` cores); every parallel run is checked against the
+    sequential results. Transfers and merges stay within communities of
+    `community` accounts, so windows split into many small components.
+    """
+    trace = make_trace(n_ops, n_accounts, seed, community)
+    expected = replay(BankingSystemImpl(), trace)
+    results = {"cpu_count": os.cpu_count(),
+               "sequential_ops_per_s": len(trace) / timed(lambda system: replay(system, trace), BankingSystemImpl,
+                                                          repeat=1)}
+    for k in workers:
+        engine = ParallelReplay(workers=k, window=window)
+        if engine.run(trace)[1] != expected:
+            raise AssertionError("parallel replay with %d workers diverged" % k)
+        seconds = timed(lambda: engine.run(trace), repeat=1)
+        results["workers_%d_ops_per_s" % k] = len(trace) / seconds
+        results["workers_%d_speedup" % k] = results["workers_%d_ops_per_s" % k] / results["sequential_ops_per_s"]
+    return results
+
+
+BENCHMARKS = {
+    "allocations": bench_allocations,
+    "archive": bench_archive,
+    "cashback_policy": bench_cashback_policy,
+    "columnar": bench_columnar,
+    "handles": bench_handles,
+    "hot_paths": bench_hot_paths,
+    "heavy_hitters": bench_heavy_hitters,
+    "ingest": bench_ingest,
+    "metrics": bench_metrics,
+    "onboarding": bench_onboarding,
+    "parallel_reads": bench_parallel_reads,
+    "parallel_replay": bench_parallel_replay,
+    "payment_statuses": bench_payment_statuses,
+    "replication": bench_replication,
+    "scheduler": bench_scheduler,
+    "sqlite": bench_sqlite,
+    "top_spenders": bench_top_spenders,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--ops", type=int, nargs="+", default=None,
+                        help="number of operations (several sizes where supported)")
+    args = parser.parse_args()
+
+    kwargs = {}
+    if args.ops is not None:
+        kwargs["n_ops"] = args.ops[0] if len(args.ops) == 1 else args.ops
+    for key, value in BENCHMARKS[args.benchmark](**kwargs).items():
+        print("%s: %.1f" % (key, value))
+
+
+if __name__ == "__main__":
+    main()
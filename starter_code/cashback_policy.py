@@ -0,0 +1,145 @@
+from abc import ABC, abstractmethod
+import bisect
+
+import numpy as np
+
+
+#cashback rates are integer basis points so amounts round down exactly
+BASIS_POINTS = 10000
+CASHBACK_DELAY = 86400000
+
+
+class CashbackPolicy(ABC):
+    """
+    Decides the cashback of a payment.
+
+    `evaluate` is called by `pay` for every successful payment;
+    `evaluate_batch` computes the same thing for arrays of payments.
+    Refunds are due `delay` ms after the payment.
+    """
+
+    delay = CASHBACK_DELAY
+
+    @abstractmethod
+    def evaluate(self, h: int, amount: int, timestamp: int, category: int = 0) -> int:
+        """
+        Cashback for a payment of `amount` by account handle `h` at
+        `timestamp` in merchant `category`.
+        """
+
+    @abstractmethod
+    def evaluate_batch(self, handles, amounts, timestamps, categories=None) -> np.ndarray:
+        """
+        Vectorized `evaluate` over equally sized integer arrays.
+        """
+
+
+class FlatCashbackPolicy(CashbackPolicy):
+    """
+    The same rate for every payment (2% by default).
+    """
+
+    def __init__(self, rate_bp: int = 200, delay: int = CASHBACK_DELAY):
+        self.rate_bp = rate_bp
+        self.delay = delay
+
+    def evaluate(self, h: int, amount: int, timestamp: int, category: int = 0) -> int:
+        return amount * self.rate_bp // BASIS_POINTS
+
+    def evaluate_batch(self, handles, amounts, timestamps, categories=None) -> np.ndarray:
+        return np.asarray(amounts, dtype=np.int64) * self.rate_bp // BASIS_POINTS
+
+
+class TieredCashbackPolicy(CashbackPolicy):
+    """
+    Rate = tier rate of the account + merchant category bonus + bonus of
+    the promotion active at the payment time, capped at `cap` per payment.
+
+    The rules are compiled into lookup tables up front: an account tier
+    array indexed by handle, a category bonus array indexed by category
+    code and sorted promotion boundaries with the bonus of every interval.
+    Evaluating a payment is a few array reads and no rule interpretation.
+    """
+
+    def __init__(self, tier_rates_bp: list[int], account_tiers: dict[int, int] | None = None,
+                 category_bonus_bp: dict[int, int] | None = None,
+                 promotions: list[tuple[int, int, int]] | None = None,
+                 cap: int | None = None, delay: int = CASHBACK_DELAY):
+        """
+        Parameters
+        ----------
+        tier_rates_bp: rate in basis points of every tier; accounts
+        without an assigned tier use tier 0
+        account_tiers: account handle -> tier
+        category_bonus_bp: merchant category code -> extra basis points
+        promotions: `(start, end, bonus_bp)` intervals `[start, end)` of
+        payment timestamps; overlapping bonuses add up
+        cap: maximum cashback per payment, or `None`
+        delay: ms between payment and refund
+        """
+        self.tier_rates = np.asarray(tier_rates_bp, dtype=np.int64)
+        self.cap = cap
+        self.delay = delay
+
+        #account handle -> tier
+        account_tiers = account_tiers or {}
+        size = max(account_tiers, default=-1) + 1
+        self.account_tiers = np.zeros(size, dtype=np.int64)
+        for h, tier in account_tiers.items():
+            self.account_tiers[h] = tier
+        #handle -> rate, so the scalar path is a single list read
+        self.account_rates = self.tier_rates[self.account_tiers].tolist()
+        self.default_rate = int(self.tier_rates[0])
+
+        #category code -> bonus
+        category_bonus_bp = category_bonus_bp or {}
+        size = max(category_bonus_bp, default=-1) + 1
+        self.category_bonus = np.zeros(size, dtype=np.int64)
+        for category, bonus in category_bonus_bp.items():
+            self.category_bonus[category] = bonus
+        self.category_bonus_list = self.category_bonus.tolist()
+
+        #promotion boundaries; interval i is [boundaries[i-1], boundaries[i])
+        boundaries = sorted({t for start, end, _ in promotions or [] for t in (start, end)})
+        bonus = [0] * (len(boundaries) + 1)
+        for start, end, bonus_bp in promotions or []:
+            for i in range(bisect.bisect_right(boundaries, start), bisect.bisect_right(boundaries, end)):
+                bonus[i] += bonus_bp
+        self.promo_boundaries = np.asarray(boundaries, dtype=np.int64)
+        self.promo_bonus = np.asarray(bonus, dtype=np.int64)
+        self.promo_boundaries_list = boundaries
+        self.promo_bonus_list = bonus
+
+    def evaluate(self, h: int, amount: int, timestamp: int, category: int = 0) -> int:
+        rate = self.account_rates[h] if h < len(self.account_rates) else self.default_rate
+        #negative codes are unknown categories, not indexes from the end
+        if 0 <= category < len(self.category_bonus_list):
+            rate += self.category_bonus_list[category]
+        if self.promo_boundaries_list:
+            rate += self.promo_bonus_list[bisect.bisect_right(self.promo_boundaries_list, timestamp)]
+        cashback = amount * rate // BASIS_POINTS
+        if self.cap is not None and cashback > self.cap:
+            return self.cap
+        return cashback
+
+    def evaluate_batch(self, handles, amounts, timestamps, categories=None) -> np.ndarray:
+        handles = np.asarray(handles, dtype=np.int64)
+        amounts = np.asarray(amounts, dtype=np.int64)
+
+        #handles past the tier table belong to tier 0
+        known = handles < len(self.account_tiers)
+        tiers = np.zeros(len(handles), dtype=np.int64)
+        tiers[known] = self.account_tiers[handles[known]]
+        rates = self.tier_rates[tiers]
+
+        if categories is not None and len(self.category_bonus):
+            categories = np.asarray(categories, dtype=np.int64)
+            known = (categories >= 0) & (categories < len(self.category_bonus))
+            rates[known] += self.category_bonus[categories[known]]
+        if len(self.promo_boundaries):
+            rates += self.promo_bonus[np.searchsorted(self.promo_boundaries, timestamps, side="right")]
+
+        cashback = amounts * rates // BASIS_POINTS
+        if self.cap is not None:
+            np.minimum(cashback, self.cap, out=cashback)
+        return cashback
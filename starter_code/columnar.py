@@ -0,0 +1,258 @@
+from array import array
+import itertools
+import json
+import os
+import struct
+
+import numpy as np
+
+from balance_history import BalanceHistory
+from banking_system_impl import BankingSystemImpl
+from ledger import Ledger
+
+
+#columns of every exported table as (name, type): "q" int64, "b" int8, "str" utf-8
+TABLES = {
+    "accounts": (("handle", "q"), ("account_id", "str"), ("live", "b"), ("created", "q"),
+                 ("balance", "q"), ("outgoing", "q"), ("merged_into", "q"), ("merged_at", "q")),
+    "history": (("handle", "q"), ("timestamp", "q"), ("balance", "q")),
+    "ledger": (("handle", "q"), ("timestamp", "q"), ("kind", "b"), ("amount", "q"), ("counterpart", "q")),
+    "payments": (("payment", "q"), ("handle", "q"), ("cb_timestamp", "q"), ("cb_amount", "q"), ("settled", "b")),
+}
+DTYPES = {"q": np.dtype("<i8"), "b": np.dtype("i1")}
+#stands in for missing integers (merge timestamp of live accounts)
+NULL = -(1 << 63)
+FORMAT_VERSION = 1
+
+#chunk header: number of rows; string columns add the byte size of their text
+CHUNK_HEADER = struct.Struct("<I")
+TEXT_HEADER = struct.Struct("<Q")
+
+
+class ChunkWriter:
+    """
+    Writes one table as a sequence of column chunks of at most
+    `chunk_rows` rows. Each chunk stores its row count and then every
+    column contiguously: fixed-width columns as raw little-endian
+    integers, string columns as int32 byte lengths followed by the
+    concatenated utf-8 text.
+    """
+
+    def __init__(self, path: str, columns: tuple, chunk_rows: int):
+        self.file = open(path, "wb")
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.buffers = [[] if kind == "str" else array(kind) for _, kind in columns]
+        self.rows = 0
+        self.chunks = 0
+
+    def extend(self, *values) -> None:
+        """
+        Append equally long sequences, one per column.
+        """
+        for buffer, column in zip(self.buffers, values):
+            buffer.extend(column)
+        if len(self.buffers[0]) >= self.chunk_rows:
+            self._write_chunks(final=False)
+
+    def _write_chunks(self, final: bool) -> None:
+        buffers = self.buffers
+        while len(buffers[0]) >= self.chunk_rows or (final and buffers[0]):
+            n = min(self.chunk_rows, len(buffers[0]))
+            out = [CHUNK_HEADER.pack(n)]
+            for buffer in buffers:
+                if isinstance(buffer, list):
+                    encoded = [value.encode() for value in buffer[:n]]
+                    text = b"".join(encoded)
+                    out.append(TEXT_HEADER.pack(len(text)))
+                    out.append(array("i", map(len, encoded)).tobytes())
+                    out.append(text)
+                else:
+                    out.append(buffer[:n].tobytes())
+                del buffer[:n]
+            self.file.write(b"".join(out))
+            self.rows += n
+            self.chunks += 1
+
+    def close(self) -> None:
+        self._write_chunks(final=True)
+        self.file.close()
+
+
+def read_chunks(path: str, columns: tuple):
+    """
+    Lazily yield the chunks of a table written by `ChunkWriter`, each as
+    a list of columns: numpy arrays for integers, lists of str for text.
+    """
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(CHUNK_HEADER.size)
+            if not header:
+                return
+            n = CHUNK_HEADER.unpack(header)[0]
+            chunk = []
+            for _, kind in columns:
+                if kind == "str":
+                    size = TEXT_HEADER.unpack(f.read(TEXT_HEADER.size))[0]
+                    lengths = np.frombuffer(f.read(4 * n), dtype="<i4")
+                    text = f.read(size)
+                    ends = np.cumsum(lengths).tolist()
+                    starts = [0] + ends[:-1]
+                    chunk.append([text[i:j].decode() for i, j in zip(starts, ends)])
+                else:
+                    dtype = DTYPES[kind]
+                    chunk.append(np.frombuffer(f.read(dtype.itemsize * n), dtype=dtype))
+            yield chunk
+
+
+def export_state(system: BankingSystemImpl, directory: str, chunk_rows: int = 65536) -> dict[str, int]:
+    """
+    Write the state of `system` as columnar tables (accounts, balance
+    histories including the cold tier, statement ledgers and the payment
+    registry) plus a `manifest.json` into `directory`. Tables are built
+    and written `chunk_rows` rows at a time, so memory beyond the engine
+    itself stays bounded. Returns the number of rows of every table.
+    """
+    os.makedirs(directory, exist_ok=True)
+    writers = {name: ChunkWriter(os.path.join(directory, name + ".col"), columns, chunk_rows)
+               for name, columns in TABLES.items()}
+
+    accounts = writers["accounts"]
+    for start in range(0, len(system.names), chunk_rows):
+        end = min(start + chunk_rows, len(system.names))
+        accounts.extend(range(start, end), system.names[start:end], system.live[start:end],
+                        system.created[start:end], system.balances[start:end], system.outgoing[start:end],
+                        system.merged_into[start:end],
+                        [NULL if t is None else t for t in system.merged_at[start:end]])
+
+    history = writers["history"]
+    store = system.history_store
+    for h in range(len(system.histories)):
+        hot = system.history(h)
+        #stream the points: a long history, spilled or not, is never listed whole
+        points = hot.items() if store is None else itertools.chain(store.items(h), hot.items())
+        while True:
+            part = list(itertools.islice(points, chunk_rows))
+            if not part:
+                break
+            history.extend([h] * len(part), [t for t, _ in part], [balance for _, balance in part])
+
+    ledgers = writers["ledger"]
+    for h, ledger in enumerate(system.ledgers):
+        if ledger is None and h in system.archive:
+            ledger = system.archive.expand(h)[1]
+        if ledger is None:
+            continue
+        for start in range(0, len(ledger), chunk_rows):
+            end = min(start + chunk_rows, len(ledger))
+            ledgers.extend(array("q", [h]) * (end - start), ledger.timestamps[start:end], ledger.kinds[start:end],
+                           ledger.amounts[start:end], ledger.counterparts[start:end])
+
+    payments = writers["payments"]
+    pay_log = system.pay_log
+    for start in range(0, len(pay_log), chunk_rows):
+        end = min(start + chunk_rows, len(pay_log))
+        payments.extend(range(start + 1, end + 1), pay_log.owners[start:end], pay_log.due[start:end],
+                        pay_log.amounts[start:end], pay_log.settled[start:end])
+
+    #a clock that was never advanced is -inf, which strict JSON cannot hold
+    clock = system.clock if system.clock > float("-inf") else None
+    manifest = {"format": FORMAT_VERSION, "clock": clock, "tables": {}}
+    for name, writer in writers.items():
+        writer.close()
+        manifest["tables"][name] = {"columns": [list(column) for column in TABLES[name]],
+                                    "rows": writer.rows, "chunks": writer.chunks}
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+    return {name: writer.rows for name, writer in writers.items()}
+
+
+def load_state(directory: str, **kwargs) -> BankingSystemImpl:
+    """
+    Rebuild a `BankingSystemImpl` from files written by `export_state`.
+    `kwargs` go to the engine constructor; with a cold history tier,
+    loaded histories are spilled like live ones. Idempotency keys,
+    cached rankings and heavy-hitter sketches are not part of the export
+    and start empty; archived accounts are loaded resident.
+    """
+    with open(os.path.join(directory, "manifest.json")) as f:
+        manifest = json.load(f)
+    if manifest["format"] != FORMAT_VERSION:
+        raise ValueError("unsupported export format %r" % manifest["format"])
+
+    def chunks(name):
+        return read_chunks(os.path.join(directory, name + ".col"), TABLES[name])
+
+    system = BankingSystemImpl(**kwargs)
+    for _, names, live, created, balances, outgoing, merged_into, merged_at in chunks("accounts"):
+        first = len(system.names)
+        system.names.extend(names)
+        system.live.extend(live.tobytes())
+        system.created.frombytes(created.tobytes())
+        system.balances.frombytes(balances.tobytes())
+        system.outgoing.frombytes(outgoing.tobytes())
+        merged_into = merged_into.tolist()
+        system.merged_into.extend(merged_into)
+        system.merged_at.extend(None if t == NULL else t for t in merged_at.tolist())
+        for h, (account_id, is_live, parent) in enumerate(zip(names, live.tolist(), merged_into), first):
+            system.histories.append(BalanceHistory())
+            system.ledgers.append(None)
+            system.payments.append(array("q"))
+            if is_live:
+                system.ids[account_id] = h
+                system.alias.append(h)
+            elif parent == -1:
+                #closed account
+                system.retired[account_id] = h
+                system.alias.append(h)
+            else:
+                system.retired[account_id] = h
+                system.alias.append(parent)
+                system.merged_from.setdefault(parent, []).append(h)
+                system.merged_accounts += 1
+
+    histories = system.histories
+    store = system.history_store
+    for handles, timestamps, balances in chunks("history"):
+        system.history_points += len(handles)
+        if store is None:
+            for h, timestamp, balance in zip(handles.tolist(), timestamps.tolist(), balances.tolist()):
+                histories[h].append(timestamp, balance)
+            continue
+        #spill while loading, as record_balance does, so cold points never pile up in memory
+        spill = 2 * system.spill_min
+        for h, timestamp, balance in zip(handles.tolist(), timestamps.tolist(), balances.tolist()):
+            history = histories[h]
+            history.append(timestamp, balance)
+            if len(history) >= spill and history.first_timestamp < timestamp - system.hot_window:
+                store.append(h, history.split_before(timestamp - system.hot_window, system.spill_min))
+
+    ledgers = system.ledgers
+    for handles, timestamps, kinds, amounts, counterparts in chunks("ledger"):
+        #rows are grouped by handle: copy every run column-wise
+        bounds = [0, *(np.flatnonzero(np.diff(handles)) + 1).tolist(), len(handles)]
+        for start, end in zip(bounds, bounds[1:]):
+            h = int(handles[start])
+            ledger = ledgers[h]
+            if ledger is None:
+                ledger = ledgers[h] = Ledger()
+            ledger.timestamps.frombytes(timestamps[start:end].tobytes())
+            ledger.kinds.frombytes(kinds[start:end].tobytes())
+            ledger.amounts.frombytes(amounts[start:end].tobytes())
+            ledger.counterparts.frombytes(counterparts[start:end].tobytes())
+
+    pay_log = system.pay_log
+    for numbers, handles, CB_timestamps, CB_amounts, settled in chunks("payments"):
+        pay_log.owners.frombytes(handles.tobytes())
+        pay_log.due.frombytes(CB_timestamps.tobytes())
+        pay_log.amounts.frombytes(CB_amounts.tobytes())
+        pay_log.settled.extend(settled.tobytes())
+        for number, h, CB_timestamp, CB_amount, CB_status in zip(
+                numbers.tolist(), handles.tolist(), CB_timestamps.tolist(), CB_amounts.tolist(), settled.tolist()):
+            system.payments[h].append(number)
+            if not CB_status:
+                system.scheduler.schedule(CB_timestamp, number)
+                system.pending_cashback += CB_amount
+
+    system.clock = manifest["clock"] if manifest["clock"] is not None else float("-inf")
+    return system
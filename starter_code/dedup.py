@@ -0,0 +1,77 @@
+import functools
+from collections import OrderedDict
+
+
+class DedupCache:
+    """
+    Bounded cache of results of already applied requests, keyed by
+    idempotency key.
+
+    At most `capacity` keys are kept; the least recently used key is
+    evicted first. With a `window`, a key also expires once the request
+    timestamp has moved more than `window` ms past the original one.
+    """
+
+    def __init__(self, capacity: int, window: int | None = None):
+        """
+        Parameters
+        ----------
+        capacity: maximum number of remembered keys
+        window: time-to-live of a key in ms of request time, or `None`
+        """
+        self.capacity = capacity
+        self.window = window
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def lookup(self, key, timestamp: int) -> tuple[bool, object]:
+        """
+        Returns `(True, result)` if `key` was seen and has not expired,
+        `(False, None)` otherwise.
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            if self.window is None or timestamp - entry[0] <= self.window:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            del self.entries[key]
+        self.misses += 1
+        return False, None
+
+    def store(self, key, timestamp: int, result) -> None:
+        """
+        Remember `result` for `key`, evicting the oldest key when full.
+        """
+        self.entries[key] = (timestamp, result)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+
+def idempotent(method):
+    """
+    Give a `BankingSystemImpl` method an optional `idempotency_key`
+    keyword. A repeated key returns the first result from the system's
+    dedup cache without running the method again. Keys are scoped per
+    method.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, timestamp, *args, idempotency_key=None, **kwargs):
+        if idempotency_key is None or self.dedup is None:
+            return method(self, timestamp, *args, **kwargs)
+        key = (name, idempotency_key)
+        hit, result = self.dedup.lookup(key, timestamp)
+        if hit:
+            return result
+        result = method(self, timestamp, *args, **kwargs)
+        self.dedup.store(key, timestamp, result)
+        return result
+
+    return wrapper
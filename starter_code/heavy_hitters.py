@@ -0,0 +1,112 @@
+import heapq
+import math
+
+
+class SpaceSaving:
+    """
+    Weighted Space-Saving heavy-hitter sketch with a fixed number of
+    counters.
+
+    With `capacity` counters and a total observed weight `W`, every
+    tracked count overestimates the true total by at most its recorded
+    error, which is never more than `W / capacity`; any key whose true
+    total exceeds `W / capacity` is guaranteed to be tracked.
+    """
+
+    def __init__(self, capacity: int):
+        """
+        Parameters
+        ----------
+        capacity: number of counters (the memory bound)
+        """
+        self.capacity = capacity
+        #key -> [count, error]
+        self.counters = {}
+        #lazy min-heap of (count, key); entries whose count is stale are skipped
+        self.heap = []
+        self.total = 0
+        #count of the latest evicted counter: an untracked key may have had
+        #up to this much, so new counters start from it
+        self.floor = 0
+
+    @classmethod
+    def with_error(cls, epsilon: float) -> "SpaceSaving":
+        """
+        Sketch whose estimates are within `epsilon * total weight`.
+        """
+        return cls(math.ceil(1 / epsilon))
+
+    def __len__(self) -> int:
+        return len(self.counters)
+
+    def _pop_min(self) -> tuple[int, object]:
+        heap = self.heap
+        while True:
+            count, key = heapq.heappop(heap)
+            counter = self.counters.get(key)
+            if counter is not None and counter[0] == count:
+                return count, key
+
+    def _push(self, count: int, key) -> None:
+        heapq.heappush(self.heap, (count, key))
+        #drop stale entries before the heap outgrows the counters
+        if len(self.heap) > 4 * self.capacity + 16:
+            self.heap = [(counter[0], k) for k, counter in self.counters.items()]
+            heapq.heapify(self.heap)
+
+    def update(self, key, weight: int) -> None:
+        """
+        Add `weight` to `key`.
+        """
+        self.total += weight
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+        elif len(self.counters) < self.capacity:
+            #a counter freed by a merge or discard: the key may have been evicted before
+            counter = self.counters[key] = [self.floor + weight, self.floor]
+        else:
+            #replace the smallest counter; its count becomes the error bound
+            self.floor, evicted = self._pop_min()
+            del self.counters[evicted]
+            counter = self.counters[key] = [self.floor + weight, self.floor]
+        self._push(counter[0], key)
+
+    def merge_keys(self, into, key) -> None:
+        """
+        Fold the estimate of `key` into `into` and forget `key`.
+        """
+        counter = self.counters.pop(key, None)
+        if counter is None:
+            #an evicted key may have had up to the floor
+            if not self.floor:
+                return
+            counter = [self.floor, self.floor]
+        self.total -= counter[0]
+        self.update(into, counter[0])
+        self.counters[into][1] += counter[1]
+
+    def discard(self, key) -> None:
+        """
+        Forget `key` and its estimate.
+        """
+        counter = self.counters.pop(key, None)
+        if counter is not None:
+            self.total -= counter[0]
+
+    def estimate(self, key) -> tuple[int, int]:
+        """
+        `(estimated total, maximum overestimate)` of `key`; untracked
+        keys may still have up to the smallest tracked count.
+        """
+        counter = self.counters.get(key)
+        if counter is None:
+            return 0, min((c[0] for c in self.counters.values()), default=self.floor)
+        return counter[0], counter[1]
+
+    def top(self, n: int) -> list[tuple[object, int]]:
+        """
+        The `n` keys with the largest estimates, as `(key, estimate)`.
+        """
+        best = heapq.nsmallest(n, ((-counter[0], key) for key, counter in self.counters.items()))
+        return [(key, -count) for count, key in best]
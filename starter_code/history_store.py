@@ -0,0 +1,165 @@
+import bisect
+import mmap
+import os
+import struct
+from collections import OrderedDict
+
+
+#block header: (history_id, number of points); each point is (timestamp, balance)
+BLOCK_HEADER = struct.Struct("<qI")
+POINT = struct.Struct("<qq")
+
+
+class SegmentStore:
+    """
+    Append-only on-disk store for cold balance history.
+
+    Old history points are written in blocks to segment files inside
+    `directory`. A sparse in-memory index keeps one entry per block
+    (first timestamp and file location) for every history, so a lookup
+    binary-searches the index, pages in a single block through mmap and
+    binary-searches inside it. Decoded blocks are kept in an LRU cache.
+
+    The index only lives in memory, so segment files are private to one
+    store: new ones are numbered after any already in `directory` and
+    `close` deletes them.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024, cache_blocks: int = 64):
+        """
+        Parameters
+        ----------
+        directory: folder holding the segment files (created if missing)
+        segment_bytes: size after which a new segment file is started
+        cache_blocks: number of decoded blocks kept in the LRU cache
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.cache_blocks = cache_blocks
+        os.makedirs(directory, exist_ok=True)
+
+        #history_id -> ([first timestamps], [(segment number, offset, count)])
+        self.index = {}
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        #never append to segment files of another store or an earlier run
+        existing = [int(name[8:-4]) for name in os.listdir(directory)
+                    if name.startswith("segment-") and name.endswith(".seg") and name[8:-4].isdigit()]
+        self.segment_no = max(existing, default=0)
+        self.segment_paths = {}
+        self.views = {}
+        self.writer = None
+        self._open_segment()
+
+    def _open_segment(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+        self.segment_no += 1
+        path = os.path.join(self.directory, "segment-%06d.seg" % self.segment_no)
+        self.segment_paths[self.segment_no] = path
+        self.writer = open(path, "ab")
+
+    def append(self, history_id: int, points: list[tuple[int, int]]) -> None:
+        """
+        Append a block of `(timestamp, balance)` points for `history_id`.
+        Points must be sorted and newer than anything already spilled
+        for that history.
+        """
+        if not points:
+            return
+        if self.writer.tell() >= self.segment_bytes:
+            self._open_segment()
+
+        payload = bytearray(BLOCK_HEADER.pack(history_id, len(points)))
+        for timestamp, balance in points:
+            payload += POINT.pack(timestamp, int(balance))
+        offset = self.writer.tell()
+        self.writer.write(payload)
+        self.writer.flush()
+
+        first_timestamps, locations = self.index.setdefault(history_id, ([], []))
+        first_timestamps.append(points[0][0])
+        locations.append((self.segment_no, offset, len(points)))
+
+    def _view(self, segment_no: int, end: int) -> mmap.mmap:
+        #remap when the segment has grown past the mapped region
+        view = self.views.get(segment_no)
+        if view is None or len(view) < end:
+            if view is not None:
+                view.close()
+            with open(self.segment_paths[segment_no], "rb") as f:
+                view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.views[segment_no] = view
+        return view
+
+    def _load_block(self, location: tuple[int, int, int]) -> tuple[list[int], list[int]]:
+        block = self.cache.get(location)
+        if block is not None:
+            self.cache.move_to_end(location)
+            self.cache_hits += 1
+            return block
+
+        self.cache_misses += 1
+        segment_no, offset, count = location
+        start = offset + BLOCK_HEADER.size
+        view = self._view(segment_no, start + count * POINT.size)
+        timestamps = []
+        balances = []
+        for timestamp, balance in POINT.iter_unpack(view[start:start + count * POINT.size]):
+            timestamps.append(timestamp)
+            balances.append(balance)
+        block = (timestamps, balances)
+
+        self.cache[location] = block
+        if len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return block
+
+    def lookup(self, history_id: int, time_at: int) -> int | None:
+        """
+        Balance recorded at the latest spilled timestamp at or before
+        `time_at`, or `None` if `time_at` precedes all spilled points.
+        """
+        entry = self.index.get(history_id)
+        if entry is None:
+            return None
+        first_timestamps, locations = entry
+        i = bisect.bisect_right(first_timestamps, time_at) - 1
+        if i < 0:
+            return None
+        timestamps, balances = self._load_block(locations[i])
+        return balances[bisect.bisect_right(timestamps, time_at) - 1]
+
+    def items(self, history_id: int):
+        """
+        Iterate over all spilled `(timestamp, balance)` points of
+        `history_id` in time order, one block at a time, bypassing the
+        read cache.
+        """
+        entry = self.index.get(history_id)
+        if entry is None:
+            return
+        for segment_no, offset, count in entry[1]:
+            start = offset + BLOCK_HEADER.size
+            view = self._view(segment_no, start + count * POINT.size)
+            yield from POINT.iter_unpack(view[start:start + count * POINT.size])
+
+    def close(self) -> None:
+        """
+        Close the open segment writer and all mapped views and delete the
+        segment files of this store; its index is gone with it.
+        """
+        for view in self.views.values():
+            view.close()
+        self.views = {}
+        self.cache.clear()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        for path in self.segment_paths.values():
+            if os.path.exists(path):
+                os.remove(path)
+        self.segment_paths = {}
+        self.index = {}
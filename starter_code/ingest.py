@@ -0,0 +1,108 @@
+import heapq
+
+
+class ReorderBuffer:
+    """
+    Ingestion stage that feeds a banking engine from a slightly unordered
+    event stream.
+
+    Events are `(method name, args)` calls whose first argument is the
+    timestamp. They are held in a min-heap until the watermark (latest
+    timestamp seen minus `max_delay`) passes them, then applied to
+    `system` in timestamp order; events with equal timestamps keep their
+    arrival order. An event older than the last applied one is late: it
+    is dropped, or with `late_policy="correct"` applied right away with
+    its timestamp moved up to the last applied one. Either way it is
+    counted and passed to `on_late`.
+    """
+
+    def __init__(self, system, max_delay: int, capacity: int | None = None,
+                 late_policy: str = "drop", on_late=None):
+        """
+        Parameters
+        ----------
+        system: engine the events are applied to
+        max_delay: ms an event may arrive after a later-stamped one and
+        still be applied in order
+        capacity: maximum number of buffered events; the oldest ones are
+        released early when it is exceeded, or `None` for no limit
+        late_policy: `"drop"` or `"correct"`
+        on_late: callable `(method, args, lateness)` called for every late
+        event, `lateness` in ms
+        """
+        if late_policy not in ("drop", "correct"):
+            raise ValueError("late_policy must be 'drop' or 'correct'")
+        self.system = system
+        self.max_delay = max_delay
+        self.capacity = capacity
+        self.late_policy = late_policy
+        self.on_late = on_late
+
+        #pending events as (timestamp, arrival seq, method, args)
+        self.heap = []
+        self.seq = 0
+        self.max_seen = float("-inf")
+        #timestamp of the last applied event
+        self.released_until = float("-inf")
+
+        self.released = 0
+        self.dropped = 0
+        self.corrected = 0
+        self.max_lateness = 0
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    @property
+    def watermark(self) -> float:
+        """
+        Events stamped at or before this timestamp are applied.
+        """
+        return self.max_seen - self.max_delay
+
+    def push(self, method: str, args: tuple) -> list[tuple[tuple[str, tuple], object]]:
+        """
+        Accept one event. Returns `((method, args), result)` of every
+        event applied because of it, in timestamp order.
+        """
+        timestamp = args[0]
+        if timestamp < self.released_until:
+            return self._late(method, args)
+        heapq.heappush(self.heap, (timestamp, self.seq, method, args))
+        self.seq += 1
+        if timestamp > self.max_seen:
+            self.max_seen = timestamp
+        return self._release(self.max_seen - self.max_delay)
+
+    def flush(self) -> list[tuple[tuple[str, tuple], object]]:
+        """
+        Apply every buffered event, e.g. at the end of the stream.
+        """
+        return self._release(float("inf"))
+
+    def _release(self, watermark: float) -> list[tuple[tuple[str, tuple], object]]:
+        heap = self.heap
+        capacity = self.capacity
+        system = self.system
+        applied = []
+        while heap and (heap[0][0] <= watermark or (capacity is not None and len(heap) > capacity)):
+            timestamp, _, method, args = heapq.heappop(heap)
+            self.released_until = timestamp
+            applied.append(((method, args), getattr(system, method)(*args)))
+        self.released += len(applied)
+        return applied
+
+    def _late(self, method: str, args: tuple) -> list[tuple[tuple[str, tuple], object]]:
+        lateness = self.released_until - args[0]
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+        if self.on_late is not None:
+            self.on_late(method, args, lateness)
+        if self.late_policy == "drop":
+            self.dropped += 1
+            return []
+        #apply now, as if it had arrived just in time
+        self.corrected += 1
+        self.released += 1
+        args = (self.released_until,) + tuple(args[1:])
+        return [((method, args), getattr(self.system, method)(*args))]
@@ -0,0 +1,88 @@
+from array import array
+import bisect
+from typing import NamedTuple
+
+
+#event kinds, stored as one byte per entry
+DEPOSIT = 0
+TRANSFER_IN = 1
+TRANSFER_OUT = 2
+PAYMENT = 3
+CASHBACK = 4
+MERGE = 5
+KINDS = ("deposit", "transfer_in", "transfer_out", "payment", "cashback", "merge")
+
+
+class StatementEvent(NamedTuple):
+    """
+    One line of an account statement.
+
+    `account_id` is the account the event happened on (the statement's
+    own account or one merged into it); `counterparty` is the other
+    account of a transfer or merge, the payment id of a payment or
+    cashback, and `None` for deposits.
+    """
+    timestamp: int
+    kind: str
+    account_id: str
+    amount: int
+    counterparty: str | None
+
+
+class Ledger:
+    """
+    Chronological activity of one account, stored column-wise in typed
+    arrays: timestamp, kind, amount and counterpart (handle of the other
+    account, or payment number). Entries are appended in time order, so
+    a time range is found by bisecting the timestamp column.
+    """
+
+    __slots__ = ("timestamps", "kinds", "amounts", "counterparts")
+
+    def __init__(self):
+        self.timestamps = array("q")
+        self.kinds = array("b")
+        self.amounts = array("q")
+        self.counterparts = array("q")
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __reduce__(self):
+        #pickle the columns as bytes: much faster than pickling each array
+        return (Ledger.from_buffers, (self.timestamps.tobytes(), self.kinds.tobytes(), self.amounts.tobytes(),
+                                      self.counterparts.tobytes()))
+
+    @classmethod
+    def from_buffers(cls, timestamps: bytes, kinds: bytes, amounts: bytes, counterparts: bytes) -> "Ledger":
+        """
+        Rebuild a ledger from the raw column buffers given by pickling.
+        """
+        ledger = cls.__new__(cls)
+        ledger.timestamps = array("q", timestamps)
+        ledger.kinds = array("b", kinds)
+        ledger.amounts = array("q", amounts)
+        ledger.counterparts = array("q", counterparts)
+        return ledger
+
+    def append(self, timestamp: int, kind: int, amount: int, counterpart: int = -1) -> None:
+        self.timestamps.append(timestamp)
+        self.kinds.append(kind)
+        self.amounts.append(amount)
+        self.counterparts.append(counterpart)
+
+    def scan(self, t1: int, t2: int):
+        """
+        Lazily yield `(timestamp, kind, amount, counterpart)` of every
+        entry with `t1 <= timestamp <= t2`, in order.
+        """
+        timestamps = self.timestamps
+        start = bisect.bisect_left(timestamps, t1)
+        end = bisect.bisect_right(timestamps, t2)
+        kinds, amounts, counterparts = self.kinds, self.amounts, self.counterparts
+        for i in range(start, end):
+            yield timestamps[i], kinds[i], amounts[i], counterparts[i]
+
+    def nbytes(self) -> int:
+        return sum(column.itemsize * len(column) for column in
+                   (self.timestamps, self.kinds, self.amounts, self.counterparts))
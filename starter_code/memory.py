@@ -0,0 +1,62 @@
+import sys
+
+
+#CPython cost of one pointer slot in a list, and of one entry of a dict with a str key
+SLOT_BYTES = 8
+DICT_ENTRY_BYTES = 3 * 8 + 8
+#one row of the payment registry columns
+PAYMENT_BYTES = 3 * 8 + 1
+
+
+def object_bytes(obj) -> int:
+    """
+    Size of `obj`, its attribute dict and its attribute values one level
+    deep (arrays and bytearrays include their buffers).
+    """
+    if obj is None:
+        return 0
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+        values = obj.__dict__.values()
+    else:
+        values = [getattr(obj, name) for name in getattr(type(obj), "__slots__", ())]
+    return size + sum(sys.getsizeof(value) for value in values)
+
+
+def account_footprint(system, h: int) -> dict[str, int]:
+    """
+    Approximate bytes held for account handle `h` of a
+    `BankingSystemImpl`, by structure.
+    """
+    name = system.names[h]
+    #one slot in every per-account list and int64 array, plus the id and its dict entry
+    tables = 10 * SLOT_BYTES + sys.getsizeof(name) + DICT_ENTRY_BYTES
+    merged_at = system.merged_at[h]
+    #small ints are shared, larger ones are objects of their own
+    if merged_at is not None and not -5 <= merged_at <= 256:
+        tables += sys.getsizeof(merged_at)
+
+    payments = system.payments[h]
+    #archived accounts hold one packed record instead of their structures,
+    #accounts without activity hold neither
+    archive = 0
+    if h in system.archive:
+        archive = sys.getsizeof(system.archive.records[h]) + DICT_ENTRY_BYTES
+    if payments is None:
+        payments = system.payment_numbers(h)
+    #payer, CB_timestamp, CB_amount and settled flag columns of the registry
+    pay_log = len(payments) * PAYMENT_BYTES
+
+    return {
+        "account_tables": tables,
+        "histories": object_bytes(system.histories[h]),
+        "ledgers": object_bytes(system.ledgers[h]),
+        "payments": sys.getsizeof(payments) if system.payments[h] is not None else 0,
+        "archive": archive,
+        "pay_log": pay_log,
+    }
+
+
+def percentile(ordered: list, q: float):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
@@ -0,0 +1,218 @@
+import bisect
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from mvcc import consistent_read
+
+
+#upper bounds (seconds) of the latency histogram buckets, 1us to 1s
+LATENCY_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 1e-2, 1e-1, 1.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram: the number of observations at or below each
+    bound (non-cumulative, the last slot counts the values above every
+    bound), their count and their sum.
+    """
+
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """
+        `(le, count)` of every bucket as exposed, ending with `"+Inf"`.
+        """
+        total = 0
+        rows = []
+        for bound, count in zip((*map(repr, self.bounds), "+Inf"), self.counts):
+            total += count
+            rows.append((bound, total))
+        return rows
+
+
+class Metrics:
+    """
+    Call counters and latency histograms of the metered methods of one
+    engine, by method name. Updating them costs two clock reads and a
+    bisect per call.
+    """
+
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.latency = {}
+        #scraper -> (time, call count by method) at its previous exposition,
+        #for rates; scrapes are served from several threads
+        self.last_scrape = {}
+        self.scrape_lock = threading.Lock()
+
+    def observe(self, method: str, seconds: float) -> None:
+        histogram = self.latency.get(method)
+        if histogram is None:
+            histogram = self.latency[method] = Histogram(self.bounds)
+        histogram.observe(seconds)
+
+    def snapshot(self) -> dict[str, Histogram]:
+        """
+        Copy of the histograms by method, safe to iterate while engine
+        threads add methods (copying a dict does not release the GIL).
+        """
+        return self.latency.copy()
+
+    def rates(self, scraper=None) -> dict[str, float]:
+        """
+        Calls per second of every method since the previous call by the
+        same `scraper`, so that scrapers do not reset each other's window.
+        """
+        now = time.perf_counter()
+        counts = {method: histogram.count for method, histogram in self.snapshot().items()}
+        with self.scrape_lock:
+            last = self.last_scrape.get(scraper)
+            self.last_scrape[scraper] = (now, counts)
+        if last is None:
+            return {}
+        elapsed = now - last[0]
+        if elapsed <= 0:
+            return {}
+        return {method: (count - last[1].get(method, 0)) / elapsed for method, count in counts.items()}
+
+
+def metered(method):
+    """
+    Count the calls of a `BankingSystemImpl` method and time them into
+    the system's `metrics`, when enabled. Nested metered calls are
+    recorded under their own name as well.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        metrics = self.metrics
+        if metrics is None:
+            return method(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            metrics.observe(name, time.perf_counter() - start)
+
+    return wrapper
+
+
+def gauges(system) -> list[tuple[str, str, str, float]]:
+    """
+    `(name, type, help, value)` of the engine-wide counters and gauges,
+    read from one version of the state.
+    """
+    def read():
+        payments = len(system.pay_log)
+        pending = len(system.scheduler)
+        return [
+            ("banking_accounts", "gauge", "Live accounts.", len(system.ids)),
+            ("banking_archived_accounts", "gauge", "Accounts held in the archive tier.", len(system.archive)),
+            ("banking_merge_aliases", "gauge", "Accounts merged away into another account.", system.merged_accounts),
+            ("banking_history_points", "gauge", "Stored balance history points, all tiers.", system.history_points),
+            ("banking_pending_cashback", "gauge", "Cashback refunds not settled yet.", pending),
+            ("banking_pending_cashback_amount", "gauge", "Total amount of unsettled cashback.", system.pending_cashback),
+            ("banking_payments_total", "counter", "Payments made.", payments),
+            ("banking_cashback_settled_total", "counter", "Cashback refunds settled.", payments - pending),
+            ("banking_clock_milliseconds", "gauge", "Settlement clock.", system.clock if system.clock > 0 else 0),
+        ]
+
+    return consistent_read(system, read)
+
+
+def exposition(system, scraper=None) -> str:
+    """
+    Metrics of `system` in the Prometheus text exposition format; rates
+    are over the window since the previous exposition for `scraper`.
+    """
+    lines = []
+    for name, kind, text, value in gauges(system):
+        lines += ["# HELP %s %s" % (name, text), "# TYPE %s %s" % (name, kind), "%s %s" % (name, value)]
+
+    metrics = system.metrics
+    if metrics is not None:
+        latency = sorted(metrics.snapshot().items())
+        lines += ["# HELP banking_operations_total Calls by method.", "# TYPE banking_operations_total counter"]
+        lines += ['banking_operations_total{method="%s"} %d' % (method, h.count) for method, h in latency]
+        lines += ["# HELP banking_operations_per_second Calls per second by method since the previous scrape.",
+                  "# TYPE banking_operations_per_second gauge"]
+        lines += ['banking_operations_per_second{method="%s"} %.3f' % (method, rate)
+                  for method, rate in sorted(metrics.rates(scraper).items())]
+        lines += ["# HELP banking_operation_duration_seconds Call latency by method.",
+                  "# TYPE banking_operation_duration_seconds histogram"]
+        for method, histogram in latency:
+            for bound, count in histogram.cumulative():
+                lines.append('banking_operation_duration_seconds_bucket{method="%s",le="%s"} %d' % (method, bound, count))
+            lines.append('banking_operation_duration_seconds_sum{method="%s"} %r' % (method, histogram.sum))
+            lines.append('banking_operation_duration_seconds_count{method="%s"} %d' % (method, histogram.count))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Local HTTP server answering `GET /metrics` with the exposition of
+    one engine, from a background thread.
+    """
+
+    def __init__(self, system, host: str = "127.0.0.1", port: int = 0):
+        """
+        Parameters
+        ----------
+        system: engine whose metrics are served
+        host: interface to listen on, local only by default
+        port: port to listen on; 0 picks a free one (see `url`)
+        """
+        self.system = system
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                url = urlsplit(handler.path)
+                if url.path != "/metrics":
+                    handler.send_error(404)
+                    return
+                #rates are per scraper: `?scraper=<name>`, else the client host
+                scraper = parse_qs(url.query).get("scraper", [handler.client_address[0]])[0]
+                body = exposition(system, scraper).encode()
+                handler.send_response(200)
+                handler.send_header("Content-Type", CONTENT_TYPE)
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return "http://%s:%d/metrics" % (host, port)
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
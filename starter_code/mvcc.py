@@ -0,0 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import multiprocessing
+import time
+
+
+def versioned(method):
+    """
+    Mark a `BankingSystemImpl` method as a write. The system's `version`
+    counter is odd while a write is in progress and moves to the next
+    even number when it completes; nested writes (e.g. settlement inside
+    a payment) count as part of the outer one.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.version & 1:
+            return method(self, *args, **kwargs)
+        self.version += 1
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.version += 1
+
+    return wrapper
+
+
+def consistent_read(system, read, *args):
+    """
+    Run `read(*args)` against `system` without
+    locking out its writer, seqlock style: the read is retried until it
+    starts and ends at the same even version, so its result is that of
+    a single version of the state. Errors raised while a write was
+    tearing the state are retried too; errors of a clean read propagate.
+    `read` must not write to the state, other than to caches that stay
+    valid under concurrent writes (see `BankingSystemImpl`).
+    """
+    while True:
+        version = system.version
+        if version & 1:
+            #let the writer finish its update
+            time.sleep(0)
+            continue
+        try:
+            result = read(*args)
+        except Exception:
+            if system.version == version:
+                raise
+            continue
+        if system.version == version:
+            return result
+
+
+#engine inherited by forked read workers; only set while forking
+pinned = None
+
+
+def pinned_reads(method: str, calls: list[tuple]) -> list:
+    #worker process: run reads against the engine copy pinned at fork time
+    read = getattr(pinned, method)
+    return [read(*args) for args in calls]
+
+
+class ReadPool:
+    """
+    Serves read calls (`get_balance`, `get_payment_status`,
+    `top_spenders`...) of one engine from several workers.
+
+    With `processes`, workers are forked processes, each holding a
+    copy-on-write snapshot of the engine pinned at `version` and
+    unaffected by later writes; `refresh` re-pins them. Otherwise
+    workers are threads reading the live engine with `consistent_read`
+    while writers keep going.
+    """
+
+    def __init__(self, system, workers: int = 4, processes: bool = True, chunk: int = 1024):
+        """
+        Parameters
+        ----------
+        system: engine to read from
+        workers: number of worker processes or threads
+        processes: fork worker processes instead of starting threads
+        chunk: number of calls sent to a worker at once
+        """
+        self.system = system
+        self.workers = workers
+        self.processes = processes
+        self.chunk = chunk
+        self.pool = None
+        self.version = None
+        self.refresh()
+
+    def refresh(self) -> None:
+        """
+        Restart the workers on the engine's current version.
+        """
+        global pinned
+        self.close()
+        if not self.processes:
+            self.pool = ThreadPoolExecutor(self.workers)
+            return
+        while self.system.version & 1:
+            time.sleep(0)
+        pinned = self.system
+        try:
+            self.pool = multiprocessing.get_context("fork").Pool(self.workers)
+        finally:
+            pinned = None
+        self.version = self.system.version
+
+    def map(self, method: str, calls: list[tuple]) -> list:
+        """
+        Results of `method(*args)` for every `args` in `calls`, in order.
+        """
+        chunks = [calls[i:i + self.chunk] for i in range(0, len(calls), self.chunk)]
+        if self.processes:
+            parts = self.pool.starmap(pinned_reads, [(method, part) for part in chunks])
+        else:
+            read = getattr(self.system, method)
+            parts = self.pool.map(lambda part: [consistent_read(self.system, read, *args) for args in part], chunks)
+        return [result for part in parts for result in part]
+
+    def close(self) -> None:
+        if self.pool is None:
+            return
+        if self.processes:
+            self.pool.terminate()
+            self.pool.join()
+        else:
+            self.pool.shutdown()
+        self.pool = None
@@ -0,0 +1,125 @@
+from array import array
+
+import numpy as np
+
+
+PREFIX = "payment"
+#bytes of the prefix, and the longest digit string that fits an int64
+PREFIX_CODES = np.frombuffer(PREFIX.encode(), dtype=np.uint8)
+MAX_DIGITS = 18
+
+
+def payment_number(payment) -> int | None:
+    """
+    Number named by the canonical payment id `payment` (`"payment7"` is
+    7), whether or not that payment exists, or `None` for any other value.
+    """
+    if not isinstance(payment, str) or not payment.startswith(PREFIX):
+        return None
+    digits = payment[len(PREFIX):]
+    #only the canonical spelling names a payment ("payment01" does not)
+    if not digits.isascii() or not digits.isdigit() or digits[0] == "0":
+        return None
+    return int(digits)
+
+
+class PaymentRegistry:
+    """
+    Registry of every payment, stored column-wise by payment number
+    (`"payment7"` is number 7): payer handle, CB_timestamp, CB_amount
+    and settled flag.
+
+    Recording or settling a payment writes into the columns and creates
+    no per-payment objects. Reads by payment id (`registry["payment7"]`,
+    `in`, iteration) go through a mapping interface that builds the
+    `(payer handle, CB_timestamp, CB_amount, CB_status)` tuple on demand.
+    """
+
+    def __init__(self):
+        self.owners = array("q")
+        self.due = array("q")
+        self.amounts = array("q")
+        self.settled = bytearray()
+
+    def __len__(self) -> int:
+        return len(self.owners)
+
+    def add(self, h: int, CB_timestamp: int, CB_amount: int) -> int:
+        """
+        Record an unsettled payment by handle `h`; returns its number.
+        """
+        self.owners.append(h)
+        self.due.append(CB_timestamp)
+        self.amounts.append(CB_amount)
+        self.settled.append(0)
+        return len(self.owners)
+
+    def number(self, payment) -> int | None:
+        """
+        Number of the payment with id `payment`, or `None` if there is
+        no such payment.
+        """
+        n = payment_number(payment)
+        return n if n is not None and n <= len(self.owners) else None
+
+    def numbers(self, payments: list) -> np.ndarray:
+        """
+        `number` of every id in `payments` as an int64 array, with 0 for
+        ids that name no payment. The ids are checked and parsed as one
+        array of bytes instead of one by one.
+        """
+        n = len(payments)
+        if not set(map(type, payments)) <= {str}:
+            return np.array([self.number(payment) or 0 for payment in payments], dtype=np.int64)
+        lengths = np.fromiter(map(len, payments), dtype=np.int64, count=n)
+        longest = len(PREFIX) + MAX_DIGITS
+        if n and lengths.max() > longest:
+            #longer ids can't be canonical; blank them to bound the array width
+            payments = [payment if len(payment) <= longest else "" for payment in payments]
+        try:
+            text = np.array(payments, dtype="S%d" % longest)
+        except UnicodeEncodeError:
+            #non-ascii ids are never canonical, but can't go in a bytes array
+            return np.array([self.number(payment) or 0 for payment in payments], dtype=np.int64)
+        codes = text.view(np.uint8).reshape(n, longest)
+        width = lengths - len(PREFIX)
+
+        #numpy drops trailing NULs, so also compare lengths
+        valid = (width > 0) & (width <= MAX_DIGITS) & (np.char.str_len(text) == lengths)
+        valid &= (codes[:, :len(PREFIX)] == PREFIX_CODES).all(axis=1)
+        #one row per digit position; bytes below "0" wrap around above 9
+        digits = np.ascontiguousarray((codes[:, len(PREFIX):] - ord("0")).T)
+        valid &= digits[0] != 0
+        #Horner's rule over the digit positions
+        values = np.zeros(n, dtype=np.int64)
+        for j, digit in enumerate(digits):
+            inside = j < width
+            valid &= ~inside | (digit <= 9)
+            values = np.where(inside, values * 10 + digit, values)
+        valid &= values <= len(self.owners)
+        return np.where(valid, values, 0)
+
+    def entry(self, n: int) -> tuple[int, int, int, bool]:
+        i = n - 1
+        return self.owners[i], self.due[i], self.amounts[i], bool(self.settled[i])
+
+    def __contains__(self, payment) -> bool:
+        return self.number(payment) is not None
+
+    def __getitem__(self, payment: str) -> tuple[int, int, int, bool]:
+        n = self.number(payment)
+        if n is None:
+            raise KeyError(payment)
+        return self.entry(n)
+
+    def get(self, payment: str, default=None):
+        n = self.number(payment)
+        return default if n is None else self.entry(n)
+
+    def __iter__(self):
+        for n in range(1, len(self.owners) + 1):
+            yield "payment" + str(n)
+
+    def items(self):
+        for n in range(1, len(self.owners) + 1):
+            yield "payment" + str(n), self.entry(n)
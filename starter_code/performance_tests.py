@@ -0,0 +1,236 @@
+"""
+Performance regression tests: the level 1-4 scenarios scaled to
+10^4 - 10^6 operations.
+
+Every test runs a scenario against a small and a 10 times larger state
+and checks that the cost per call grows slowly (a linear scan would grow
+10 times, a quadratic one 100 times), then compares the per-call cost
+on the larger state with the recorded baseline in
+`performance_baseline.json`, recorded at the same size. Costs are
+recorded in units of a fixed pure-Python calibration workload so
+baselines carry across machines.
+
+The larger size is `PERFORMANCE_OPS` (100000 by default; 1000000 for
+the full tier). After an intended change, re-record the baselines of a
+size with `PERFORMANCE_OPS=<size> python3 performance_tests.py --record`;
+sizes without a baseline only check growth, with a warning.
+"""
+import itertools
+import json
+import os
+import random
+import sys
+import unittest
+import warnings
+
+from banking_system_impl import BankingSystemImpl
+from benchmarks import make_trace, replay, timed
+
+
+LARGE = int(os.environ.get("PERFORMANCE_OPS", 100000))
+SMALL = LARGE // 10
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "performance_baseline.json")
+#a call may cost this many times its baseline before the test fails
+TOLERANCE = 3.0
+ATTEMPTS = 3
+#ms between a payment and its cashback
+DAY = 86400000
+
+
+def calibrate() -> float:
+    """
+    Best seconds of a fixed pure-Python workload (dict updates in a
+    loop), the unit of recorded costs.
+    """
+    def work():
+        counts = {}
+        for i in range(200000):
+            counts[i & 1023] = counts.get(i & 1023, 0) + i
+
+    return timed(work, repeat=5)
+
+
+def load_baselines() -> dict[str, dict[str, float]]:
+    """
+    Recorded costs by scenario, by `LARGE` size (as a string key).
+    """
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE) as f:
+        return json.load(f)["costs"]
+
+
+def funded(n_accounts: int) -> BankingSystemImpl:
+    system = BankingSystemImpl()
+    for i in range(n_accounts):
+        system.create_account(i, "account%d" % i)
+        system.deposit(i, "account%d" % i, 10 ** 12)
+    return system
+
+
+class PerformanceTests(unittest.TestCase):
+
+    failureException = Exception
+
+    #scenario -> cost per call on the larger state, in calibration units
+    measured = {}
+    #set by `--record` to skip the baseline comparison
+    recording = False
+
+    @classmethod
+    def setUpClass(cls):
+        cls.unit = calibrate()
+        cls.baseline = load_baselines().get(str(LARGE), {})
+        if not cls.baseline and not cls.recording:
+            warnings.warn("no performance baseline recorded at %d operations; only growth is checked" % LARGE)
+
+    def check(self, name: str, per_call, max_growth: float) -> None:
+        """
+        Assert that the cost per call `per_call(n)` of scenario `name`
+        grows at most `max_growth` times from the small to the large
+        state and stays within `TOLERANCE` of its baseline. A failing
+        scenario is measured again up to `ATTEMPTS` times, so that only
+        slowdowns that persist fail.
+        """
+        baseline = None if self.recording else self.baseline.get(name)
+        for attempt in range(ATTEMPTS):
+            small, large = per_call(SMALL), per_call(LARGE)
+            cost = large / self.unit
+            if large / small < max_growth and (baseline is None or cost < baseline * TOLERANCE):
+                break
+        self.measured[name] = cost
+        self.assertLess(large / small, max_growth,
+                        "%s: %.3g s per call at %d, %.3g s at %d" % (name, small, SMALL, large, LARGE))
+        if baseline is not None:
+            self.assertLess(cost, baseline * TOLERANCE,
+                            "%s: %.3g units per call, baseline %.3g" % (name, cost, baseline))
+
+    def test_level_1_deposit_and_transfer_do_not_grow_with_accounts(self):
+        def per_call(n):
+            rng = random.Random(0)
+            picks = [("account%d" % rng.randrange(n), "account%d" % rng.randrange(n)) for _ in range(SMALL)]
+            system = funded(n)
+            clock = itertools.count(n)
+
+            def run():
+                for (a, b), t in zip(picks, clock):
+                    system.deposit(t, a, 10)
+                    system.transfer(t, a, b, 5)
+
+            return timed(run) / (2 * len(picks))
+
+        self.check("deposit_transfer", per_call, 2.0)
+
+    def test_level_2_top_spenders_does_not_rescan_accounts(self):
+        def per_call(n):
+            rng = random.Random(0)
+            amounts = [rng.randint(1, 10 ** 6) for _ in range(n)]
+            picks = [("account%d" % rng.randrange(n), "account%d" % rng.randrange(n), rng.randint(1, 10 ** 6))
+                     for _ in range(2000)]
+
+            system = funded(n)
+            for i, amount in enumerate(amounts):
+                system.pay(n + i, "account%d" % i, amount)
+            system.top_spenders(2 * n, 10)
+            clock = itertools.count(2 * n)
+
+            def run():
+                for (a, b, amount), t in zip(picks, clock):
+                    system.transfer(t, a, b, amount)
+                    system.top_spenders(t, 10)
+
+            return timed(run) / len(picks)
+
+        self.check("top_spenders", per_call, 2.0)
+
+    def test_level_3_cashback_does_not_grow_with_settled_payments(self):
+        def per_call(n):
+            system = funded(1000)
+            for i in range(n):
+                system.pay(1000 + i, "account%d" % (i % 1000), 100)
+            clock = [1000 + n + DAY]
+
+            def run():
+                #settle every refund scheduled so far, then schedule SMALL more
+                t = clock[0]
+                system.deposit(t, "account0", 1)
+                for i in range(SMALL):
+                    system.pay(t + i, "account%d" % (i % 1000), 100)
+                system.get_payment_status(t + SMALL, "account0", "payment1")
+                clock[0] = t + SMALL + DAY
+
+            run()
+            return timed(run) / SMALL
+
+        self.check("pay_and_cashback", per_call, 2.0)
+
+    def test_level_4_get_balance_does_not_scan_history(self):
+        def per_call(n):
+            rng = random.Random(0)
+            queries = [rng.randrange(1, n + 1) for _ in range(SMALL)]
+
+            system = BankingSystemImpl()
+            system.create_account(0, "account0")
+            for t in range(1, n + 1):
+                system.deposit(t, "account0", 1)
+
+            def run():
+                for time_at in queries:
+                    system.get_balance(n + 1, "account0", time_at)
+
+            return timed(run) / len(queries)
+
+        self.check("get_balance", per_call, 2.0)
+
+    def test_level_4_merge_does_not_copy_history(self):
+        def per_call(n):
+            def setup():
+                system = BankingSystemImpl()
+                for i in range(2000):
+                    system.create_account(i, "account%d" % i)
+                t = 2000
+                for i in range(n):
+                    t += 1
+                    system.deposit(t, "account%d" % (i % 2000), 1)
+                return system
+
+            def run(system):
+                t = 2000 + n
+                for i in range(0, 2000, 2):
+                    t += 1
+                    system.merge_accounts(t, "account%d" % i, "account%d" % (i + 1))
+                    system.get_balance(t, "account%d" % i, 2000 + i)
+
+            return timed(run, setup) / 1000
+
+        self.check("merge_accounts", per_call, 2.0)
+
+    def test_mixed_trace_cost_per_call_stays_flat(self):
+        def per_call(n):
+            trace = make_trace(n, 1000)
+            return timed(lambda system: replay(system, trace), BankingSystemImpl, repeat=1) / len(trace)
+
+        self.check("mixed_trace", per_call, 2.5)
+
+
+def record() -> None:
+    """
+    Run the tests without the baseline comparison and store the measured
+    costs as the new baseline of size `LARGE`, keeping those of other sizes.
+    """
+    PerformanceTests.recording = True
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(PerformanceTests)
+    if not unittest.TextTestRunner(verbosity=2).run(suite).wasSuccessful():
+        sys.exit(1)
+    baselines = load_baselines()
+    baselines[str(LARGE)] = PerformanceTests.measured
+    with open(BASELINE_FILE, "w") as f:
+        json.dump({"costs": baselines}, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--record"]:
+        record()
+    else:
+        unittest.main()
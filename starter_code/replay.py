@@ -0,0 +1,474 @@
+from array import array
+import gc
+import heapq
+import multiprocessing
+
+import numpy as np
+
+from banking_system_impl import BankingSystemImpl
+from ledger import CASHBACK, PAYMENT, Ledger
+from payment_registry import payment_number
+
+
+#methods a trace may call, with the positions of their account id arguments;
+#top_spenders reads every account and is answered while merging a window
+ACCOUNT_ARGS = {
+    "create_account": (1,),
+    "deposit": (1,),
+    "transfer": (1, 2),
+    "pay": (1,),
+    "get_balance": (1,),
+    "get_payment_status": (1,),
+    "merge_accounts": (1, 2),
+    "top_spenders": (),
+}
+
+def components(trace: list[tuple], start: int, end: int) -> list[list[int]]:
+    """
+    Indices of the calls of `trace[start:end]` grouped by connected
+    component of the accounts they name, linked by transfers and merges,
+    in trace order. `top_spenders` calls belong to no component.
+    """
+    #union-find over the accounts of transfers and merges only
+    parent = {}
+
+    def find(account_id):
+        while parent[account_id] != account_id:
+            parent[account_id] = account_id = parent[parent[account_id]]
+        return account_id
+
+    for i in range(start, end):
+        method, args = trace[i]
+        if len(ACCOUNT_ARGS[method]) == 2:
+            a, b = args[1], args[2]
+            parent.setdefault(a, a)
+            parent.setdefault(b, b)
+            a, b = find(a), find(b)
+            if a != b:
+                parent[b] = a
+
+    groups = {}
+    for i in range(start, end):
+        method, args = trace[i]
+        if method == "top_spenders":
+            continue
+        account_id = args[1]
+        groups.setdefault(find(account_id) if account_id in parent else account_id, []).append(i)
+    return list(groups.values())
+
+
+def replay_part(connection, system: BankingSystemImpl, trace: list[tuple], indices: list[int]) -> None:
+    """
+    Worker process: replay the calls `indices` of the trace on the forked
+    copy of `system`, in two rounds over `connection`.
+
+    The first reply holds the results and what the parent orders across
+    parts: creations, outgoing totals, merges and payments, by call
+    index. The parent answers with the handles and payment numbers it
+    assigned to the accounts and payments created here; they are
+    renumbered in place, and the accounts written (balance, history,
+    ledger, payment numbers) and new payments are sent back.
+    """
+    ids, names, pay_log = system.ids, system.names, system.pay_log
+    histories, ledgers, payments, balances = system.histories, system.ledgers, system.payments, system.balances
+    first, paid = len(names), len(pay_log)
+    history_points, pending_cashback = system.history_points, system.pending_cashback
+
+    #live accounts the part may write
+    roots = {}
+    for i in indices:
+        method, args = trace[i]
+        for position in ACCOUNT_ARGS[method]:
+            h = ids.get(args[position])
+            if h is not None:
+                roots[h] = None
+    #(balance, history size and last balance, ledger rows, payments) of each at the start
+    marks = {}
+    records = {}
+    pending = []
+    settled = pay_log.settled
+    for root in roots:
+        history, ledger, numbers = histories[root], ledgers[root], payments[root]
+        marks[root] = (balances[root], None if history is None else (len(history), history.last_balance),
+                       0 if ledger is None else len(ledger), 0 if numbers is None else len(numbers))
+        for h in system.merged_handles(root) if root in system.merged_from else (root,):
+            if h in system.archive:
+                records[h] = system.archive.records[h]
+            numbers = system.payment_numbers(h)
+            #refunds of a payer are settled in payment order
+            k = len(numbers)
+            while k and not settled[numbers[k - 1] - 1]:
+                k -= 1
+            pending.extend(numbers[k:])
+
+    #only the refunds of these accounts can come due in this part
+    scheduler = system.scheduler = type(system.scheduler)()
+    for number in sorted(pending):
+        scheduler.schedule(pay_log.due[number - 1], number)
+
+    results = []
+    creations, spends, merges, pays, deferred = [], [], [], [], []
+    for i in indices:
+        method, args = trace[i]
+        if method == "get_payment_status":
+            h = ids.get(args[1])
+            number = payment_number(args[2])
+            if h is not None and number is not None and number > paid:
+                #payments of this window are numbered by the parent
+                deferred.append((i, h, number))
+                results.append(None)
+                continue
+        elif method == "transfer" or method == "pay":
+            payer = ids.get(args[1])
+        elif method == "merge_accounts":
+            merged = (ids.get(args[1]), ids.get(args[2]))
+        result = getattr(system, method)(*args)
+        results.append(result)
+        if result is None or result is False:
+            continue
+        if method == "create_account":
+            creations.append(i)
+        elif method == "transfer":
+            spends.append((i, payer, args[3]))
+        elif method == "pay":
+            spends.append((i, payer, args[2]))
+            pays.append(i)
+        elif method == "merge_accounts":
+            merges.append((i, *merged))
+
+    connection.send({
+        "results": results,
+        "creations": creations,
+        "spends": spends,
+        "merges": merges,
+        "pays": pays,
+        "deferred": deferred,
+        "refunded": [number for number in pending if settled[number - 1]],
+        #creation points are counted again when the parent creates the accounts
+        "history_points": system.history_points - history_points - len(creations),
+        "pending_cashback": system.pending_cashback - pending_cashback,
+        "clock": system.clock,
+    })
+    handles, numbers = connection.recv()
+
+    #histories go whole; ledger rows and payment numbers added here go as
+    #one set of columns, with the count of each account
+    written, logged_rows, paid_rows = [], array("q"), array("q")
+    tail = Ledger()
+    numbered_tail = array("q")
+    for h in [*roots, *range(first, len(names))]:
+        history, ledger, paid_numbers = histories[h], ledgers[h], payments[h]
+        if history is None:
+            continue
+        logged = numbered = 0
+        mark = marks.get(h)
+        if mark is not None:
+            logged, numbered = mark[2], mark[3]
+            if mark == (balances[h], (len(history), history.last_balance), len(ledger) if ledger else 0,
+                        len(paid_numbers)):
+                #only read
+                continue
+        if ledger is not None:
+            #counterparts are payment numbers or account handles
+            kinds, counterparts = ledger.kinds, ledger.counterparts
+            for j in range(logged, len(counterparts)):
+                counterpart = counterparts[j]
+                if kinds[j] == PAYMENT or kinds[j] == CASHBACK:
+                    if counterpart > paid:
+                        counterparts[j] = numbers[counterpart - paid - 1]
+                elif counterpart >= first:
+                    counterparts[j] = handles[counterpart - first]
+            tail.timestamps.extend(ledger.timestamps[logged:])
+            tail.kinds.extend(kinds[logged:])
+            tail.amounts.extend(ledger.amounts[logged:])
+            tail.counterparts.extend(counterparts[logged:])
+        for j in range(numbered, len(paid_numbers)):
+            if paid_numbers[j] > paid:
+                paid_numbers[j] = numbers[paid_numbers[j] - paid - 1]
+        numbered_tail.extend(paid_numbers[numbered:])
+        written.append(h)
+        logged_rows.append(0 if ledger is None else len(ledger) - logged)
+        paid_rows.append(len(paid_numbers) - numbered)
+
+    owners = array("q", (h if h < first else handles[h - first] for h in pay_log.owners[paid:]))
+    connection.send({
+        "handles": [h if h < first else handles[h - first] for h in written],
+        "balances": array("q", (balances[h] for h in written)),
+        "histories": [histories[h] for h in written],
+        "ledger_rows": logged_rows,
+        "ledger": tail,
+        "payment_rows": paid_rows,
+        "payments": numbered_tail,
+        #refunds settled into accounts that stay archived
+        "archived": [(h, system.archive.records[h]) for h, record in records.items()
+                     if system.archive.records.get(h, record) is not record],
+        "registry": (owners, pay_log.due[paid:], pay_log.amounts[paid:], bytes(settled[paid:])),
+    })
+    connection.close()
+
+
+#helper function for merges replayed in a worker
+def fold(system: BankingSystemImpl, timestamp: int, h1: int, h2: int) -> None:
+    """
+    The lineage and ranking half of `absorb`: balances and the merge's
+    ledger event come with the changes of the part that made the merge.
+    """
+    system.merged_from.setdefault(h1, []).append(h2)
+    system.outgoing[h1] += system.outgoing[h2]
+    system.mark_dirty(h1)
+    system.mark_dirty(h2)
+    system.merged_into[h2] = h1
+    system.merged_at[h2] = timestamp
+    system.alias[h2] = h1
+    system.merged_accounts += 1
+    account_id_2 = system.names[h2]
+    del system.ids[account_id_2]
+    system.retired[account_id_2] = h2
+    system.live[h2] = 0
+
+
+def replay_window(system: BankingSystemImpl, trace: list[tuple], results: list, start: int, end: int,
+                  parts: list[list[int]], meanwhile=None):
+    """
+    Replay the window `trace[start:end]`, split into independent `parts`,
+    with one forked worker per part, and merge their changes into
+    `system` and `results` so that both end up as if the window had been
+    replayed sequentially.
+
+    Accounts and payments created in the window get their handles and
+    numbers in trace order. Creations, outgoing totals and merges are
+    swept in trace order with the window's `top_spenders` calls while
+    the workers renumber; status checks of payments made in the window
+    are answered as of their call.
+
+    Returns the result of `meanwhile()`, called while the workers
+    replay (to partition the next window).
+    """
+    first, paid = len(system.names), len(system.pay_log)
+    context = multiprocessing.get_context("fork")
+    connections, processes = [], []
+    #keep the engine out of the workers' garbage collections, which would
+    #otherwise touch (and so copy) every page of it; `run` unfreezes
+    gc.freeze()
+    try:
+        for part in parts:
+            connection, child = context.Pipe()
+            process = context.Process(target=replay_part, args=(child, system, trace, part), daemon=True)
+            process.start()
+            child.close()
+            connections.append(connection)
+            processes.append(process)
+
+        upcoming = meanwhile() if meanwhile is not None else None
+        summaries = [connection.recv() for connection in connections]
+        created = sorted((i, k) for k, summary in enumerate(summaries) for i in summary["creations"])
+        handles = [[] for _ in parts]
+        for g, (_, k) in enumerate(created, first):
+            handles[k].append(g)
+        made = sorted((i, k) for k, summary in enumerate(summaries) for i in summary["pays"])
+        numbers = [[] for _ in parts]
+        for number, (i, k) in enumerate(made, paid + 1):
+            numbers[k].append(number)
+            results[i] = "payment" + str(number)
+        for connection, mapping in zip(connections, zip(handles, numbers)):
+            connection.send(mapping)
+
+        events = [(i, "top_spenders", None, None) for i in range(start, end) if trace[i][0] == "top_spenders"]
+        merge_calls = {}
+        for part, summary, new in zip(parts, summaries, handles):
+            for i, result in zip(part, summary["results"]):
+                if trace[i][0] != "pay":
+                    results[i] = result
+            events += [(i, "create", None, None) for i in summary["creations"]]
+            events += [(i, "spend", h if h < first else new[h - first], amount) for i, h, amount in summary["spends"]]
+            for i, h1, h2 in summary["merges"]:
+                h1, h2 = (h if h < first else new[h - first] for h in (h1, h2))
+                events.append((i, "merge", h1, h2))
+                merge_calls[h2] = i
+        events.sort()
+        for i, kind, a, b in events:
+            args = trace[i][1]
+            if kind == "create":
+                system.create_account(*args)
+            elif kind == "spend":
+                system.outgoing[a] += b
+                system.mark_dirty(a)
+            elif kind == "merge":
+                fold(system, args[0], a, b)
+            else:
+                results[i] = system.top_spenders(*args)
+
+        changes = [connection.recv() for connection in connections]
+    finally:
+        for connection in connections:
+            connection.close()
+        for process in processes:
+            process.join()
+
+    pay_log = system.pay_log
+    for change in changes:
+        tail, paid_numbers = change["ledger"], change["payments"]
+        row = j = 0
+        for g, balance, history, logged, numbered in zip(change["handles"], change["balances"], change["histories"],
+                                                         change["ledger_rows"], change["payment_rows"]):
+            if system.histories[g] is None:
+                #first write to the account, or restored from the archive
+                system.archive.records.pop(g, None)
+                system.payments[g] = array("q")
+            system.balances[g] = balance
+            system.histories[g] = history
+            if logged:
+                ledger = system.ledgers[g]
+                if ledger is None:
+                    ledger = system.ledgers[g] = Ledger()
+                ledger.timestamps.extend(tail.timestamps[row:row + logged])
+                ledger.kinds.extend(tail.kinds[row:row + logged])
+                ledger.amounts.extend(tail.amounts[row:row + logged])
+                ledger.counterparts.extend(tail.counterparts[row:row + logged])
+                row += logged
+            if numbered:
+                system.payments[g].extend(paid_numbers[j:j + numbered])
+                j += numbered
+        for h, record in change["archived"]:
+            system.archive.records[h] = record
+
+    columns = [np.zeros(len(made), dtype=np.int64) for _ in range(3)] + [np.zeros(len(made), dtype=np.uint8)]
+    for summary, change, assigned in zip(summaries, changes, numbers):
+        if assigned:
+            rows = np.array(assigned, dtype=np.int64) - paid - 1
+            for column, values in zip(columns, change["registry"]):
+                column[rows] = np.frombuffer(values, dtype=column.dtype)
+        for number in summary["refunded"]:
+            pay_log.settled[number - 1] = 1
+        system.history_points += summary["history_points"]
+        system.pending_cashback += summary["pending_cashback"]
+    pay_log.owners.frombytes(columns[0].tobytes())
+    pay_log.due.frombytes(columns[1].tobytes())
+    pay_log.amounts.frombytes(columns[2].tobytes())
+    pay_log.settled.extend(columns[3].tobytes())
+
+    #requeue what is still pending in payment order, then settle up to the
+    #clock the sequential replay would have reached
+    scheduler = system.scheduler = type(system.scheduler)()
+    for number in (np.flatnonzero(np.frombuffer(pay_log.settled, dtype=np.uint8) == 0) + 1).tolist():
+        scheduler.schedule(pay_log.due[number - 1], number)
+    system.advance_time(max(summary["clock"] for summary in summaries))
+
+    made = [i for i, _ in made]
+    for summary, new in zip(summaries, handles):
+        for i, h, number in summary["deferred"]:
+            h = h if h < first else new[h - first]
+            results[i] = payment_status(system, trace[i][1][0], h, number, i, made, paid, merge_calls)
+    return upcoming
+
+
+def payment_status(system: BankingSystemImpl, timestamp: int, h: int, number: int, i: int,
+                   made: list[int], paid: int, merge_calls: dict) -> str | None:
+    """
+    `get_payment_status_h` of payment `number`, made in the current
+    window, as of call `i`: the payment must have been made before the
+    call, by `h` or by an account merged into `h` before the call.
+
+    Parameters
+    ----------
+    made: index of the call that made each payment of the window
+    paid: number of payments before the window
+    merge_calls: index of the call that merged each account away in the window
+    """
+    if number > paid + len(made) or made[number - paid - 1] > i:
+        return None
+    pay_log = system.pay_log
+    owner = pay_log.owners[number - 1]
+    while owner != h:
+        parent = system.merged_into[owner]
+        if parent < 0 or merge_calls.get(owner, -1) > i:
+            return None
+        owner = parent
+    return "IN_PROGRESS" if timestamp < pay_log.due[number - 1] else "CASHBACK_RECEIVED"
+
+
+class ParallelReplay:
+    """
+    Rebuilds engine state from a trace of `(method name, args)` calls
+    with the same results and final state as calling them one by one.
+
+    The trace is cut into windows of `window` calls. Within a window,
+    calls are grouped by connected component of the accounts they name
+    (transfers and merges link accounts); components share no account,
+    so they are packed into up to `workers` parts and replayed by forked
+    processes, each on a copy-on-write snapshot of the engine at the
+    start of the window. Their changes are merged back before the next
+    window. Smaller windows split into more components, larger ones pay
+    the fork and merge cost less often; a window that forms a single
+    part is replayed in place.
+
+    Accounts and payments are numbered in trace order, the global reads
+    (`top_spenders`) are answered while merging and the settlement clock
+    ends where sequential replay leaves it, so the engine (handles,
+    payment ids, histories, ledgers, registry) is identical. Supported
+    calls are those in `ACCOUNT_ARGS`.
+    """
+
+    def __init__(self, workers: int = 4, window: int = 100000):
+        """
+        Parameters
+        ----------
+        workers: number of worker processes per window
+        window: number of trace calls partitioned at once
+        """
+        self.workers = workers
+        self.window = window
+
+    def partition(self, groups: list[list[int]]) -> list[list[int]]:
+        """
+        Pack components into at most `workers` parts of similar size,
+        largest first; every part lists its calls in trace order.
+        """
+        loads = [(0, k) for k in range(self.workers)]
+        parts = [[] for _ in range(self.workers)]
+        for group in sorted(groups, key=len, reverse=True):
+            load, k = heapq.heappop(loads)
+            parts[k].extend(group)
+            heapq.heappush(loads, (load + len(group), k))
+        return [sorted(part) for part in parts if part]
+
+    def run(self, trace: list[tuple], system: BankingSystemImpl | None = None) -> tuple[BankingSystemImpl, list]:
+        """
+        Replay `trace` onto `system` (a new engine by default); returns
+        the engine and every call's result.
+        """
+        if system is None:
+            system = BankingSystemImpl()
+        for method, _ in trace:
+            if method not in ACCOUNT_ARGS:
+                raise ValueError("parallel replay does not support %r calls" % method)
+        #workers can't share the cold tier files or the sketch, and handle-based
+        #cashback rates must not reach the accounts created by the replay
+        if system.history_store is not None or system.heavy_hitters is not None:
+            raise ValueError("parallel replay needs an engine without cold history tier or heavy hitters")
+        if len(getattr(system.cashback_policy, "account_rates", ())) > len(system.names):
+            raise ValueError("cashback policy rates accounts that don't exist yet")
+
+        results = [None] * len(trace)
+
+        def partition(start):
+            if self.workers < 2:
+                return []
+            return self.partition(components(trace, start, min(start + self.window, len(trace))))
+
+        #objects of earlier windows stay frozen, out of the garbage collections
+        #of the parent as well
+        try:
+            parts = partition(0)
+            for start in range(0, len(trace), self.window):
+                end = min(start + self.window, len(trace))
+                if len(parts) > 1:
+                    parts = replay_window(system, trace, results, start, end, parts, lambda: partition(end))
+                    continue
+                for i in range(start, end):
+                    method, args = trace[i]
+                    results[i] = getattr(system, method)(*args)
+                parts = partition(end)
+        finally:
+            gc.unfreeze()
+        return system, results
@@ -0,0 +1,323 @@
+from collections import deque
+import struct
+import threading
+import time
+
+from banking_system_impl import BankingSystemImpl
+
+
+#record header: payload size, sequence number, publish time (ms), op code;
+#the sequence number is the primary's latest when the record is published
+RECORD_HEADER = struct.Struct("<IQqB")
+INT = struct.Struct("<q")
+LENGTH = struct.Struct("<I")
+
+#replicated calls and their argument types: q int, s account id, b bool,
+#S list of account ids, P list of account id pairs; HEARTBEAT carries no call
+HEARTBEAT = 0
+OPS = (None, "advance_time", "create_account", "deposit", "transfer", "pay", "merge_accounts", "merge_many",
+       "close_account", "create_accounts")
+SIGNATURES = {
+    "advance_time": "q",
+    "create_account": "qs",
+    "deposit": "qsq",
+    "transfer": "qssq",
+    "pay": "qsqq",
+    "merge_accounts": "qss",
+    "merge_many": "qPb",
+    "close_account": "qs",
+    "create_accounts": "qS",
+}
+#trailing optional arguments filled in before encoding
+DEFAULTS = {"pay": (0,), "merge_many": (False,)}
+OP_CODES = {method: code for code, method in enumerate(OPS) if method is not None}
+
+
+class StaleReplicaError(RuntimeError):
+    """
+    A replica is further behind the primary than a read allows.
+    """
+
+
+def encode_args(signature: str, args: tuple) -> bytes:
+    out = bytearray()
+    for kind, value in zip(signature, args):
+        if kind == "s":
+            text = value.encode()
+            out += LENGTH.pack(len(text))
+            out += text
+        elif kind == "S":
+            out += LENGTH.pack(len(value))
+            out += encode_args("s" * len(value), value)
+        elif kind == "P":
+            out += LENGTH.pack(len(value))
+            for pair in value:
+                out += encode_args("ss", pair)
+        else:
+            out += INT.pack(value)
+    return bytes(out)
+
+
+def decode_args(signature: str, payload: bytes, offset: int = 0) -> tuple[tuple, int]:
+    args = []
+    for kind in signature:
+        if kind == "s":
+            size = LENGTH.unpack_from(payload, offset)[0]
+            offset += LENGTH.size
+            args.append(payload[offset:offset + size].decode())
+            offset += size
+        elif kind == "S":
+            count = LENGTH.unpack_from(payload, offset)[0]
+            offset += LENGTH.size
+            account_ids, offset = decode_args("s" * count, payload, offset)
+            args.append(list(account_ids))
+        elif kind == "P":
+            count = LENGTH.unpack_from(payload, offset)[0]
+            offset += LENGTH.size
+            pairs = []
+            for _ in range(count):
+                pair, offset = decode_args("ss", payload, offset)
+                pairs.append(pair)
+            args.append(pairs)
+        else:
+            value = INT.unpack_from(payload, offset)[0]
+            args.append(bool(value) if kind == "b" else value)
+            offset += INT.size
+    return tuple(args), offset
+
+
+class Primary:
+    """
+    Writable engine that publishes every applied mutation as a compact
+    binary change stream to its replicas.
+
+    Calls are `(method name, args)` events as in `ReorderBuffer`. Each
+    mutation is framed as a record (size, sequence number, publish time
+    in ms, op code, arguments) and written to every sink (binary
+    file-like objects: pipe ends, `socket.makefile("wb")`, files). The
+    engine is deterministic, so a replica replaying the records reaches
+    the same state.
+    """
+
+    def __init__(self, system: BankingSystemImpl | None = None, sinks=()):
+        """
+        Parameters
+        ----------
+        system: engine receiving the writes; a new one by default
+        sinks: writable binary streams the records are sent to
+        """
+        self.system = system if system is not None else BankingSystemImpl()
+        self.sinks = list(sinks)
+        self.seq = 0
+        self.bytes_sent = 0
+
+    def _publish(self, op: int, payload: bytes) -> None:
+        self.seq += 1
+        record = RECORD_HEADER.pack(len(payload), self.seq, int(time.time() * 1000), op) + payload
+        for sink in self.sinks:
+            sink.write(record)
+            sink.flush()
+        self.bytes_sent += len(record)
+
+    def apply(self, method: str, args: tuple):
+        """
+        Run `method(*args)` on the primary engine, publish it if it
+        changes state, and return its result.
+        """
+        result = getattr(self.system, method)(*args)
+        signature = SIGNATURES.get(method)
+        if signature is not None:
+            missing = len(signature) - len(args)
+            if missing:
+                args = tuple(args) + DEFAULTS[method][-missing:]
+            self._publish(OP_CODES[method], encode_args(signature, args))
+        return result
+
+    def heartbeat(self) -> None:
+        """
+        Publish an empty record so idle replicas can tell they are
+        current.
+        """
+        self._publish(HEARTBEAT, b"")
+
+
+class Replica:
+    """
+    Read-only engine kept up to date from a `Primary`'s change stream.
+
+    Records are received from the stream into a queue and applied in
+    order by `apply_next`, or continuously by background receiving and
+    applying threads (`start`/`stop`); reads and applies share `lock`.
+    Lag is tracked in ms (`lag_ms`, `last_apply_lag_ms`,
+    `max_apply_lag_ms`) and in records (`lag_events`,
+    `last_apply_lag_events`, `max_apply_lag_events`), the latter against
+    the primary's latest sequence number seen in records and heartbeats.
+    Reads accept an optional staleness bound: `max_lag_ms` on the age of
+    the last applied record and `min_seq` for reading one's own writes.
+    """
+
+    def __init__(self, source, system: BankingSystemImpl | None = None, lock=None, max_pending: int = 4096):
+        """
+        Parameters
+        ----------
+        source: readable binary stream carrying the primary's records
+        system: engine the records are applied to; a new one by default
+        lock: lock shared by the applying thread and readers
+        max_pending: number of received records the receiving thread
+        queues ahead of the applying thread
+        """
+        self.source = source
+        self.system = system if system is not None else BankingSystemImpl()
+        self.lock = lock if lock is not None else threading.Lock()
+        self.max_pending = max_pending
+        self.applied_seq = 0
+        #latest sequence number of the primary seen in the stream
+        self.primary_seq = 0
+        #publish time (ms) of the last applied record
+        self.published_ms = None
+        #delay between publishing and applying a record
+        self.last_apply_lag_ms = 0
+        self.max_apply_lag_ms = 0
+        #records received but not applied when a record is applied
+        self.last_apply_lag_events = 0
+        self.max_apply_lag_events = 0
+        self.applied_bytes = 0
+        self.caught_up = threading.Condition(self.lock)
+        #received records (seq, publish time, op code, payload, size) not applied yet
+        self.pending = deque()
+        self.arrived = threading.Condition()
+        self.ended = False
+        self.threads = []
+
+    def receive(self) -> bool:
+        """
+        Read one record from the stream into the apply queue and note
+        the primary's sequence number; `False` at the end of the stream.
+        """
+        header = self.source.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return False
+        size, seq, published_ms, op = RECORD_HEADER.unpack(header)
+        payload = self.source.read(size)
+        with self.arrived:
+            self.pending.append((seq, published_ms, op, payload, RECORD_HEADER.size + size))
+            if seq > self.primary_seq:
+                self.primary_seq = seq
+            self.arrived.notify_all()
+        return True
+
+    def apply_next(self) -> bool:
+        """
+        Apply the oldest received record, reading one from the stream
+        first if none is queued; `False` at the end of the stream.
+        """
+        if not self.pending and not self.receive():
+            return False
+        with self.arrived:
+            seq, published_ms, op, payload, size = self.pending.popleft()
+            self.arrived.notify_all()
+        with self.lock:
+            method = OPS[op]
+            if method is not None:
+                args, _ = decode_args(SIGNATURES[method], payload)
+                getattr(self.system, method)(*args)
+            self.applied_seq = seq
+            self.published_ms = published_ms
+            self.applied_bytes += size
+            lag = int(time.time() * 1000) - published_ms
+            self.last_apply_lag_ms = lag
+            if lag > self.max_apply_lag_ms:
+                self.max_apply_lag_ms = lag
+            behind = self.primary_seq - seq
+            self.last_apply_lag_events = behind
+            if behind > self.max_apply_lag_events:
+                self.max_apply_lag_events = behind
+            self.caught_up.notify_all()
+        return True
+
+    def _receive_all(self) -> None:
+        while True:
+            with self.arrived:
+                self.arrived.wait_for(lambda: len(self.pending) < self.max_pending)
+            if not self.receive():
+                break
+        with self.arrived:
+            self.ended = True
+            self.arrived.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            with self.arrived:
+                self.arrived.wait_for(lambda: self.pending or self.ended)
+                if not self.pending:
+                    return
+            self.apply_next()
+
+    def start(self) -> None:
+        self.ended = False
+        self.threads = [threading.Thread(target=self._receive_all, name="replica-receive", daemon=True),
+                        threading.Thread(target=self._run, name="replica", daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self) -> None:
+        """
+        Wait for the receiving and applying threads, which end with the
+        stream.
+        """
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def lag_events(self) -> int:
+        """
+        Number of records the primary has published, as far as the
+        stream has been received, that are not applied yet.
+        """
+        return self.primary_seq - self.applied_seq
+
+    def lag_ms(self) -> int | None:
+        """
+        Age of the last applied record, or `None` before the first one.
+        With regular heartbeats this bounds how stale reads are.
+        """
+        if self.published_ms is None:
+            return None
+        return int(time.time() * 1000) - self.published_ms
+
+    def _check(self, max_lag_ms: int | None, min_seq: int | None, timeout: float) -> None:
+        #caller holds the lock
+        if min_seq is not None and self.applied_seq < min_seq:
+            self.caught_up.wait_for(lambda: self.applied_seq >= min_seq, timeout)
+            if self.applied_seq < min_seq:
+                raise StaleReplicaError("replica at seq %d, read needs %d" % (self.applied_seq, min_seq))
+        if max_lag_ms is not None:
+            lag = self.lag_ms()
+            if lag is None or lag > max_lag_ms:
+                raise StaleReplicaError("replica lag %s ms exceeds %d ms" % (lag, max_lag_ms))
+
+    def get_balance(self, timestamp: int, account_id: str, time_at: int,
+                    max_lag_ms: int | None = None, min_seq: int | None = None, timeout: float = 1.0) -> int | None:
+        with self.lock:
+            self._check(max_lag_ms, min_seq, timeout)
+            return self.system.get_balance(timestamp, account_id, time_at)
+
+    def get_payment_status(self, timestamp: int, account_id: str, payment: str,
+                           max_lag_ms: int | None = None, min_seq: int | None = None,
+                           timeout: float = 1.0) -> str | None:
+        with self.lock:
+            self._check(max_lag_ms, min_seq, timeout)
+            return self.system.get_payment_status(timestamp, account_id, payment)
+
+    def get_payment_statuses(self, timestamp: int, account_id: str, payments: list[str],
+                             max_lag_ms: int | None = None, min_seq: int | None = None,
+                             timeout: float = 1.0) -> list[str | None]:
+        with self.lock:
+            self._check(max_lag_ms, min_seq, timeout)
+            return self.system.get_payment_statuses(timestamp, account_id, payments)
+
+    def top_spenders(self, timestamp: int, n: int,
+                     max_lag_ms: int | None = None, min_seq: int | None = None, timeout: float = 1.0) -> list[str]:
+        with self.lock:
+            self._check(max_lag_ms, min_seq, timeout)
+            return self.system.top_spenders(timestamp, n)
@@ -4,8 +4,29 @@ parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir)
 
 from timeout_decorator import timeout
+import gc
+import io
+import json
+import random
+import tempfile
+import threading
 import unittest
+import urllib.error
+import urllib.request
+from balance_history import BalanceHistory
 from banking_system_impl import BankingSystemImpl
+from banking_system_sqlite import SQLiteBankingSystem
+from columnar import export_state, load_state
+from cashback_policy import CashbackPolicy, FlatCashbackPolicy, TieredCashbackPolicy
+from heavy_hitters import SpaceSaving
+from ingest import ReorderBuffer
+from metrics import MetricsServer, exposition
+from mvcc import ReadPool, consistent_read
+from payment_registry import PaymentRegistry
+from replay import ParallelReplay
+from replication import Primary, Replica, StaleReplicaError
+from settlement import HeapScheduler, SettlementWorker, TimingWheel
+import level_1_tests, level_2_tests, level_3_tests, level_4_tests
 
 
 class SandboxTests(unittest.TestCase):
@@ -34,3 +55,1418 @@ class SandboxTests(unittest.TestCase):
         self.assertEqual(self.system.deposit(3, 'account1', 2000), 2000)
         self.assertEqual(self.system.deposit(4, 'account2', 1000), 1000)
         self.assertEqual(self.system.transfer(5, 'account1', 'account2', 500), 1500)
+
+
+class ColdHistoryTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.system = BankingSystemImpl(history_dir=self.tmp.name, hot_window=100, spill_min=4, cache_blocks=2)
+
+    def tearDown(self):
+        self.system.close()
+        self.tmp.cleanup()
+
+    def test_old_history_is_spilled_and_paged_back(self):
+        self.assertTrue(self.system.create_account(1, 'account1'))
+        for t in range(2, 1000):
+            self.system.deposit(t, 'account1', 1)
+        self.assertLess(len(self.system.histories[self.system.handle('account1')]), 200)
+        self.assertEqual(self.system.get_balance(1000, 'account1', 1), 0)
+        self.assertEqual(self.system.get_balance(1001, 'account1', 10), 9)
+        self.assertEqual(self.system.get_balance(1002, 'account1', 500), 499)
+        self.assertEqual(self.system.get_balance(1003, 'account1', 990), 989)
+        self.assertIsNone(self.system.get_balance(1004, 'account1', 0))
+
+    def test_merged_account_history_reads_cold_tier(self):
+        self.assertTrue(self.system.create_account(1, 'account1'))
+        self.assertTrue(self.system.create_account(2, 'account2'))
+        for t in range(3, 600):
+            self.system.deposit(t, 'account2', 2)
+        self.assertTrue(self.system.merge_accounts(600, 'account1', 'account2'))
+        self.assertEqual(self.system.get_balance(601, 'account2', 4), 4)
+        self.assertEqual(self.system.get_balance(602, 'account2', 599), 1194)
+        self.assertIsNone(self.system.get_balance(603, 'account2', 600))
+
+    def test_segments_are_private_to_one_store(self):
+        directory = os.path.join(self.tmp.name, 'shared')
+        os.makedirs(directory)
+        #leftovers with a gap in their numbers
+        for name in ('segment-000001.seg', 'segment-000003.seg'):
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(b'leftover')
+        system = BankingSystemImpl(history_dir=directory, hot_window=100, spill_min=4)
+        system.create_account(1, 'account1')
+        for t in range(2, 500):
+            system.deposit(t, 'account1', 1)
+        self.assertEqual(sorted(os.listdir(directory)),
+                         ['segment-000001.seg', 'segment-000003.seg', 'segment-000004.seg'])
+        self.assertEqual(system.get_balance(500, 'account1', 10), 9)
+        system.close()
+        self.assertEqual(sorted(os.listdir(directory)), ['segment-000001.seg', 'segment-000003.seg'])
+        for name in os.listdir(directory):
+            with open(os.path.join(directory, name), 'rb') as f:
+                self.assertEqual(f.read(), b'leftover')
+
+
+class BalanceHistoryTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def test_lookup_matches_plain_dict(self):
+        rng = random.Random(7)
+        history = BalanceHistory(block_size=8)
+        expected = {}
+        timestamp, balance = 1, 0
+        for _ in range(500):
+            timestamp += rng.randint(1, 50)
+            balance += rng.randint(-300, 300)
+            history.append(timestamp, balance)
+            expected[timestamp] = balance
+        history.append(timestamp, balance + 1)
+        expected[timestamp] = balance + 1
+
+        self.assertEqual(len(history), 500)
+        self.assertEqual(list(history.items()), list(expected.items()))
+        first = next(iter(expected))
+        self.assertIsNone(history.lookup(first - 1))
+        for time_at in range(first, timestamp + 10, 7):
+            keys = [key for key in expected if key <= time_at]
+            self.assertEqual(history.lookup(time_at), expected[max(keys)])
+
+    def test_encoding_is_compact(self):
+        history = BalanceHistory()
+        for t in range(10000):
+            history.append(1000000 + 3 * t, 5000000 + (t % 17) * 40)
+        self.assertLess(history.nbytes() / len(history), 10)
+
+
+class HandleApiTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def setUp(self):
+        self.system = BankingSystemImpl()
+
+    def test_handle_methods_match_string_api(self):
+        self.assertTrue(self.system.create_account(1, 'account1'))
+        self.assertTrue(self.system.create_account(2, 'account10'))
+        a, b = self.system.handle('account1'), self.system.handle('account10')
+        self.assertEqual((a, b), (0, 1))
+        self.assertIsNone(self.system.handle('account2'))
+        self.assertEqual(self.system.deposit_h(3, a, 1000), 1000)
+        self.assertEqual(self.system.transfer_h(4, a, b, 300), 700)
+        self.assertIsNone(self.system.transfer_h(5, a, a, 1))
+        self.assertEqual(self.system.pay_h(6, b, 100), 'payment1')
+        self.assertEqual(self.system.get_payment_status_h(7, b, 'payment1'), 'IN_PROGRESS')
+        self.assertEqual(self.system.get_balance_h(8, b, 5), 300)
+
+    def test_merge_retires_handle_without_touching_similar_ids(self):
+        self.assertTrue(self.system.create_account(1, 'account1'))
+        self.assertTrue(self.system.create_account(2, 'account10'))
+        self.assertTrue(self.system.create_account(3, 'account2'))
+        self.assertEqual(self.system.deposit(4, 'account10', 1000), 1000)
+        self.assertEqual(self.system.pay(5, 'account10', 100), 'payment1')
+        retired = self.system.handle('account2')
+        self.assertTrue(self.system.merge_accounts_h(6, self.system.handle('account1'), retired))
+        self.assertIsNone(self.system.deposit_h(7, retired, 10))
+        self.assertEqual(self.system.get_payment_status(8, 'account10', 'payment1'), 'IN_PROGRESS')
+
+
+class IdempotencyTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def setUp(self):
+        self.system = BankingSystemImpl(dedup_capacity=2, dedup_window=100)
+
+    def test_retried_requests_are_not_applied_twice(self):
+        self.assertTrue(self.system.create_account(1, 'account1'))
+        self.assertEqual(self.system.deposit(2, 'account1', 1000, idempotency_key='d1'), 1000)
+        self.assertEqual(self.system.deposit(3, 'account1', 1000, idempotency_key='d1'), 1000)
+        self.assertEqual(self.system.pay(4, 'account1', 100, idempotency_key='p1'), 'payment1')
+        self.assertEqual(self.system.pay(5, 'account1', 100, idempotency_key='p1'), 'payment1')
+        self.assertEqual(self.system.deposit(6, 'account1', 0), 900)
+        self.assertEqual((self.system.dedup.hits, self.system.dedup.misses), (2, 2))
+
+    def test_keys_expire_by_capacity_and_window(self):
+        self.assertTrue(self.system.create_account(1, 'account1'))
+        self.assertEqual(self.system.deposit(2, 'account1', 10, idempotency_key='a'), 10)
+        self.assertEqual(self.system.deposit(3, 'account1', 10, idempotency_key='b'), 20)
+        self.assertEqual(self.system.deposit(4, 'account1', 10, idempotency_key='c'), 30)
+        self.assertEqual(len(self.system.dedup), 2)
+        self.assertEqual(self.system.deposit(5, 'account1', 10, idempotency_key='a'), 40)
+        self.assertEqual(self.system.deposit(500, 'account1', 10, idempotency_key='a'), 50)
+
+
+class CashbackPolicyTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def test_tiered_policy_rules_and_batch(self):
+        policy = TieredCashbackPolicy(tier_rates_bp=[200, 500], account_tiers={1: 1},
+                                      category_bonus_bp={3: 100}, promotions=[(100, 200, 1000)], cap=40)
+        self.assertEqual(policy.evaluate(0, 1000, 50), 20)
+        self.assertEqual(policy.evaluate(1, 1000, 50), 40)
+        self.assertEqual(policy.evaluate(0, 1000, 50, 3), 30)
+        self.assertEqual(policy.evaluate(0, 100, 150, 3), 13)
+        self.assertEqual(policy.evaluate(7, 100, 200), 2)
+        batch = policy.evaluate_batch([0, 1, 0, 0, 7], [1000, 1000, 1000, 100, 100], [50, 50, 50, 150, 200],
+                                      [0, 0, 3, 3, 0])
+        self.assertEqual(batch.tolist(), [20, 40, 30, 13, 2])
+
+    def test_negative_category_earns_no_bonus(self):
+        policy = TieredCashbackPolicy(tier_rates_bp=[100], category_bonus_bp={7: 500})
+        self.assertEqual(policy.evaluate(0, 10000, 0, -1), 100)
+        self.assertEqual(policy.evaluate(0, 10000, 0, 7), 600)
+        self.assertEqual(policy.evaluate_batch([0, 0, 0], [10000] * 3, [0] * 3, [-1, -8, 7]).tolist(), [100, 100, 600])
+
+    def test_policy_interface_is_abstract(self):
+        with self.assertRaises(TypeError):
+            CashbackPolicy()
+
+    def test_pay_uses_configured_policy(self):
+        system = BankingSystemImpl(cashback_policy=FlatCashbackPolicy(rate_bp=1000, delay=10))
+        self.assertTrue(system.create_account(1, 'account1'))
+        self.assertEqual(system.deposit(2, 'account1', 1000), 1000)
+        self.assertEqual(system.pay(3, 'account1', 500), 'payment1')
+        self.assertEqual(system.get_payment_status(12, 'account1', 'payment1'), 'IN_PROGRESS')
+        self.assertEqual(system.deposit(13, 'account1', 0), 550)
+
+
+class SettlementClockTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def setUp(self):
+        self.system = BankingSystemImpl()
+
+    def test_advance_time_settles_idle_accounts_at_due_time(self):
+        self.assertTrue(self.system.create_account(1, 'account1'))
+        self.assertTrue(self.system.create_account(2, 'account2'))
+        self.assertEqual(self.system.deposit(3, 'account1', 1000), 1000)
+        self.assertEqual(self.system.deposit(4, 'account2', 1000), 1000)
+        self.assertEqual(self.system.pay(5, 'account1', 500), 'payment1')
+        self.assertEqual(self.system.pay(6, 'account2', 100), 'payment2')
+        self.assertEqual(self.system.advance_time(86400005), 1)
+        self.assertEqual(self.system.advance_time(90000000), 1)
+        self.assertEqual(self.system.advance_time(90000000), 0)
+        self.assertEqual(self.system.pay_log['payment2'][3], True)
+        self.assertEqual(self.system.get_balance(90000001, 'account2', 86400005), 900)
+        self.assertEqual(self.system.get_balance(90000002, 'account2', 86400006), 902)
+
+    def test_worker_drives_settlement(self):
+        self.assertTrue(self.system.create_account(1, 'account1'))
+        self.assertEqual(self.system.deposit(2, 'account1', 1000), 1000)
+        self.assertEqual(self.system.pay(3, 'account1', 500), 'payment1')
+        worker = SettlementWorker(self.system, interval=0.01, clock=lambda: 86400003)
+        worker.run_once()
+        self.assertEqual(self.system.balances[self.system.handle('account1')], 510)
+
+
+class TimingWheelTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def test_wheel_expires_like_heap(self):
+        rng = random.Random(3)
+        wheel, heap = TimingWheel(bits=4, levels=3), HeapScheduler()
+        now = 1000
+        for i in range(3000):
+            if rng.random() < 0.6:
+                due = now + rng.choice([0, 1, rng.randint(0, 300), rng.randint(0, 20000)])
+                wheel.schedule(due, i)
+                heap.schedule(due, i)
+            else:
+                now += rng.choice([0, 1, rng.randint(0, 100), rng.randint(0, 5000)])
+                self.assertEqual(wheel.pop_due(now), heap.pop_due(now))
+                self.assertEqual(len(wheel), len(heap))
+                self.assertEqual(wheel.next_due(), heap.next_due())
+
+    def test_far_and_late_items(self):
+        wheel = TimingWheel(bits=2, levels=2)
+        wheel.schedule(100, 'a')
+        wheel.schedule(1000, 'far')
+        wheel.schedule(50, 'late')
+        self.assertEqual(wheel.pop_due(99), [(50, 'late')])
+        self.assertEqual(wheel.pop_due(999), [(100, 'a')])
+        self.assertEqual(wheel.next_due(), 1000)
+        self.assertEqual(wheel.pop_due(5000), [(1000, 'far')])
+        self.assertEqual(len(wheel), 0)
+
+    def test_empty_wheel_is_anchored_by_pop_due(self):
+        wheel = TimingWheel(bits=4, levels=3)
+        self.assertEqual(wheel.pop_due(1000), [])
+        wheel.schedule(3000, 'b')
+        wheel.schedule(2000, 'a')
+        #the second item is due before the first but still after the clock
+        self.assertEqual(wheel.late, [])
+        self.assertEqual(wheel.pop_due(2500), [(2000, 'a')])
+        self.assertEqual(wheel.pop_due(3000), [(3000, 'b')])
+
+
+class MergeLineageTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def setUp(self):
+        self.system = BankingSystemImpl()
+
+    def test_chained_merges_keep_histories_in_place(self):
+        for i in range(1, 5):
+            self.assertTrue(self.system.create_account(i, 'account%d' % i))
+            self.assertEqual(self.system.deposit(10 + i, 'account%d' % i, 100 * i), 100 * i)
+        self.assertEqual(self.system.pay(20, 'account4', 100), 'payment1')
+        self.assertTrue(self.system.merge_accounts(21, 'account3', 'account4'))
+        self.assertTrue(self.system.merge_accounts(22, 'account2', 'account3'))
+        self.assertTrue(self.system.merge_accounts(23, 'account1', 'account2'))
+        self.assertEqual(self.system.pay_log['payment1'][0], 3)
+        h4 = self.system.retired['account4']
+        self.assertEqual(self.system.lineage(h4), [(2, 21), (1, 22), (0, 23)])
+        self.assertEqual(self.system.get_payment_status(24, 'account1', 'payment1'), 'IN_PROGRESS')
+        self.assertEqual(self.system.get_balance(25, 'account4', 20), 300)
+        self.assertEqual(self.system.get_balance(26, 'account3', 21), 600)
+        self.assertIsNone(self.system.get_balance(27, 'account3', 22))
+        self.assertEqual(self.system.top_spenders(28, 2), ['account1(100)'])
+        self.assertEqual(self.system.deposit(86400020, 'account1', 0), 902)
+
+
+class MergeManyTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def setUp(self):
+        self.system = BankingSystemImpl()
+        for i, name in enumerate(['A', 'B', 'C', 'D']):
+            self.assertTrue(self.system.create_account(i + 1, name))
+            self.assertEqual(self.system.deposit(i + 10, name, 10 ** i), 10 ** i)
+
+    def test_results_match_sequential_merges(self):
+        pairs = [('A', 'B'), ('B', 'C'), ('C', 'C'), ('D', 'C'), ('A', 'X'), ('A', 'D')]
+        self.assertEqual(self.system.merge_many(20, pairs), [True, False, False, True, False, True])
+        self.assertEqual(self.system.deposit(21, 'A', 0), 1111)
+        self.assertEqual(self.system.get_balance(22, 'D', 19), 1000)
+        self.assertIsNone(self.system.get_balance(23, 'D', 20))
+
+    def test_resolve_chains_follows_batch_merges(self):
+        pairs = [('A', 'B'), ('B', 'C'), ('C', 'D'), ('D', 'A')]
+        self.assertEqual(self.system.merge_many(20, pairs, resolve_chains=True), [True, True, True, False])
+        self.assertEqual(self.system.deposit(21, 'A', 0), 1111)
+        self.assertEqual(self.system.get_balance(22, 'A', 20), 1111)
+
+
+#the graded level suites, run against the SQLite engine
+class SQLiteLevel1Tests(level_1_tests.Level1Tests):
+
+    @classmethod
+    def setUp(cls):
+        cls.system = SQLiteBankingSystem()
+
+
+class SQLiteLevel2Tests(level_2_tests.Level2Tests):
+
+    @classmethod
+    def setUp(cls):
+        cls.system = SQLiteBankingSystem()
+
+
+class SQLiteLevel3Tests(level_3_tests.Level3Tests):
+
+    @classmethod
+    def setUp(cls):
+        cls.system = SQLiteBankingSystem()
+
+
+class SQLiteLevel4Tests(level_4_tests.Level4Tests):
+
+    @classmethod
+    def setUp(cls):
+        cls.system = SQLiteBankingSystem()
+
+
+class SQLiteStorageTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def test_state_survives_reopen(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bank.db')
+            system = SQLiteBankingSystem(path, commit_every=100)
+            with system.batch():
+                self.assertTrue(system.create_account(1, 'account1'))
+                self.assertEqual(system.deposit(2, 'account1', 1000), 1000)
+                self.assertEqual(system.pay(3, 'account1', 500), 'payment1')
+            system.close()
+
+            system = SQLiteBankingSystem(path)
+            self.assertEqual(system.pay(4, 'account1', 100), 'payment2')
+            self.assertEqual(system.get_balance(86400004, 'account1', 86400003), 410)
+            self.assertEqual(system.top_spenders(86400005, 1), ['account1(600)'])
+            system.close()
+
+    def test_edge_inputs_match_the_in_memory_engine(self):
+        for system in (SQLiteBankingSystem(), BankingSystemImpl()):
+            system.create_account(1, 'a')
+            system.create_account(2, 'b')
+            system.deposit(3, 'a', 1000)
+            system.pay(4, 'a', 100)
+            self.assertEqual(system.top_spenders(5, -1), [])
+            self.assertEqual(system.top_spenders(5, 0), [])
+            for payment in ('payment01', 'payment\u0661', 'payment', 'payment-1', 1, None):
+                self.assertIsNone(system.get_payment_status(6, 'a', payment))
+            self.assertEqual(system.get_payment_status(6, 'a', 'payment1'), 'IN_PROGRESS')
+
+
+class TopSpendersCacheTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def expected(self, system, n):
+        ranking = sorted((-system.outgoing[h], name) for name, h in system.ids.items())
+        return ['%s(%d)' % (name, -total) for total, name in ranking[:n]]
+
+    def test_cached_rankings_match_recomputation(self):
+        rng = random.Random(11)
+        system = BankingSystemImpl()
+        names = ['acc%d' % i for i in range(40)]
+        for t, name in enumerate(names[:20]):
+            system.create_account(t, name)
+            system.deposit(t, name, 10 ** 6)
+        for t in range(100, 3000):
+            roll = rng.random()
+            a, b = rng.choice(names), rng.choice(names)
+            if roll < 0.4:
+                system.transfer(t, a, b, rng.randint(1, 500))
+            elif roll < 0.6:
+                system.pay(t, a, rng.randint(1, 500))
+            elif roll < 0.65:
+                system.merge_accounts(t, a, b)
+            elif roll < 0.7:
+                if system.create_account(t, a):
+                    system.deposit(t, a, 10 ** 6)
+            else:
+                n = rng.choice([0, 1, 3, 5, 50])
+                self.assertEqual(system.top_spenders(t, n), self.expected(system, n))
+
+    def test_unchanged_system_reuses_ranking(self):
+        self.assertTrue(BankingSystemImpl().top_spenders(1, 3) == [])
+        system = BankingSystemImpl()
+        for t, name in enumerate(['a', 'b', 'c']):
+            system.create_account(t, name)
+        first = system.top_spenders(5, 2)
+        ranking = system.top_cache[2][0]
+        self.assertEqual(system.top_spenders(6, 2), first)
+        self.assertIs(system.top_cache[2][0], ranking)
+
+
+class HeavyHitterTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def test_sketch_error_bounds(self):
+        rng = random.Random(5)
+        sketch = SpaceSaving(20)
+        exact = {}
+        for _ in range(5000):
+            key = min(int(rng.paretovariate(1.0)), 500)
+            amount = rng.randint(1, 100)
+            sketch.update(key, amount)
+            exact[key] = exact.get(key, 0) + amount
+        self.assertEqual(len(sketch), 20)
+        self.assertEqual(sketch.total, sum(exact.values()))
+        for key, true_total in exact.items():
+            count, error = sketch.estimate(key)
+            if key in sketch.counters:
+                self.assertTrue(true_total <= count <= true_total + error)
+                self.assertTrue(error <= sketch.total // 20)
+            #keys above total / capacity are always tracked
+            elif true_total > sketch.total / 20:
+                self.fail('heavy key %d was evicted' % key)
+
+    def test_evicted_key_returning_after_a_merge_is_not_undercounted(self):
+        sketch = SpaceSaving(2)
+        sketch.update('a', 100)
+        sketch.update('b', 50)
+        sketch.update('c', 60)
+        sketch.merge_keys('a', 'c')
+        sketch.update('b', 1)
+        count, error = sketch.estimate('b')
+        self.assertTrue(51 <= count <= 51 + error)
+        self.assertTrue(error <= sketch.total // 2)
+        sketch.discard('a')
+        sketch.discard('b')
+        self.assertEqual(sketch.estimate('d'), (0, 50))
+        sketch.update('d', 5)
+        self.assertEqual(sketch.estimate('d'), (55, 50))
+
+    def test_merging_an_evicted_key_is_not_undercounted(self):
+        sketch = SpaceSaving(2)
+        sketch.update('a', 100)
+        sketch.update('b', 50)
+        sketch.update('c', 60)
+        sketch.merge_keys('a', 'b')
+        count, error = sketch.estimate('a')
+        self.assertTrue(150 <= count <= 150 + error)
+        self.assertEqual(sketch.total, 210)
+
+        system = BankingSystemImpl(heavy_hitters_epsilon=0.5)
+        for t, (name, amount) in enumerate([('A', 100), ('B', 50), ('C', 60)]):
+            system.create_account(t, name)
+            system.deposit(t, name, 1000)
+            system.pay(10 + t, name, amount)
+        system.merge_accounts(20, 'A', 'B')
+        self.assertEqual(system.top_spenders(21, 2), ['A(150)', 'C(60)'])
+        self.assertEqual(system.top_spenders(22, 2, approximate=True), ['A(150)', 'C(110)'])
+
+    def test_approximate_matches_exact_when_sketch_fits(self):
+        rng = random.Random(3)
+        system = BankingSystemImpl(heavy_hitters_epsilon=1 / 64)
+        names = ['acc%d' % i for i in range(30)]
+        for t, name in enumerate(names):
+            system.create_account(t, name)
+            system.deposit(t, name, 10 ** 6)
+        for t in range(100, 2000):
+            roll = rng.random()
+            a, b = rng.choice(names), rng.choice(names)
+            if roll < 0.45:
+                system.transfer(t, a, b, rng.randint(1, 500))
+            elif roll < 0.9:
+                system.pay(t, a, rng.randint(1, 500))
+            elif roll < 0.93:
+                system.merge_accounts(t, a, b)
+            else:
+                exact = system.top_spenders(t, 5)
+                approximate = system.top_spenders(t, 5, approximate=True)
+                #ties at the cut may pick different accounts, the totals agree
+                self.assertEqual([s[s.index('('):] for s in approximate], [s[s.index('('):] for s in exact])
+
+    def test_approximate_needs_sketch(self):
+        system = BankingSystemImpl()
+        system.create_account(1, 'a')
+        with self.assertRaises(ValueError):
+            system.top_spenders(2, 1, approximate=True)
+
+
+class ReorderBufferTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def trace(self, seed):
+        rng = random.Random(seed)
+        names = ['acc%d' % i for i in range(10)]
+        trace = [('create_account', (t, name)) for t, name in enumerate(names)]
+        trace += [('deposit', (10 + t, name, 10000)) for t, name in enumerate(names)]
+        for t in range(100, 100000, 50):
+            roll = rng.random()
+            a, b = rng.choice(names), rng.choice(names)
+            if roll < 0.4:
+                trace.append(('transfer', (t, a, b, rng.randint(1, 300))))
+            elif roll < 0.7:
+                trace.append(('pay', (t, a, rng.randint(1, 300))))
+            else:
+                trace.append(('get_balance', (t, a, rng.randint(0, t))))
+        return trace
+
+    def test_jittered_stream_matches_in_order_replay(self):
+        trace = self.trace(2)
+        system = BankingSystemImpl()
+        expected = [getattr(system, method)(*args) for method, args in trace]
+
+        rng = random.Random(4)
+        arrivals = sorted(trace, key=lambda event: event[1][0] + rng.randint(0, 1000))
+        buffer = ReorderBuffer(BankingSystemImpl(), max_delay=1000)
+        applied = []
+        for method, args in arrivals:
+            applied.extend(buffer.push(method, args))
+        applied.extend(buffer.flush())
+        self.assertEqual([event for event, _ in applied], trace)
+        self.assertEqual([result for _, result in applied], expected)
+        self.assertEqual((buffer.released, buffer.dropped, len(buffer)), (len(trace), 0, 0))
+
+    def test_late_events_are_dropped_or_corrected(self):
+        late = []
+        buffer = ReorderBuffer(BankingSystemImpl(), max_delay=10,
+                               on_late=lambda method, args, lateness: late.append((method, lateness)))
+        buffer.push('create_account', (1, 'a'))
+        self.assertEqual(buffer.push('deposit', (20, 'a', 100)), [(('create_account', (1, 'a')), True)])
+        self.assertEqual(buffer.push('deposit', (40, 'a', 5)), [(('deposit', (20, 'a', 100)), 100)])
+        self.assertEqual(buffer.push('deposit', (15, 'a', 7)), [])
+        self.assertEqual((buffer.dropped, late), (1, [('deposit', 5)]))
+
+        buffer.late_policy = 'correct'
+        self.assertEqual(buffer.push('deposit', (12, 'a', 7)), [(('deposit', (20, 'a', 7)), 107)])
+        self.assertEqual((buffer.corrected, buffer.max_lateness), (1, 8))
+        self.assertEqual(buffer.flush(), [(('deposit', (40, 'a', 5)), 112)])
+
+    def test_capacity_releases_oldest_events(self):
+        buffer = ReorderBuffer(BankingSystemImpl(), max_delay=10 ** 9, capacity=2)
+        self.assertEqual(buffer.push('create_account', (3, 'b')), [])
+        self.assertEqual(buffer.push('create_account', (1, 'a')), [])
+        self.assertEqual(buffer.push('create_account', (2, 'c')), [(('create_account', (1, 'a')), True)])
+        self.assertEqual(len(buffer), 2)
+        with self.assertRaises(ValueError):
+            ReorderBuffer(BankingSystemImpl(), 10, late_policy='reorder')
+
+
+class StatementTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def test_statement_covers_merged_accounts(self):
+        system = BankingSystemImpl()
+        system.create_account(1, 'a')
+        system.create_account(2, 'b')
+        system.deposit(3, 'a', 1000)
+        system.deposit(4, 'b', 500)
+        system.transfer(5, 'a', 'b', 200)
+        system.pay(6, 'b', 100)
+        system.merge_accounts(7, 'a', 'b')
+        system.deposit(86400006, 'a', 1)
+        self.assertEqual(list(system.iter_statement('a', 0, 86400006)), [
+            (3, 'deposit', 'a', 1000, None),
+            (4, 'deposit', 'b', 500, None),
+            (5, 'transfer_out', 'a', 200, 'b'),
+            (5, 'transfer_in', 'b', 200, 'a'),
+            (6, 'payment', 'b', 100, 'payment1'),
+            (7, 'merge', 'a', 600, 'b'),
+            (86400006, 'cashback', 'a', 2, 'payment1'),
+            (86400006, 'deposit', 'a', 1, None),
+        ])
+        self.assertEqual([event.kind for event in system.iter_statement('b', 5, 6)], ['transfer_in', 'payment'])
+        self.assertEqual(list(system.iter_statement('a', 8, 100)), [])
+        self.assertIsNone(system.iter_statement('c', 0, 10))
+
+    def test_statement_reconstructs_balances(self):
+        rng = random.Random(8)
+        system = BankingSystemImpl()
+        names = ['acc%d' % i for i in range(8)]
+        for t, name in enumerate(names):
+            system.create_account(t, name)
+        signs = {'deposit': 1, 'transfer_in': 1, 'cashback': 1, 'transfer_out': -1, 'payment': -1}
+        for t in range(10, 400000, 97):
+            a, b = rng.choice(names), rng.choice(names)
+            roll = rng.random()
+            if roll < 0.3:
+                system.deposit(t, a, rng.randint(1, 1000))
+            elif roll < 0.6:
+                system.transfer(t, a, b, rng.randint(1, 500))
+            elif roll < 0.9:
+                system.pay(t, a, rng.randint(1, 500))
+            else:
+                name, t1 = rng.choice(names), rng.randint(0, t)
+                system.advance_time(t)
+                events = list(system.iter_statement(name, t1, t))
+                self.assertEqual(events, sorted(events, key=lambda event: event.timestamp))
+                self.assertTrue(all(t1 <= event.timestamp <= t for event in events))
+                balance = sum(signs[event.kind] * event.amount for event in system.iter_statement(name, 0, t))
+                self.assertEqual(balance, system.get_balance(t, name, t))
+
+
+class ColumnarExportTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def trace(self, seed, start, stop):
+        rng = random.Random(seed)
+        names = ['acc%d' % i for i in range(25)] + ['ünïcode']
+        for t in range(start, stop, 71):
+            a, b = rng.choice(names), rng.choice(names)
+            roll = rng.random()
+            if roll < 0.1:
+                yield 'create_account', (t, a)
+            elif roll < 0.35:
+                yield 'deposit', (t, a, rng.randint(1, 1000))
+            elif roll < 0.6:
+                yield 'transfer', (t, a, b, rng.randint(1, 300))
+            elif roll < 0.8:
+                yield 'pay', (t, a, rng.randint(1, 300))
+            elif roll < 0.83:
+                yield 'merge_accounts', (t, a, b)
+            elif roll < 0.95:
+                yield 'get_balance', (t, a, rng.randint(0, t))
+            else:
+                yield 'top_spenders', (t, 5)
+
+    def check_round_trip(self, system, **kwargs):
+        for method, args in self.trace(1, 0, 300000000 // 1000):
+            getattr(system, method)(*args)
+        with tempfile.TemporaryDirectory() as tmp:
+            rows = export_state(system, os.path.join(tmp, 'export'), chunk_rows=7)
+            self.assertEqual(rows['payments'], len(system.pay_log))
+            loaded = load_state(os.path.join(tmp, 'export'), **kwargs)
+            for method, args in self.trace(2, 300000000 // 1000, 600000000 // 1000):
+                self.assertEqual(getattr(loaded, method)(*args), getattr(system, method)(*args))
+            for name in set(system.ids) | set(system.retired):
+                self.assertEqual(list(loaded.iter_statement(name, 0, 10 ** 9)),
+                                 list(system.iter_statement(name, 0, 10 ** 9)))
+            loaded.close()
+        system.close()
+
+    def test_export_of_an_engine_whose_clock_never_advanced(self):
+        def reject(constant):
+            raise ValueError('not strict JSON: %s' % constant)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            export_state(BankingSystemImpl(), os.path.join(tmp, 'export'))
+            with open(os.path.join(tmp, 'export', 'manifest.json')) as f:
+                manifest = json.load(f, parse_constant=reject)
+            self.assertIsNone(manifest['clock'])
+            loaded = load_state(os.path.join(tmp, 'export'))
+            self.assertEqual(loaded.clock, float('-inf'))
+            self.assertTrue(loaded.create_account(1, 'a'))
+            loaded.close()
+
+    def test_round_trip_in_memory(self):
+        self.check_round_trip(BankingSystemImpl())
+
+    def test_round_trip_with_cold_history(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            system = BankingSystemImpl(history_dir=os.path.join(tmp, 'a'), hot_window=1000, spill_min=8)
+            self.check_round_trip(system, history_dir=os.path.join(tmp, 'b'), hot_window=1000, spill_min=8)
+
+    def test_loading_spills_long_histories_as_it_goes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            system = BankingSystemImpl()
+            system.create_account(0, 'a')
+            for t in range(1, 5000):
+                system.deposit(t, 'a', 1)
+            export_state(system, os.path.join(tmp, 'export'), chunk_rows=100)
+            loaded = load_state(os.path.join(tmp, 'export'), history_dir=os.path.join(tmp, 'cold'),
+                                hot_window=100, spill_min=64)
+            h = loaded.handle('a')
+            #spilled in many small blocks while loading, not in one at the end
+            self.assertTrue(len(loaded.history_store.index[h][1]) > 10)
+            self.assertTrue(len(loaded.histories[h]) < 4 * 64 + 100)
+            self.assertEqual([loaded.get_balance(5000, 'a', t) for t in range(0, 5000, 37)],
+                             [system.get_balance(5000, 'a', t) for t in range(0, 5000, 37)])
+            loaded.close()
+
+
+class ReplicationTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def events(self, seed):
+        rng = random.Random(seed)
+        names = ['acc%d' % i for i in range(12)]
+        for t in range(0, 20000000, 9973):
+            a, b = rng.choice(names), rng.choice(names)
+            roll = rng.random()
+            if roll < 0.15:
+                yield 'create_account', (t, a)
+            elif roll < 0.35:
+                yield 'deposit', (t, a, rng.randint(1, 1000))
+            elif roll < 0.55:
+                yield 'transfer', (t, a, b, rng.randint(1, 300))
+            elif roll < 0.7:
+                yield 'pay', (t, a, rng.randint(1, 300), rng.randint(0, 3))
+            elif roll < 0.75:
+                yield 'pay', (t, a, rng.randint(1, 300))
+            elif roll < 0.78:
+                yield 'merge_accounts', (t, a, b)
+            elif roll < 0.8:
+                yield 'merge_many', (t, [(a, b), (b, rng.choice(names))], rng.random() < 0.5)
+            else:
+                yield 'get_balance', (t, a, rng.randint(0, t))
+
+    def test_replica_converges_to_primary(self):
+        sink = io.BytesIO()
+        primary = Primary(sinks=[sink])
+        for method, args in self.events(6):
+            primary.apply(method, args)
+        primary.heartbeat()
+
+        replica = Replica(io.BytesIO(sink.getvalue()))
+        while replica.apply_next():
+            pass
+        self.assertEqual(replica.applied_seq, primary.seq)
+        self.assertEqual(replica.applied_bytes, primary.bytes_sent)
+        ours, theirs = primary.system, replica.system
+        self.assertEqual(theirs.clock, ours.clock)
+        self.assertEqual(theirs.top_spenders(ours.clock, 20), ours.top_spenders(ours.clock, 20))
+        for name in ['acc%d' % i for i in range(12)]:
+            for time_at in range(0, 20000000, 250000):
+                self.assertEqual(replica.get_balance(ours.clock, name, time_at, max_lag_ms=60000),
+                                 ours.get_balance(ours.clock, name, time_at))
+            for payment in ours.pay_log:
+                self.assertEqual(replica.get_payment_status(ours.clock, name, payment),
+                                 ours.get_payment_status(ours.clock, name, payment))
+
+    def test_read_your_writes_over_a_pipe(self):
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(read_fd, 'rb') as source, os.fdopen(write_fd, 'wb') as sink:
+            primary = Primary(sinks=[sink])
+            replica = Replica(source)
+            with self.assertRaises(StaleReplicaError):
+                replica.get_balance(1, 'a', 1, max_lag_ms=1000)
+            replica.start()
+            primary.apply('create_account', (1, 'a'))
+            primary.apply('deposit', (2, 'a', 50))
+            self.assertEqual(replica.get_balance(5, 'a', 5, min_seq=primary.seq), 50)
+            #due cashback shows up without the replica settling it
+            primary.apply('pay', (3, 'a', 50))
+            self.assertEqual(replica.get_balance(86400003, 'a', 86400003, min_seq=primary.seq), 1)
+            self.assertEqual(replica.system.clock, 3)
+            with self.assertRaises(StaleReplicaError):
+                replica.top_spenders(4, 1, min_seq=primary.seq + 1, timeout=0.01)
+            sink.close()
+            replica.stop()
+        self.assertEqual(replica.applied_seq, 3)
+        self.assertEqual(replica.lag_events(), 0)
+        self.assertTrue(0 <= replica.max_apply_lag_ms < 5000)
+
+    def test_lag_in_records(self):
+        sink = io.BytesIO()
+        primary = Primary(sinks=[sink])
+        primary.apply('create_account', (1, 'a'))
+        primary.apply('deposit', (2, 'a', 5))
+        primary.heartbeat()
+        replica = Replica(io.BytesIO(sink.getvalue()))
+        self.assertEqual(replica.lag_events(), 0)
+        for _ in range(3):
+            self.assertTrue(replica.receive())
+        self.assertEqual((replica.primary_seq, replica.lag_events()), (3, 3))
+        self.assertTrue(replica.apply_next())
+        self.assertEqual((replica.lag_events(), replica.last_apply_lag_events), (2, 2))
+        while replica.apply_next():
+            pass
+        self.assertEqual((replica.applied_seq, replica.lag_events()), (3, 0))
+        self.assertEqual((replica.last_apply_lag_events, replica.max_apply_lag_events), (0, 2))
+        self.assertEqual(replica.system.get_balance(3, 'a', 3), 5)
+
+
+class VersionedReadTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def test_get_balance_has_no_side_effects(self):
+        rng = random.Random(12)
+        pure, settled = BankingSystemImpl(), BankingSystemImpl()
+        names = ['acc%d' % i for i in range(6)]
+        for system in (pure, settled):
+            for t, name in enumerate(names):
+                system.create_account(t, name)
+                system.deposit(t, name, 5000)
+        for t in range(100, 600000000, 1999993):
+            a, b = rng.choice(names), rng.choice(names)
+            roll, amount = rng.random(), rng.randint(1, 300)
+            for system in (pure, settled):
+                if roll < 0.4:
+                    system.pay(t, a, amount)
+                elif roll < 0.5:
+                    system.merge_accounts(t, a, b)
+            query = (t + rng.randint(0, 10 ** 6), a, t + rng.randint(-10 ** 8, 10 ** 8))
+            state = (pure.clock, pure.version, len(pure.scheduler))
+            balance = pure.get_balance(*query)
+            self.assertEqual(state, (pure.clock, pure.version, len(pure.scheduler)))
+            #same answer as settling everything due first
+            settled.advance_time(query[0])
+            self.assertEqual(balance, settled.get_balance(*query))
+
+    def test_writes_bump_version(self):
+        system = BankingSystemImpl()
+        system.create_account(1, 'a')
+        system.deposit(2, 'a', 100)
+        system.pay(3, 'a', 10)
+        self.assertEqual(system.version, 6)
+        system.get_balance(4, 'a', 4)
+        system.top_spenders(4, 1)
+        self.assertEqual(system.version, 6)
+
+    def test_consistent_reads_alongside_a_writer(self):
+        system = BankingSystemImpl()
+        system.create_account(0, 'a')
+        system.create_account(0, 'b')
+        system.create_account(0, 'c')
+        system.deposit(0, 'a', 1000)
+        system.deposit(0, 'c', 10 ** 9)
+        done = threading.Event()
+        errors = []
+
+        def writer():
+            rng = random.Random(1)
+            t = 1
+            try:
+                while not done.is_set():
+                    t += 1
+                    roll = rng.random()
+                    if roll < 0.4:
+                        system.transfer(t, 'a', 'b', rng.randint(1, 50))
+                    elif roll < 0.8:
+                        system.transfer(t, 'b', 'a', rng.randint(1, 50))
+                    else:
+                        system.pay(t, 'c', rng.randint(1, 50))
+            except Exception as error:
+                errors.append(error)
+
+        def total(t):
+            return system.get_balance(t, 'a', t) + system.get_balance(t, 'b', t)
+
+        def spenders(n):
+            return system.top_spenders(system.clock, n), [entry[3] for entry in system.rank_spenders(n)]
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            for i in range(2000):
+                self.assertEqual(consistent_read(system, lambda: total(system.clock)), 1000)
+                cached, fresh = consistent_read(system, spenders, 1 + i % 8)
+                self.assertEqual(cached, fresh)
+        finally:
+            done.set()
+            thread.join()
+            sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+        for n in range(1, 9):
+            self.assertEqual(*spenders(n))
+
+    def test_top_spenders_does_not_cache_a_ranking_raced_by_a_write(self):
+        system = BankingSystemImpl()
+        for t, name in enumerate(['a', 'b', 'c']):
+            system.create_account(t, name)
+            system.deposit(t, name, 1000)
+        system.transfer(3, 'a', 'b', 100)
+        self.assertEqual(system.top_spenders(4, 2), ['a(100)', 'b(0)'])
+        system.transfer(5, 'b', 'c', 50)
+        patch_ranking = system.patch_ranking
+
+        def racing_patch(n, ranking, dirty):
+            #a writer thread runs between the reader's computation and its cache update
+            patched = patch_ranking(n, ranking, dirty)
+            system.transfer(6, 'c', 'a', 500)
+            return patched
+
+        system.patch_ranking = racing_patch
+        self.assertEqual(system.top_spenders(7, 2), ['a(100)', 'b(50)'])
+        del system.patch_ranking
+        self.assertEqual(system.top_spenders(8, 2), ['c(500)', 'a(100)'])
+
+    def test_read_pool_matches_direct_reads(self):
+        system = BankingSystemImpl()
+        for t, name in enumerate(['a', 'b', 'c']):
+            system.create_account(t, name)
+            system.deposit(t, name, 100 * (t + 1))
+        system.pay(10, 'c', 100)
+        calls = [(t, name, t) for t in range(0, 86400020, 4320001) for name in ['a', 'b', 'c', 'd']]
+        expected = [system.get_balance(*args) for args in calls]
+        for processes in (True, False):
+            pool = ReadPool(system, workers=2, processes=processes, chunk=7)
+            try:
+                self.assertEqual(pool.map('get_balance', calls), expected)
+                if processes:
+                    #forked workers stay pinned to the version they were started on
+                    system.deposit(86400030, 'a', 1)
+                    self.assertEqual(pool.map('get_balance', [(86400031, 'a', 86400031)]), [100])
+                    pool.refresh()
+                    self.assertEqual(pool.map('get_balance', [(86400031, 'a', 86400031)]), [101])
+            finally:
+                pool.close()
+
+
+class MemoryReportTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def test_sampled_report_tracks_exact_report(self):
+        rng = random.Random(2)
+        system = BankingSystemImpl()
+        names = ['acc%d' % i for i in range(400)]
+        for t, name in enumerate(names):
+            system.create_account(t, name)
+            system.deposit(t, name, 10 ** 6)
+        for t in range(1000, 20000):
+            a = rng.choice(names[:20]) if rng.random() < 0.5 else rng.choice(names)
+            system.pay(t, a, rng.randint(1, 100))
+        exact = system.memory_report(sample=10 ** 6)
+        self.assertEqual((exact['accounts'], exact['sampled']), (400, 400))
+        #the busy accounts top the ranking
+        self.assertTrue(all(int(name[3:]) < 20 for name, _ in exact['heaviest']))
+        self.assertEqual(exact['per_account']['max'], exact['heaviest'][0][1])
+        self.assertEqual(exact['total'], sum(exact['structures'].values()))
+
+        sampled = system.memory_report(sample=100, seed=3)
+        self.assertEqual(sampled['sampled'], 100)
+        for structure in ('account_tables', 'histories', 'ledgers', 'pay_log'):
+            self.assertTrue(abs(sampled['structures'][structure] - exact['structures'][structure])
+                            < 0.35 * exact['structures'][structure])
+
+    def test_empty_system(self):
+        report = BankingSystemImpl().memory_report()
+        self.assertEqual((report['accounts'], report['heaviest'], report['per_account']['max']), (0, [], 0))
+
+
+class HotPathAllocationTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def test_payment_registry_behaves_like_the_pay_log_dict(self):
+        registry = PaymentRegistry()
+        self.assertEqual(registry.add(4, 100, 2), 1)
+        self.assertEqual(registry.add(7, 200, 3), 2)
+        registry.settled[0] = 1
+        self.assertEqual(registry['payment1'], (4, 100, 2, True))
+        self.assertEqual(dict(registry.items()), {'payment1': (4, 100, 2, True), 'payment2': (7, 200, 3, False)})
+        self.assertEqual(list(registry), ['payment1', 'payment2'])
+        for missing in ('payment0', 'payment3', 'payment01', 'payment', 'payment-1', 'pay1', 'payment\u0661', 7):
+            self.assertFalse(missing in registry)
+            self.assertIsNone(registry.get(missing))
+        with self.assertRaises(KeyError):
+            registry['payment3']
+
+    def test_steady_state_operations_allocate_no_objects(self):
+        system = BankingSystemImpl()
+        names = ['acc%d' % i for i in range(50)]
+        for t, name in enumerate(names):
+            system.create_account(t, name)
+            system.deposit(t, name, 10 ** 12)
+        rng = random.Random(0)
+        step = 2 * system.cashback_policy.delay // 20000
+        calls = []
+        for i in range(60000):
+            a, b, amount = rng.choice(names), rng.choice(names), rng.randint(1000, 5000)
+            method = ('deposit', 'transfer', 'pay')[i % 3]
+            args = (a, b, amount) if method == 'transfer' else (a, amount)
+            calls.append((getattr(system, method), (100 + i * step,) + args))
+        gc.disable()
+        try:
+            #warm-up covers a full refund cycle
+            for method, args in calls[:40000]:
+                method(*args)
+            blocks = sys.getallocatedblocks()
+            for method, args in calls[40000:]:
+                method(*args)
+            blocks = sys.getallocatedblocks() - blocks
+        finally:
+            gc.enable()
+        self.assertTrue(abs(blocks) < 200)
+
+
+class PaymentStatusesTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def test_bulk_statuses_match_single_checks_across_merges(self):
+        system = BankingSystemImpl()
+        rng = random.Random(3)
+        names = ['acc%d' % i for i in range(8)]
+        for t, name in enumerate(names):
+            system.create_account(t, name)
+            system.deposit(t, name, 10 ** 9)
+        payments = [system.pay(100 + i, rng.choice(names), rng.randint(1, 1000)) for i in range(300)]
+        merge_time = 100 + 86400000 // 2
+        system.merge_accounts(merge_time, 'acc0', 'acc1')
+        system.merge_accounts(merge_time, 'acc2', 'acc0')
+        system.merge_accounts(merge_time, 'acc3', 'acc4')
+        ids = payments + ['payment0', 'payment01', 'payment999', 'payment', 'payment\u0661', 'payment1\0', 'x' * 40]
+        rng.shuffle(ids)
+        for t in (merge_time, 86400000 + 200, 86400000 + 500):
+            for account_id in names + ['missing']:
+                expected = [system.get_payment_status(t, account_id, payment) for payment in ids]
+                self.assertEqual(system.get_payment_statuses(t, account_id, ids), expected)
+        self.assertEqual(system.get_payment_statuses(merge_time, 'acc2', []), [])
+
+    def test_registry_parses_ids_like_number(self):
+        registry = PaymentRegistry()
+        for i in range(120):
+            registry.add(0, 0, 0)
+        ids = ['payment%d' % i for i in range(130)] + ['payment007', 'payment 1', 'Payment1', 'payment1x',
+                                                     'payment-1', 'payment+1', 'payment' + '9' * 30, '']
+        self.assertEqual(registry.numbers(ids).tolist(), [registry.number(payment) or 0 for payment in ids])
+        self.assertEqual(registry.numbers(['payment3', None, 4]).tolist(), [3, 0, 0])
+
+
+class AccountLifecycleTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def snapshot(self, system, names, payments, t):
+        balances = [system.get_balance(t, name, time_at) for name in names for time_at in range(0, t + 1, t // 40)]
+        statuses = [system.get_payment_statuses(t, name, payments) for name in names]
+        statements = [list(system.iter_statement(name, 0, t) or ()) for name in names]
+        return balances, statuses, statements, system.top_spenders(t, 5)
+
+    def test_archived_accounts_answer_reads_and_restore_on_write(self):
+        archived, resident = BankingSystemImpl(), BankingSystemImpl()
+        rng = random.Random(11)
+        names = ['acc%d' % i for i in range(12)]
+        payments = []
+        t = 0
+        for rounds in range(3):
+            for step in range(300):
+                t += rng.randint(1, 600000)
+                a, b, amount, roll = rng.choice(names), rng.choice(names), rng.randint(1, 900), rng.random()
+                for system in (archived, resident):
+                    if roll < 0.05:
+                        result = system.create_account(t, a)
+                    elif roll < 0.3:
+                        result = system.deposit(t, a, amount)
+                    elif roll < 0.55:
+                        result = system.transfer(t, a, b, amount)
+                    elif roll < 0.85:
+                        result = system.pay(t, a, amount)
+                    elif roll < 0.9:
+                        result = system.merge_accounts(t, a, b)
+                    else:
+                        result = system.archive_account(t, a)
+                if roll >= 0.55 and roll < 0.85 and result is not None:
+                    payments.append(result)
+            #archive everything, including accounts with refunds still pending
+            for name in names:
+                archived.archive_account(t, name)
+            self.assertEqual(self.snapshot(archived, names, payments, t), self.snapshot(resident, names, payments, t))
+        self.assertTrue(len(archived.archive) > 0)
+        archived.advance_time(t + 86400000)
+        resident.advance_time(t + 86400000)
+        self.assertEqual(self.snapshot(archived, names, payments, t + 86400000),
+                         self.snapshot(resident, names, payments, t + 86400000))
+
+    def test_long_archived_history_reads_and_settles(self):
+        archived, resident = BankingSystemImpl(), BankingSystemImpl()
+        for system in (archived, resident):
+            system.create_account(0, 'a')
+            for t in range(1, 5000):
+                system.deposit(t, 'a', t % 7)
+            for t in range(5000, 5100):
+                system.pay(t, 'a', 10 + t % 3)
+        archived.archive_account(5100, 'a')
+        times = list(range(-1, 5200, 13))
+        for due in (86405000, 86405000, 86405040, 86405099, 86405200):
+            for system in (archived, resident):
+                system.advance_time(due)
+            self.assertEqual([archived.get_balance(due, 'a', time_at) for time_at in times + [due]],
+                             [resident.get_balance(due, 'a', time_at) for time_at in times + [due]])
+        self.assertEqual(archived.history_points, resident.history_points)
+        self.assertEqual(list(archived.iter_statement('a', 0, 86405200)), list(resident.iter_statement('a', 0, 86405200)))
+        #statements read the ledger rows of the record without expanding it
+        archived.archive.expand = None
+        for t1, t2 in ((0, 0), (17, 17), (4990, 5010), (5099, 86405040), (86405100, 86405200)):
+            self.assertEqual(list(archived.iter_statement('a', t1, t2)), list(resident.iter_statement('a', t1, t2)))
+        del archived.archive.expand
+        self.assertEqual(archived.deposit(86405300, 'a', 1), resident.deposit(86405300, 'a', 1))
+        self.assertEqual(list(archived.history(archived.handle('a')).items()),
+                         list(resident.history(resident.handle('a')).items()))
+
+    def test_close_account(self):
+        system = BankingSystemImpl()
+        system.create_account(1, 'a')
+        system.create_account(2, 'b')
+        system.deposit(3, 'a', 1000)
+        system.pay(4, 'a', 400)
+        system.transfer(5, 'a', 'b', 600)
+        self.assertFalse(system.close_account(6, 'c'))
+        #the refund of payment1 is still pending
+        self.assertFalse(system.close_account(6, 'a'))
+        system.transfer(86400004, 'a', 'b', 8)
+        self.assertEqual(system.top_spenders(86400004, 2), ['a(1008)', 'b(0)'])
+        self.assertTrue(system.close_account(86400010, 'a'))
+        self.assertFalse(system.close_account(86400011, 'b'))
+
+        self.assertIsNone(system.deposit(86400012, 'a', 5))
+        self.assertIsNone(system.pay(86400012, 'a', 5))
+        self.assertEqual(system.top_spenders(86400012, 2), ['b(0)'])
+        self.assertEqual(system.get_balance(86400012, 'a', 86400004), 0)
+        self.assertEqual(system.get_balance(86400012, 'a', 5), 0)
+        self.assertEqual(system.get_balance(86400012, 'a', 4), 600)
+        self.assertIsNone(system.get_balance(86400012, 'a', 86400010))
+        self.assertIsNone(system.get_payment_status(86400012, 'a', 'payment1'))
+        self.assertEqual(len(list(system.iter_statement('a', 0, 86400012))), 5)
+        self.assertTrue(system.create_account(86400013, 'a'))
+        self.assertEqual(system.get_balance(86400014, 'a', 86400014), 0)
+
+    def test_archiving_dormant_accounts_reduces_memory(self):
+        system = BankingSystemImpl()
+        rng = random.Random(5)
+        names = ['acc%d' % i for i in range(400)]
+        for t, name in enumerate(names):
+            system.create_account(t, name)
+            system.deposit(t, name, 10 ** 6)
+        for t in range(1000, 200000, 50):
+            system.transfer(t, rng.choice(names), rng.choice(names), rng.randint(1, 100))
+            system.pay(t, rng.choice(names), rng.randint(1, 100))
+        before = system.memory_report()['total']
+        for name in names:
+            system.archive_account(300000, name)
+        after = system.memory_report()['total']
+        self.assertTrue(after < before / 2)
+
+    def test_export_keeps_archived_and_closed_accounts(self):
+        system = BankingSystemImpl()
+        for t, name in enumerate(['a', 'b', 'c']):
+            system.create_account(t, name)
+            system.deposit(10 + t, name, 100 * (t + 1))
+        system.pay(20, 'b', 50)
+        system.transfer(30, 'a', 'c', 100)
+        system.close_account(40, 'a')
+        system.archive_account(50, 'b')
+        with tempfile.TemporaryDirectory() as directory:
+            export_state(system, directory)
+            loaded = load_state(directory)
+        for name in ('a', 'b', 'c'):
+            for time_at in (5, 15, 25, 35, 45, 86400025):
+                self.assertEqual(loaded.get_balance(86400030, name, time_at), system.get_balance(86400030, name, time_at))
+            self.assertEqual(list(loaded.iter_statement(name, 0, 100)), list(system.iter_statement(name, 0, 100)))
+        self.assertEqual(loaded.top_spenders(60, 3), system.top_spenders(60, 3))
+        self.assertTrue(loaded.create_account(70, 'a'))
+
+
+class CreateAccountsTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def test_bulk_creation_matches_single_creation(self):
+        bulk, single = BankingSystemImpl(), BankingSystemImpl()
+        batches = [['a', 'b', 'c'], ['d', 'b', 'e', 'd', 'f'], [], ['g', 'g'], ['h']]
+        for t, batch in enumerate(batches, 1):
+            expected = [single.create_account(t, account_id) for account_id in batch]
+            self.assertEqual(bulk.create_accounts(t, batch), expected)
+        self.assertEqual(bulk.ids, single.ids)
+        self.assertEqual(bulk.top_spenders(10, 3), ['a(0)', 'b(0)', 'c(0)'])
+        rng = random.Random(2)
+        names = list(single.ids) + ['missing']
+        for t in range(10, 400000, 1000):
+            a, b, amount = rng.choice(names), rng.choice(names), rng.randint(1, 500)
+            for system in (bulk, single):
+                system.deposit(t, a, amount)
+                system.transfer(t, b, a, amount // 2)
+                system.pay(t, b, amount // 3)
+            if t % 7000 == 10:
+                bulk.merge_accounts(t, a, b)
+                single.merge_accounts(t, a, b)
+        for name in names:
+            for time_at in (0, 1, 3, 5000, 200000, 400000):
+                self.assertEqual(bulk.get_balance(400000, name, time_at), single.get_balance(400000, name, time_at))
+        self.assertEqual(bulk.top_spenders(400000, 8), single.top_spenders(400000, 8))
+
+    def test_accounts_without_activity_hold_no_containers(self):
+        system = BankingSystemImpl()
+        system.create_accounts(5, ['acc%d' % i for i in range(1000)])
+        self.assertEqual(system.histories.count(None), 1000)
+        self.assertEqual(system.payments.count(None), 1000)
+        self.assertEqual(system.memory_report()['per_account']['max'], system.memory_report()['per_account']['p50'])
+        self.assertEqual(system.get_balance(6, 'acc3', 5), 0)
+        self.assertIsNone(system.get_balance(6, 'acc3', 4))
+        system.deposit(7, 'acc3', 10)
+        self.assertEqual(system.histories.count(None), 999)
+        self.assertEqual(system.get_balance(8, 'acc3', 6), 0)
+        self.assertEqual(system.get_balance(8, 'acc3', 7), 10)
+        self.assertTrue(system.close_account(9, 'acc4'))
+        self.assertEqual(system.get_balance(10, 'acc4', 8), 0)
+        self.assertIsNone(system.get_balance(10, 'acc4', 9))
+
+
+class MetricsTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def recount(self, system):
+        points = sum(len(system.history(h)) for h in range(len(system.names)))
+        if system.history_store is not None:
+            points += sum(len(list(system.history_store.items(h))) for h in range(len(system.names)))
+        pay_log = system.pay_log
+        pending = sum(amount for amount, settled in zip(pay_log.amounts, pay_log.settled) if not settled)
+        merged = sum(parent != -1 for parent in system.merged_into)
+        return points, pending, merged
+
+    def test_engine_totals_are_kept_incrementally(self):
+        with tempfile.TemporaryDirectory() as directory:
+            system = BankingSystemImpl(history_dir=directory, hot_window=10 ** 6, spill_min=8)
+            rng = random.Random(4)
+            names = ['acc%d' % i for i in range(20)]
+            system.create_accounts(0, names)
+            t = 0
+            for step in range(3000):
+                t += rng.randint(1, 200000)
+                a, b, roll = rng.choice(names), rng.choice(names), rng.random()
+                if roll < 0.3:
+                    system.deposit(t, a, rng.randint(1, 1000))
+                elif roll < 0.55:
+                    system.transfer(t, a, b, rng.randint(1, 500))
+                elif roll < 0.85:
+                    system.pay(t, a, rng.randint(1, 500))
+                elif roll < 0.88:
+                    system.merge_accounts(t, a, b)
+                elif roll < 0.93:
+                    system.archive_account(t, a)
+                elif roll < 0.95:
+                    system.close_account(t, a)
+                else:
+                    system.create_account(t, a)
+                if step % 500 == 0:
+                    self.assertEqual((system.history_points, system.pending_cashback, system.merged_accounts),
+                                     self.recount(system))
+            self.assertEqual((system.history_points, system.pending_cashback, system.merged_accounts),
+                             self.recount(system))
+            export_state(system, os.path.join(directory, 'export'))
+            loaded = load_state(os.path.join(directory, 'export'))
+            self.assertEqual((loaded.history_points, loaded.pending_cashback, loaded.merged_accounts),
+                             self.recount(loaded))
+            system.close()
+
+    def test_exposition_served_over_http(self):
+        system = BankingSystemImpl(metrics=True)
+        system.create_accounts(1, ['a', 'b'])
+        for t in range(2, 12):
+            system.deposit(t, 'a', 100)
+        system.pay(12, 'a', 500)
+        system.get_balance(13, 'b', 13)
+        system.merge_accounts(14, 'a', 'b')
+        server = MetricsServer(system)
+        server.start()
+        try:
+            with urllib.request.urlopen(server.url) as response:
+                self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+                text = response.read().decode()
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(server.url.replace('/metrics', '/other'))
+        finally:
+            server.stop()
+        samples = {}
+        for line in text.splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        self.assertEqual(samples['banking_accounts'], 1)
+        self.assertEqual(samples['banking_merge_aliases'], 1)
+        self.assertEqual(samples['banking_pending_cashback'], 1)
+        self.assertEqual(samples['banking_pending_cashback_amount'], 10)
+        self.assertEqual(samples['banking_payments_total'], 1)
+        self.assertEqual(samples['banking_operations_total{method="deposit"}'], 10)
+        self.assertEqual(samples['banking_operations_total{method="create_accounts"}'], 1)
+        self.assertEqual(samples['banking_operation_duration_seconds_count{method="deposit"}'], 10)
+        self.assertEqual(samples['banking_operation_duration_seconds_bucket{method="deposit",le="+Inf"}'], 10)
+        buckets = [value for name, value in samples.items() if name.startswith('banking_operation_duration_seconds_bucket{method="deposit"')]
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertNotIn('banking_operations_total', exposition(BankingSystemImpl()))
+
+    def test_scrapers_keep_their_own_rate_windows(self):
+        system = BankingSystemImpl(metrics=True)
+        system.create_accounts(1, ['a'])
+        metrics = system.metrics
+        self.assertEqual(metrics.rates('first'), {})
+        for t in range(2, 12):
+            system.deposit(t, 'a', 100)
+        self.assertEqual(metrics.rates('second'), {})
+        #the second scraper's first scrape does not reset the first one's window
+        self.assertGreater(metrics.rates('first')['deposit'], 0)
+        self.assertEqual(metrics.rates('second')['deposit'], 0)
+
+        server = MetricsServer(system)
+        server.start()
+        try:
+            for scraper in ('first', 'second', 'first'):
+                urllib.request.urlopen(server.url + '?scraper=' + scraper).read()
+            system.deposit(12, 'a', 100)
+            with urllib.request.urlopen(server.url + '?scraper=second') as response:
+                text = response.read().decode()
+        finally:
+            server.stop()
+        self.assertNotIn('banking_operations_per_second{method="deposit"} 0.000', text)
+
+    def test_exposition_alongside_new_methods(self):
+        system = BankingSystemImpl(metrics=True)
+        metrics = system.metrics
+        done = threading.Event()
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+        def observe():
+            #engine threads add a histogram the first time a method is called
+            for i in range(20000):
+                metrics.observe('method%d' % i, 1e-6)
+            done.set()
+
+        thread = threading.Thread(target=observe)
+        thread.start()
+        try:
+            while not done.is_set():
+                exposition(system, 'scraper')
+        finally:
+            thread.join()
+            sys.setswitchinterval(interval)
+        self.assertIn('banking_operations_total{method="method19999"} 1', exposition(system))
+
+
+class ParallelReplayTests(unittest.TestCase):
+
+    failureException = Exception
+
+    def make_trace(self, seed, n_ops=3000, n_accounts=300, gap=3000000):
+        #sparse transfers and frequent merges, re-created ids and status
+        #checks of payments made just before
+        rng = random.Random(seed)
+        names = ['acc%d' % i for i in range(n_accounts)]
+        trace = [('create_account', (t, name)) for t, name in enumerate(names[:n_accounts // 2])]
+        t = len(trace)
+        payments = 0
+        for _ in range(n_ops):
+            t += rng.randint(1, gap)
+            roll = rng.random()
+            a = rng.choice(names)
+            if roll < 0.05:
+                trace.append(('create_account', (t, a)))
+            elif roll < 0.3:
+                trace.append(('deposit', (t, a, rng.randint(1, 5000))))
+            elif roll < 0.4:
+                trace.append(('transfer', (t, a, rng.choice(names), rng.randint(1, 2000))))
+            elif roll < 0.6:
+                trace.append(('pay', (t, a, rng.randint(1, 2000))))
+                payments += 1
+            elif roll < 0.7:
+                trace.append(('get_balance', (t, a, rng.randint(0, t))))
+            elif roll < 0.85:
+                trace.append(('get_payment_status', (t, a, 'payment%d' % rng.randint(max(1, payments - 20), payments + 5))))
+            elif roll < 0.9:
+                trace.append(('top_spenders', (t, rng.choice([3, 10]))))
+            else:
+                trace.append(('merge_accounts', (t, a, rng.choice(names))))
+        return trace
+
+    def state(self, system):
+        with tempfile.TemporaryDirectory() as directory:
+            export_state(system, directory)
+            tables = {name: open(os.path.join(directory, name), 'rb').read() for name in sorted(os.listdir(directory))}
+        return (tables, [None if numbers is None else list(numbers) for numbers in system.payments],
+                [history is None for history in system.histories], system.ids, system.retired, system.merged_from,
+                system.archive.records, system.history_points, system.pending_cashback, system.merged_accounts,
+                system.clock, len(system.scheduler))
+
+    def test_matches_sequential_replay(self):
+        for seed, gap in ((0, 3000000), (1, 20000000), (2, 2000)):
+            trace = self.make_trace(seed, gap=gap)
+            system = BankingSystemImpl()
+            expected = [getattr(system, method)(*args) for method, args in trace]
+            replayed, results = ParallelReplay(workers=3, window=200).run(trace)
+            self.assertEqual(results, expected)
+            self.assertEqual(self.state(replayed), self.state(system))
+
+    def test_continues_an_engine_with_archived_accounts(self):
+        def setup():
+            system = BankingSystemImpl()
+            for t, name in enumerate(['a', 'b', 'c', 'd']):
+                system.create_account(t, name)
+                system.deposit(10, name, 1000)
+            system.pay(20, 'b', 500)
+            system.merge_accounts(30, 'c', 'd')
+            system.archive_account(40, 'b')
+            system.archive_account(40, 'c')
+            return system
+
+        day = 86400000
+        trace = [('deposit', (50, 'a', 5)), ('get_balance', (60, 'b', 60)), ('transfer', (70, 'c', 'e', 1)),
+                 ('create_account', (80, 'e')), ('pay', (day + 30, 'a', 100)), ('get_balance', (day + 40, 'b', day + 40)),
+                 ('deposit', (day + 50, 'c', 1)), ('top_spenders', (day + 60, 3)),
+                 ('get_payment_status', (day + 70, 'a', 'payment2'))]
+        system = setup()
+        expected = [getattr(system, method)(*args) for method, args in trace]
+        replayed, results = ParallelReplay(workers=3, window=len(trace)).run(trace, setup())
+        self.assertEqual(results, expected)
+        self.assertEqual(self.state(replayed), self.state(system))
+        self.assertIn(system.handle('b'), replayed.archive)
+
+    def test_rejects_unsupported_calls(self):
+        with self.assertRaises(ValueError):
+            ParallelReplay().run([('close_account', (1, 'a'))])
@@ -0,0 +1,243 @@
+import heapq
+import threading
+import time
+
+
+class HeapScheduler:
+    """
+    Priority queue of pending cashback refunds ordered by due timestamp.
+    Refunds due at the same time come out in scheduling order.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.seq = 0
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def schedule(self, due: int, item) -> None:
+        """
+        Queue `item` to become due at timestamp `due`.
+        """
+        heapq.heappush(self.heap, (due, self.seq, item))
+        self.seq += 1
+
+    def next_due(self) -> int | None:
+        """
+        Earliest due timestamp, or `None` if nothing is pending.
+        """
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now: int) -> list[tuple[int, object]]:
+        """
+        Remove and return every `(due, item)` with `due <= now`, in due
+        order.
+        """
+        heap = self.heap
+        due_items = []
+        while heap and heap[0][0] <= now:
+            due, _, item = heapq.heappop(heap)
+            due_items.append((due, item))
+        return due_items
+
+
+class SettlementWorker:
+    """
+    Background thread that settles due cashback on a schedule by calling
+    `system.advance_time(clock())` every `interval` seconds.
+
+    The banking engine is not thread-safe: every other caller of `system`
+    must hold `lock` while it runs operations.
+    """
+
+    def __init__(self, system, interval: float = 1.0, clock=None, lock=None):
+        """
+        Parameters
+        ----------
+        system: engine exposing `advance_time(timestamp)`
+        interval: seconds between settlement passes
+        clock: callable returning the current timestamp in ms; defaults
+        to wall-clock time
+        lock: lock shared with the other users of `system`
+        """
+        self.system = system
+        self.interval = interval
+        self.clock = clock if clock is not None else lambda: int(time.time() * 1000)
+        self.lock = lock if lock is not None else threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.passes = 0
+
+    def run_once(self) -> None:
+        with self.lock:
+            self.system.advance_time(self.clock())
+        self.passes += 1
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.run_once()
+
+    def start(self) -> None:
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name="settlement", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class TimingWheel:
+    """
+    Hierarchical timing wheel of pending cashback refunds, with the same
+    interface as `HeapScheduler`.
+
+    `levels` wheels of 2**`bits` slots each cover ticks (ms) at
+    increasing granularity; an item sits on the lowest wheel whose window
+    still contains its due time and is cascaded down one wheel when time
+    reaches its slot. Scheduling is O(1) and expiry amortized O(1). An
+    occupancy bitmap per wheel lets `pop_due` jump straight to the next
+    occupied slot instead of ticking through empty milliseconds. Items
+    beyond the top wheel wait in an overflow list.
+    """
+
+    def __init__(self, bits: int = 8, levels: int = 4):
+        self.bits = bits
+        self.levels = levels
+        self.mask = (1 << bits) - 1
+        self.slots = [[[] for _ in range(1 << bits)] for _ in range(levels)]
+        self.bitmaps = [0] * levels
+        self.overflow = []
+        #items scheduled behind the wheel's time, as a heap of (due, seq, item)
+        self.late = []
+        self.seq = 0
+        self.count = 0
+        #next tick to process; every earlier tick has been expired
+        self.time = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def schedule(self, due: int, item) -> None:
+        """
+        Queue `item` to become due at timestamp `due`.
+        """
+        if self.time is None:
+            self.time = due
+        self.count += 1
+        if due < self.time:
+            heapq.heappush(self.late, (due, self.seq, item))
+            self.seq += 1
+        else:
+            self._place(due, item)
+
+    def _place(self, due: int, item) -> None:
+        #lowest wheel on which due shares the current window with time:
+        #the highest differing bit picks the wheel
+        level = ((due ^ self.time).bit_length() - 1) // self.bits
+        if level < 0:
+            level = 0
+        elif level >= self.levels:
+            self.overflow.append((due, item))
+            return
+        index = (due >> (self.bits * level)) & self.mask
+        slot = self.slots[level][index]
+        if not slot:
+            self.bitmaps[level] |= 1 << index
+        slot.append((due, item))
+
+    def _take(self, level: int, index: int) -> list:
+        slot = self.slots[level][index]
+        self.slots[level][index] = []
+        self.bitmaps[level] &= ~(1 << index)
+        return slot
+
+    def _next_tick(self, t: int) -> int | None:
+        """
+        Earliest tick after `t` at which a slot expires or cascades.
+        """
+        bits = self.bits
+        for level in range(self.levels):
+            shift = bits * level
+            index = (t >> shift) & self.mask
+            ahead = self.bitmaps[level] >> (index + 1)
+            if ahead:
+                #lower wheels only hold ticks before the next boundary of the wheel above
+                nxt = index + (ahead & -ahead).bit_length()
+                return ((t >> (shift + bits)) << (shift + bits)) + (nxt << shift)
+        if self.overflow:
+            top = bits * self.levels
+            return ((t >> top) + 1) << top
+        return None
+
+    def next_due(self) -> int | None:
+        """
+        Earliest due timestamp, or `None` if nothing is pending.
+        """
+        late_due = self.late[0][0] if self.late else None
+        if self.count == len(self.late):
+            return late_due
+        #earliest item of the first occupied slot on every wheel; a slot of a
+        #higher wheel may still be waiting to cascade at the current tick
+        dues = [due for due, _ in self.overflow]
+        if late_due is not None:
+            dues.append(late_due)
+        for level in range(self.levels):
+            shift = self.bits * level
+            index = (self.time >> shift) & self.mask
+            ahead = self.bitmaps[level] >> index
+            if ahead:
+                slot = self.slots[level][index + (ahead & -ahead).bit_length() - 1]
+                dues.append(min(due for due, _ in slot))
+        return min(dues)
+
+    def pop_due(self, now: int) -> list[tuple[int, object]]:
+        """
+        Remove and return every `(due, item)` with `due <= now`, in due
+        order.
+        """
+        due_items = []
+        late = self.late
+        while late and late[0][0] <= now:
+            due, _, item = heapq.heappop(late)
+            due_items.append((due, item))
+        if self.time is None or self.count == len(due_items) + len(late):
+            #nothing on the wheel: jump the clock, anchoring a new wheel at
+            #now so that later items due before their predecessors still fit
+            if self.time is None or now >= self.time:
+                self.time = now + 1
+            self.count -= len(due_items)
+            return due_items
+
+        bits = self.bits
+        top = bits * self.levels
+        while self.time <= now:
+            t = self.time
+            #at window boundaries, cascade higher wheels down (top first)
+            if not t & ((1 << top) - 1) and self.overflow:
+                waiting = self.overflow
+                self.overflow = []
+                for due, item in waiting:
+                    self._place(due, item)
+            for level in range(self.levels - 1, 0, -1):
+                shift = bits * level
+                if not t & ((1 << shift) - 1):
+                    index = (t >> shift) & self.mask
+                    if self.bitmaps[level] >> index & 1:
+                        for due, item in self._take(level, index):
+                            self._place(due, item)
+            #expire the occupied ms slots of the lowest wheel up to now in one sweep
+            index = t & self.mask
+            last = min(now, t | self.mask)
+            occupied = (self.bitmaps[0] >> index) & ((1 << (last - t + 1)) - 1)
+            while occupied:
+                due_items.extend(self._take(0, index + (occupied & -occupied).bit_length() - 1))
+                occupied &= occupied - 1
+
+            nxt = self._next_tick(last)
+            self.time = now + 1 if nxt is None or nxt > now else nxt
+        self.count -= len(due_items)
+        return due_items